@@ -1,25 +1,42 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Any, Union
 import asyncio
-import random
 
 from models.models import (
     Document,
     DocumentChunk,
+    DocumentChunkMetadata,
     DocumentMetadataFilter,
     Query,
     QueryGroupResult,
     QueryWithEmbedding,
-    SearchPrecision,
     DocumentDelete
 )
 
-from services.data_processing import get_embeddings, get_document_chunks
+from services.data_processing import (
+    EMBEDDING_ID,
+    PARTITION,
+    STREAMING_UPSERT_CHARS,
+    aget_query_embeddings,
+    embed_document_chunks,
+    embedding_executor,
+    get_document_chunks,
+    get_document_metadata,
+    is_incremental,
+    iter_document_chunks,
+    stream_document_chunks,
+)
+from services.dedup import get_deduplicator
+from services.embedding_cache import get_embedding_cache
+from services.query_batcher import QueryEmbeddingBatcher
 
 
 #default values
 MODEL_SEARCH_SIZE = 5
 
+# Query texts of concurrent requests are embedded together
+query_batcher = QueryEmbeddingBatcher(aget_query_embeddings)
+
 #import qgr_data_processing as qgr
 
 class DataStore(ABC):
@@ -28,14 +45,132 @@ class DataStore(ABC):
     ) -> Dict[str, Dict[str, str]]:
         """
             Takes in a list of documents and inserts them into the database.
+            Documents of INCREMENTAL_UPSERT_PARTITIONS with a title and a creation date
+            (and so a stable id) are updated incrementally, see upsert_incremental, documents longer than STREAMING_UPSERT_CHARS are streamed,
+            see upsert_stream.
         """
+        incremental = [doc for doc in documents if is_incremental(doc)]
+        documents = [doc for doc in documents if not is_incremental(doc)]
+        streamed = [doc for doc in documents if len(doc.text) > STREAMING_UPSERT_CHARS]
+        documents = [doc for doc in documents if len(doc.text) <= STREAMING_UPSERT_CHARS]
 
-        document_chunks = get_document_chunks(documents, chunk_token_size)
-        
-        response = await self._upsert(document_chunks)
+        response = {}
+        if documents:
+            document_chunks, deduplications = await get_document_chunks(documents, chunk_token_size)
+
+            response = await self._upsert(document_chunks) or {}
+
+            if deduplications:
+                # Only the documents stored in full are indexed, the others are deduplicated again on their next upsert
+                stored = [
+                    deduplication for deduplication in deduplications
+                    if int(response.get(deduplication.document_id, {}).get("count", 0))
+                    == len(document_chunks[deduplication.document_id])
+                ]
+                await asyncio.get_running_loop().run_in_executor(None, get_deduplicator().record, stored)
+
+        for doc in streamed:
+            response.update(await self.upsert_stream(doc, chunk_token_size))
+
+        for doc in incremental:
+            response.update(await self.upsert_incremental(doc, chunk_token_size))
     
         return response or {"document_id": {}, "message": "Nothing processed."}
 
+    async def upsert_stream(
+        self, document: Document, chunk_token_size: Optional[int] = 512
+    ) -> Dict[str, Dict[str, str]]:
+        """
+            Inserts a large document batch by batch: its chunks are cleaned, split and embedded
+            lazily and every batch is inserted while the next one is embedded, so memory does
+            not grow with the document size.
+        """
+        doc_id, chunk_metadata = get_document_metadata(document)
+        count = 0
+        async for batch in stream_document_chunks(document, doc_id, chunk_metadata, chunk_token_size):
+            response = await self._upsert({doc_id: batch})
+            if response:
+                count += int(response[doc_id]["count"])
+        return {doc_id: {"count": str(count)}}
+
+    async def upsert_incremental(
+        self, document: Document, chunk_token_size: Optional[int] = 512
+    ) -> Dict[str, Dict[str, str]]:
+        """
+            Updates a document already in the database: its chunks are diffed by content hash
+            against the stored ones, only the new chunks are embedded and inserted and only the
+            vanished ones are deleted. A stored chunk whose text is still in the document is kept
+            wherever it moved, with the index it was inserted at: chunk indexes are metadata,
+            not part of the diff. The counts of inserted, unchanged and deleted chunks are returned.
+            Datastores that cannot diff chunks replace the document: delete it, then insert every chunk.
+        """
+        doc_id, chunk_metadata = get_document_metadata(document)
+        chunks = list(iter_document_chunks(document, doc_id, chunk_metadata, chunk_token_size))
+        partition_name = document.partition or PARTITION
+        stored = None
+        if self._supports_chunk_deletes():
+            stored = await self._get_chunk_hashes(doc_id, document.collection, partition_name, chunk_metadata)
+        if stored is None:
+            # Nothing to diff against, replace the document
+            await self._delete([DocumentDelete(document_id=doc_id, collection=document.collection)])
+            await embed_document_chunks(chunks)
+            return await self._upsert({doc_id: chunks}) or {doc_id: {"count": "0"}}
+
+        new_chunks = []
+        for chunk in chunks:
+            # The stored chunks with the same text, one is kept per occurrence in the document
+            ids = stored.get(chunk.chunk_hash)
+            if ids:
+                ids.pop()
+            else:
+                new_chunks.append(chunk)
+        vanished = [id for ids in stored.values() for id in ids]
+
+        inserted = 0
+        if new_chunks:
+            await embed_document_chunks(new_chunks)
+            response = await self._upsert({doc_id: new_chunks})
+            if response:
+                inserted = int(response[doc_id]["count"])
+
+        deleted = 0
+        # Only drop the old chunks once their replacements are in
+        if vanished and inserted == len(new_chunks):
+            deleted = await self._delete_chunks(document.collection, vanished)
+
+        return {
+            doc_id: {
+                "count": str(inserted),
+                "unchanged": str(len(chunks) - len(new_chunks)),
+                "deleted": str(deleted),
+            }
+        }
+
+    def _supports_chunk_deletes(self) -> bool:
+        """Whether the datastore deletes single chunks, see _delete_chunks."""
+        return type(self)._delete_chunks is not DataStore._delete_chunks
+
+    async def _get_chunk_hashes(
+        self,
+        document_id: str,
+        collection_name: Optional[str],
+        partition_name: str,
+        metadata: DocumentChunkMetadata,
+    ) -> Optional[Dict[str, List[Any]]]:
+        """
+        The ids of the stored chunks of a document by chunk hash (several for a text repeated
+        in the document), None if the datastore does not store chunk hashes. Only the chunks
+        stored with the same title, authors and creation date as metadata belong to the document.
+        """
+        return None
+
+    async def _delete_chunks(self, collection_name: Optional[str], ids: List[Any]) -> int:
+        """
+        Removes chunks by id, returns how many were removed.
+        Datastores without it replace documents in full on incremental upserts.
+        """
+        raise NotImplementedError
+
     
     async def query(self, queries: List[Query]) -> List[QueryGroupResult]:
         """
@@ -43,39 +178,29 @@ class DataStore(ABC):
         """
         # get a list of of just the queries from the Query list
         query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        # embed them in the embedding executor, off the event loop, batched with concurrent queries
+        query_embeddings = await query_batcher.embed(query_texts)
         
-        # hydrate the queries with embeddings
+        # The results kept per query, fewer per query when several are asked at once
+        num_queries = len(queries)
+        if num_queries == 1:
+            result_size = MODEL_SEARCH_SIZE
+        elif num_queries == 2:
+            result_size = MODEL_SEARCH_SIZE - 2
+        else:
+            result_size = 1
+
+        # hydrate the queries with embeddings, only the kept results are searched for
         queries_with_embeddings = [
-            QueryWithEmbedding(**query.dict(), embedding=embedding)
+            QueryWithEmbedding(
+                **{**query.dict(), "top_k": min(query.top_k or result_size, result_size)}, embedding=embedding
+            )
             for query, embedding in zip(queries, query_embeddings)
         ]
         response = await self._query(queries_with_embeddings)
-    
-                        
-        def truncate_results(results, size, precision):
-            """Helper function to truncate results based on precision."""
-            if precision == SearchPrecision.low or precision == SearchPrecision.medium:
-                return random.sample(results, min(size, len(results)))
-            else:
-                return results[:size]
 
-        num_queries = len(response)
-
-        if num_queries == 1:
-            response[0].results = truncate_results(
-                response[0].results, MODEL_SEARCH_SIZE, queries[0].searchprecision
-            )
-        elif num_queries == 2:
-            response[0].results = truncate_results(
-                response[0].results, MODEL_SEARCH_SIZE - 2, queries[0].searchprecision
-            )
-            response[1].results = truncate_results(
-                response[1].results, MODEL_SEARCH_SIZE - 2, queries[1].searchprecision
-            )
-        else:
-            for i, r in enumerate(response):
-                r.results = truncate_results(r.results, 1, queries[i].searchprecision)
+        for r in response:
+            r.results = r.results[:result_size]
 
 
         def process_query_results(query_results):
@@ -122,7 +247,14 @@ class DataStore(ABC):
         Removes vectors by documentId
         Returns whether the operation was successful.
         """
-        return await self._delete(documents)
+        deleted = await self._delete(documents)
+        deduplicator = get_deduplicator()
+        if deduplicator is not None:
+            # Deleted documents must not hide their next upsert
+            await asyncio.get_running_loop().run_in_executor(
+                None, deduplicator.forget, [document.document_id for document in documents]
+            )
+        return deleted
     
     async def raw_upsert(
             self,
@@ -141,4 +273,16 @@ class DataStore(ABC):
         """
         Flush
         """
-        return await self._flush()
\ No newline at end of file
+        return await self._flush()
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Embedding throughput, cache, query batching and deduplication metrics
+        """
+        deduplicator = get_deduplicator()
+        return {
+            "embedder": embedding_executor.stats(),
+            "embedding_cache": get_embedding_cache(EMBEDDING_ID).stats(),
+            "query_batcher": query_batcher.stats(),
+            "dedup": deduplicator.stats() if deduplicator is not None else {},
+        }
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+A pool of Milvus connection aliases.
+
+pymilvus opens one gRPC channel per connection alias, so every call of a datastore
+using a single alias shares one channel. The pool keeps MILVUS_POOL_SIZE aliases and
+leases the least busy one to every operation. An alias is health checked (a server
+version round-trip) when it has not been checked for MILVUS_HEALTH_CHECK_INTERVAL
+seconds or after an operation on it failed, and reconnected when the check fails.
+Collection objects look their connection up by alias on every call, so they keep
+working across reconnects.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+from loguru import logger
+from pymilvus import connections, utility
+
+
+MILVUS_POOL_SIZE = int(os.environ.get("MILVUS_POOL_SIZE") or 1)
+MILVUS_HEALTH_CHECK_INTERVAL = float(os.environ.get("MILVUS_HEALTH_CHECK_INTERVAL") or 30)  # Seconds
+
+
+class MilvusConnectionPool:
+    def __init__(
+        self,
+        aliases: List[str],
+        connect: Callable[[str], None],
+        health_check_interval: float = MILVUS_HEALTH_CHECK_INTERVAL,
+        timeout: float = 10,
+    ):
+        """Create a pool over connected aliases.
+
+        Args:
+            aliases (List[str]): The connection aliases, already connected.
+            connect (Callable[[str], None]): Connects an alias to the Milvus server, used to reconnect.
+            health_check_interval (float, optional): Seconds after which a leased alias is checked again.
+                                                     Defaults to MILVUS_HEALTH_CHECK_INTERVAL.
+            timeout (float, optional): Timeout of a health check in seconds.
+        """
+        if not aliases:
+            raise ValueError("A connection pool needs at least one alias")
+        self.aliases = list(aliases)
+        self._connect = connect
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, int] = {alias: 0 for alias in self.aliases}
+        self._checked_at: Dict[str, float] = {alias: time.monotonic() for alias in self.aliases}
+        # Metrics
+        self.leases = 0
+        self.reconnects = 0
+        self.failed_checks = 0
+
+    @contextmanager
+    def lease(self) -> Iterator[str]:
+        """Lease the alias with the fewest operations in flight for one operation."""
+        with self._lock:
+            alias = min(self.aliases, key=self._in_flight.__getitem__)
+            self._in_flight[alias] += 1
+            self.leases += 1
+            due = time.monotonic() - self._checked_at[alias] > self.health_check_interval
+            if due:
+                # Other leases do not check it meanwhile
+                self._checked_at[alias] = time.monotonic()
+        try:
+            if due:
+                self.check(alias)
+            yield alias
+        finally:
+            with self._lock:
+                self._in_flight[alias] -= 1
+
+    def check(self, alias: str) -> bool:
+        """Check that alias reaches the server, reconnect it if not. Returns whether it was healthy."""
+        try:
+            utility.get_server_version(using=alias, timeout=self.timeout)
+            healthy = True
+        except Exception as e:
+            logger.warning("Milvus connection '{}' failed its health check, reconnecting, error: {}".format(alias, e))
+            with self._lock:
+                self.failed_checks += 1
+            self.reconnect(alias)
+            healthy = False
+        with self._lock:
+            self._checked_at[alias] = time.monotonic()
+        return healthy
+
+    def reconnect(self, alias: str) -> None:
+        """Open a new channel for alias."""
+        try:
+            connections.disconnect(alias)
+        except Exception:
+            pass
+        self._connect(alias)
+        with self._lock:
+            self.reconnects += 1
+        logger.info("Reconnected Milvus connection '{}'".format(alias))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self.aliases),
+                "leases": self.leases,
+                "in_flight": sum(self._in_flight.values()),
+                "failed_checks": self.failed_checks,
+                "reconnects": self.reconnects,
+            }
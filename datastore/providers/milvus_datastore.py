@@ -1,10 +1,15 @@
 import json
 import os
+import re
 import asyncio
 import ast
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
-from typing import Dict, List, Optional, Any, Union
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Any, Tuple, TypeVar, Union
 from pymilvus import (
     Collection,
     connections,
@@ -14,10 +19,17 @@ from pymilvus import (
     CollectionSchema,
     MilvusException,
 )
+from pymilvus.exceptions import DataNotMatchException, DataTypeNotMatchException, DataTypeNotSupportException, ParamError
 from uuid import uuid4
 
 
 from datastore.datastore import DataStore
+from datastore.providers.milvus_connection_pool import MILVUS_POOL_SIZE, MilvusConnectionPool
+from datastore.providers.milvus_flush_scheduler import FlushScheduler
+from datastore.providers.milvus_index_manager import MILVUS_AUTO_INDEX, IndexManager
+from datastore.providers.milvus_pk_index import get_pk_index
+from datastore.providers.milvus_write_buffer import WriteBuffer
+from services.data_processing import generate_chunk_hash
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
@@ -42,7 +54,25 @@ MILVUS_INDEX_PARAMS = json.loads(os.environ.get("MILVUS_INDEX_PARAMS", '{}'))
 MILVUS_SEARCH_PARAMS = json.loads(os.environ.get("MILVUS_SEARCH_PARAMS", '{}'))
 MILVUS_CONSISTENCY_LEVEL = os.environ.get("MILVUS_CONSISTENCY_LEVEL")
 
-#UPSERT_BATCH_SIZE = 100
+# Inserts are sent in batches bounded by both a row count and an approximate payload size
+MILVUS_UPSERT_BATCH_SIZE = int(os.environ.get("MILVUS_UPSERT_BATCH_SIZE") or 1000)
+MILVUS_UPSERT_BATCH_BYTES = int(os.environ.get("MILVUS_UPSERT_BATCH_BYTES") or 16 * 1024 * 1024)
+# Queries searched together are sent in multi-vector searches of at most this many hits (vectors * limit)
+MILVUS_SEARCH_BATCH_HITS = int(os.environ.get("MILVUS_SEARCH_BATCH_HITS") or 2048)
+# pymilvus calls are blocking, they run in a dedicated thread pool with per-call timeouts (seconds)
+MILVUS_EXECUTOR_WORKERS = int(os.environ.get("MILVUS_EXECUTOR_WORKERS") or 8)
+MILVUS_TIMEOUT = float(os.environ.get("MILVUS_TIMEOUT") or 30)
+# Flushes and collection loads can take much longer
+MILVUS_FLUSH_TIMEOUT = float(os.environ.get("MILVUS_FLUSH_TIMEOUT") or 300)
+# Flushing seals segments, so by default upserts and deletes leave it to the flush scheduler
+MILVUS_FLUSH_ON_UPSERT = (os.environ.get("MILVUS_FLUSH_ON_UPSERT") or "false").lower() == "true"
+# Deletes are sent as one expression per this many document ids (or primary keys), deleted rows are
+# invisible to searches without a flush
+MILVUS_DELETE_BATCH_SIZE = int(os.environ.get("MILVUS_DELETE_BATCH_SIZE") or 1000)
+MILVUS_FLUSH_ON_DELETE = (os.environ.get("MILVUS_FLUSH_ON_DELETE") or "false").lower() == "true"
+# Rows returned by one Milvus query at most
+MILVUS_QUERY_MAX_ROWS = 16384
+
 OUTPUT_DIM = 384
 EMBEDDING_FIELD = "content_vector"
 MILVUS_COLLECTION_PARTITIONS = ['researches', 'papers', 'notes', 'books', 'others', 'chats', 'codes', 'emails']
@@ -106,6 +136,79 @@ SCHEMA_V3 = [
     ),
 ]
 
+# SCHEMA_V3 with the hash and the index of every chunk, to diff a document against what is stored
+SCHEMA_V4 = SCHEMA_V3 + [
+    (
+        "chunkHash",
+        FieldSchema(name="chunkHash", dtype=DataType.VARCHAR, max_length=64),
+        "",
+    ),
+    (
+        "chunkIndex",
+        FieldSchema(name="chunkIndex", dtype=DataType.INT64),
+        0,
+    ),
+]
+
+SCHEMAS = {"V3": SCHEMA_V3, "V4": SCHEMA_V4}
+
+
+def _schema_version(collection: Collection) -> str:
+    """V4 if the collection stores chunk hashes, V3 otherwise."""
+    for field in collection.schema.fields:
+        if field.name == "chunkHash":
+            return "V4"
+    return "V3"
+
+
+def _collection_key(collection_name: Optional[str]) -> str:
+    """The name of a collection, given by name, Collection member or None for MILVUS_COLLECTION."""
+    return getattr(collection_name, "value", collection_name) or MILVUS_COLLECTION
+
+
+# Errors of requests rejected before anything was applied, e.g. by a stale handle of a recreated collection
+_NOT_APPLIED_ERRORS = ("collection not found", "can't find collection", "collection not exist", "not loaded")
+
+
+def _not_applied(e: MilvusException) -> bool:
+    """Whether a failed request was rejected without being applied, and so can be sent again."""
+    message = str(getattr(e, "message", e)).lower()
+    return any(error in message for error in _NOT_APPLIED_ERRORS)
+
+
+# Client-side checks of the insert data, raised before anything is sent
+_INVALID_DATA_EXCEPTIONS = (ParamError, DataNotMatchException, DataTypeNotMatchException, DataTypeNotSupportException)
+# Errors of inserts whose data the server rejected as a whole
+_INVALID_DATA_ERRORS = ("exceeds max length", "not equal to schema dim", "invalid")
+# Errors of inserts that may have been applied on the server, whatever else the message says
+_MAYBE_APPLIED_ERRORS = ("timeout", "timed out", "deadline", "unavailable", "cancelled")
+
+
+def _rejected(e: Exception) -> bool:
+    """Whether a failed insert was rejected without any of its rows being written, and so can be sent again.
+
+    Anything else, in particular a grpc.RpcError or a timeout that pymilvus raises as is,
+    may have been applied by the server.
+    """
+    if isinstance(e, _INVALID_DATA_EXCEPTIONS):
+        return True
+    if not isinstance(e, MilvusException):
+        return False
+    message = str(getattr(e, "message", e)).lower()
+    if any(error in message for error in _MAYBE_APPLIED_ERRORS):
+        return False
+    return _not_applied(e) or any(error in message for error in _INVALID_DATA_ERRORS)
+
+
+class CollectionHandle(NamedTuple):
+    """A loaded collection and the schema version of its fields."""
+    collection: Collection
+    schema_ver: str
+
+
+T = TypeVar("T")
+
+
 class MilvusDataStore(DataStore):
     def __init__(
         self,
@@ -125,13 +228,43 @@ class MilvusDataStore(DataStore):
         # Overwrite the default consistency level by MILVUS_CONSISTENCY_LEVEL
         self._consistency_level = MILVUS_CONSISTENCY_LEVEL or consistency_level
         self._create_connection()
+        # Milvus before 2.3 only deletes by primary key expressions
+        self._expression_deletes = self._supports_expression_deletes()
+
+        # Collection handles by (alias, name), checked and loaded once, see _get_collection
+        self._collections: Dict[Tuple[str, str], CollectionHandle] = {}
+        self._collections_lock = threading.Lock()
+        # Runs the blocking pymilvus calls of the async methods, see _run
+        self._executor = ThreadPoolExecutor(max_workers=MILVUS_EXECUTOR_WORKERS, thread_name_prefix="milvus")
+        # The primary keys of every document, None unless MILVUS_PK_INDEX_PATH is set
+        self._pk_index = get_pk_index()
+        # Flushes the written collections by row count and age, see FlushScheduler
+        self._flush_scheduler = FlushScheduler(self._flush_collection)
+        # Coalesces the rows of concurrent upserts into large inserts, see WriteBuffer
+        self._write_buffer = WriteBuffer(self._insert_rows)
+        # Chooses the vector index of the collections by size, see IndexManager
+        self._index_manager = IndexManager(EMBEDDING_FIELD, OUTPUT_DIM, timeout=MILVUS_FLUSH_TIMEOUT)
 
         self._create_collection(MILVUS_COLLECTION, create_new)  # type: ignore
         self._create_index()
+        if MILVUS_AUTO_INDEX and not MILVUS_INDEX_PARAMS:
+            # Rebuild the indexes the collections outgrow
+            self._index_manager.start(self._opened_collections)
 
     def _get_schema(self):
-        return SCHEMA_V3
+        return SCHEMAS[self._schema_ver]
     
+    def _connect(self, alias: str) -> None:
+        """Connect alias to the Milvus instance using the passed in Environment variables."""
+        connections.connect(
+            alias=alias,
+            host=MILVUS_HOST,
+            port=MILVUS_PORT,
+            user=MILVUS_USER,  # type: ignore
+            password=MILVUS_PASSWORD,  # type: ignore
+            secure=MILVUS_USE_SECURITY,
+        )
+
     def _create_connection(self):
         try:
             self.alias = ""
@@ -147,20 +280,37 @@ class MilvusDataStore(DataStore):
             # Connect to the Milvus instance using the passed in Environment variables
             if len(self.alias) == 0:
                 self.alias = uuid4().hex
-                connections.connect(
-                    alias=self.alias,
-                    host=MILVUS_HOST,
-                    port=MILVUS_PORT,
-                    user=MILVUS_USER,  # type: ignore
-                    password=MILVUS_PASSWORD,  # type: ignore
-                    secure=MILVUS_USE_SECURITY,
-                )
+                self._connect(self.alias)
                 logger.info("Create connection to Milvus server '{}:{}' with alias '{:s}'"
                                  .format(MILVUS_HOST, MILVUS_PORT, self.alias))
         except Exception as e:
             logger.error("Failed to create connection to Milvus server '{}:{}', error: {}"
                             .format(MILVUS_HOST, MILVUS_PORT, e))
 
+        # The operations are spread over MILVUS_POOL_SIZE aliases, each with its own gRPC channel
+        aliases = [self.alias]
+        for _ in range(MILVUS_POOL_SIZE - 1):
+            alias = uuid4().hex
+            try:
+                self._connect(alias)
+                aliases.append(alias)
+            except Exception as e:
+                logger.error("Failed to create pooled connection to Milvus server '{}:{}', error: {}"
+                                .format(MILVUS_HOST, MILVUS_PORT, e))
+                break
+        self._pool = MilvusConnectionPool(aliases, self._connect, timeout=MILVUS_TIMEOUT)
+        logger.info("Milvus connection pool of {} aliases".format(len(aliases)))
+
+    def _supports_expression_deletes(self) -> bool:
+        """Whether the Milvus server deletes by any boolean expression, as from 2.3, not by primary keys only."""
+        try:
+            version = utility.get_server_version(using=self.alias, timeout=MILVUS_TIMEOUT)
+        except Exception as e:
+            logger.error("Failed to get the Milvus server version, deleting by primary key, error: {}".format(e))
+            return False
+        match = re.match(r"v?(\d+)\.(\d+)", version)
+        return match is not None and (int(match.group(1)), int(match.group(2))) >= (2, 3)
+
     def _create_collection(self, collection_name, create_new: bool) -> None:
         """Create a collection based on environment and passed in variables.
 
@@ -168,7 +318,7 @@ class MilvusDataStore(DataStore):
             create_new (bool): Whether to overwrite if collection already exists.
         """
         try:
-            self._schema_ver = "V3"
+            self._schema_ver = "V4"
             # If the collection exists and create_new is True, drop the existing collection
             if utility.has_collection(collection_name, using=self.alias) and create_new:
                 utility.drop_collection(collection_name, using=self.alias)
@@ -176,7 +326,7 @@ class MilvusDataStore(DataStore):
             # Check if the collection doesnt exist
             if utility.has_collection(collection_name, using=self.alias) is False:
                 # If it doesnt exist use the field params from init to create a new schem
-                schema = [field[1] for field in SCHEMA_V3]
+                schema = [field[1] for field in SCHEMA_V4]
                 schema = CollectionSchema(schema)
                 # Use the schema to create a new collection
                 self.col = Collection(
@@ -190,7 +340,12 @@ class MilvusDataStore(DataStore):
                 for partition_name in MILVUS_COLLECTION_PARTITIONS:
                     self.col.create_partition(partition_name)
 
-                self._schema_ver = "V3"
+                if self._pk_index is not None:
+                    # Empty, every primary key will be seen being inserted
+                    self._pk_index.forget(collection_name)
+                    self._pk_index.track(collection_name)
+
+                self._schema_ver = "V4"
                 logger.info("Create Milvus collection '{}' with schema {} and consistency level {}"
                                  .format(collection_name, self._schema_ver, self._consistency_level))
             else:
@@ -199,43 +354,195 @@ class MilvusDataStore(DataStore):
                     collection_name, using=self.alias
                 )  # type: ignore
                 # Which sechma is used
-                self._schema_ver = "V3"
-                for field in self.col.schema.fields:
-                    if field.name == "id" and field.is_primary:
-                        self._schema_ver = "V3"
-                        break
+                self._schema_ver = _schema_version(self.col)
                 logger.info("Milvus collection '{}' already exists with schema {}"
                                  .format(collection_name, self._schema_ver))
         except Exception as e:
             logger.error("Failed to create collection '{}', error: {}".format(collection_name, e))
 
-    def _update_collection(self, collection_name):
+    def _load_collection(self, collection_name: str, alias: str) -> CollectionHandle:
         """
-        Switch to the specified collection in Milvus.
+        Open the specified collection in Milvus and load it if needed.
         If the collection does not exist, it could either create a new one or raise an error.
 
         Args:
-            collection_name (str): The name of the collection to switch to.
+            collection_name (str): The name of the collection to open.
+            alias (str): The connection alias the handle uses.
         """
 
         # Check if the collection exists
-        if utility.has_collection(collection_name, using=self.alias) is False:
+        if utility.has_collection(collection_name, using=alias, timeout=MILVUS_TIMEOUT) is False:
             # Option 1: Create the collection if it doesn't exist
             # self._create_collection(collection_name)
 
             # Option 2: Or, raise an error
             raise ValueError(f"Collection {collection_name} does not exist in Milvus.")
 
-        # Switch the current collection context
-        self.col = Collection(
-                    collection_name, using=self.alias
+        collection = Collection(
+                    collection_name, using=alias
                 )
         # Check if the collection is loaded
-        load_state = utility.load_state(collection_name, using=self.alias)
+        load_state = utility.load_state(collection_name, using=alias, timeout=MILVUS_TIMEOUT)
         if load_state != 'Loaded':
             # Load the collection
-            self.col.load()
-        
+            collection.load(timeout=MILVUS_FLUSH_TIMEOUT)
+        return CollectionHandle(collection, _schema_version(collection))
+
+    def _get_collection(self, collection_name: Optional[str], alias: Optional[str] = None) -> CollectionHandle:
+        """The handle of a collection on a connection alias, opened and loaded on first use only."""
+        key = (alias or self.alias, collection_name or MILVUS_COLLECTION)
+        handle = self._collections.get(key)
+        if handle is None:
+            with self._collections_lock:
+                handle = self._collections.get(key)
+                if handle is None:
+                    handle = self._load_collection(key[1], key[0])
+                    self._collections[key] = handle
+        return handle
+
+    def _opened_collections(self) -> List[Collection]:
+        """Every collection opened on any alias, once, through its handle on the main alias."""
+        collections = []
+        for collection_name in sorted({name for _, name in list(self._collections)}):
+            try:
+                collections.append(self._get_collection(collection_name).collection)
+            except Exception as e:
+                logger.error("Failed to open collection '{}', error: {}".format(collection_name, e))
+        return collections
+
+    def _refresh_collection(self, collection_name: Optional[str], alias: Optional[str] = None) -> CollectionHandle:
+        """Drop the cached handle of a collection (e.g. dropped, recreated or released) and open it again."""
+        key = (alias or self.alias, collection_name or MILVUS_COLLECTION)
+        with self._collections_lock:
+            self._collections.pop(key, None)
+        return self._get_collection(collection_name, alias)
+
+    def _with_collection(
+        self, collection_name: Optional[str], operation: Callable[[CollectionHandle], T], idempotent: bool = True
+    ) -> T:
+        """Run operation on the cached handle of a collection over a pooled connection.
+        On a Milvus error, check the connection, refresh the handle and retry once. Operations that
+        are not idempotent (inserts) are only retried when the error shows nothing was applied."""
+        with self._pool.lease() as alias:
+            try:
+                return operation(self._get_collection(collection_name, alias))
+            except MilvusException as e:
+                if not idempotent and not _not_applied(e):
+                    # E.g. timed out on the client but applied on the server, retrying would insert twice
+                    raise
+                logger.warning("Operation on collection '{}' failed, refreshing its handle, error: {}"
+                               .format(collection_name or MILVUS_COLLECTION, e))
+                self._pool.check(alias)
+                return operation(self._refresh_collection(collection_name, alias))
+
+    def _gated(
+        self, collection_name: Optional[str], operation: Callable[[CollectionHandle], T], idempotent: bool = True
+    ) -> T:
+        """_with_collection, waiting while the index of the collection is rebuilt by any process, see IndexManager."""
+        with self._index_manager.operation(_collection_key(collection_name)):
+            return self._with_collection(collection_name, operation, idempotent)
+
+    async def _run(
+        self, collection_name: Optional[str], operation: Callable[[CollectionHandle], T], idempotent: bool = True
+    ) -> T:
+        """Run an operation on a collection, see _gated, in the Milvus executor without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._gated, collection_name, operation, idempotent)
+
+    def _flush_collection(self, collection_name: str) -> None:
+        self._gated(collection_name, lambda handle: handle.collection.flush(timeout=MILVUS_FLUSH_TIMEOUT))
+
+    async def _flush_collections(self, collection_names: Optional[List[str]] = None) -> List[str]:
+        """Flush the collections with unflushed rows (or the given ones among them) now."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._flush_scheduler.flush, collection_names)
+
+    def _insert(self, handle: CollectionHandle, data: List[List[Any]], partition_name: Optional[str]) -> Any:
+        """Insert columns (the document ids first) and record the primary keys of the inserted rows."""
+        result = handle.collection.insert(data=data, partition_name=partition_name, timeout=MILVUS_TIMEOUT)
+        if result:
+            self._flush_scheduler.record(handle.collection.name, result.insert_count)
+        if self._pk_index is not None and result:
+            document_ids = data[0]
+            primary_keys = list(result.primary_keys or [])
+            if len(primary_keys) == len(document_ids):
+                rows = zip(document_ids, primary_keys)
+            else:
+                # Only the keys of the inserted rows came back
+                rows = zip((document_ids[i] for i in result.succ_index), primary_keys)
+            self._pk_index.add(handle.collection.name, rows)
+        return result
+
+    def _track_primary_keys(self, handle: CollectionHandle) -> bool:
+        """Backfill the primary key index with the stored chunks of a collection it has not seen filled.
+        Returns whether the index holds every chunk of the collection, the backfill needs Milvus 2.3."""
+        collection_name = handle.collection.name
+        if self._pk_index.is_tracked(collection_name):
+            return True
+        if not self._expression_deletes:
+            # No query iterator before Milvus 2.3, and paginated queries stop at MILVUS_QUERY_MAX_ROWS rows
+            return False
+        logger.info("Backfilling the primary key index of collection '{}'".format(collection_name))
+        iterator = handle.collection.query_iterator(
+            batch_size=MILVUS_DELETE_BATCH_SIZE, output_fields=["documentId"], timeout=MILVUS_TIMEOUT
+        )
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                self._pk_index.add(collection_name, [(row["documentId"], row["id"]) for row in rows])
+        finally:
+            iterator.close()
+        self._pk_index.track(collection_name)
+        return True
+
+    def _delete_documents(self, handle: CollectionHandle, document_ids: List[str]) -> int:
+        """Delete the chunks of documents, by primary key for the documents the index knows.
+        The other documents are deleted by documentId, see _delete_by_document_ids."""
+        if self._pk_index is None:
+            return self._delete_by_document_ids(handle, document_ids)
+        collection_name = handle.collection.name
+        deleted = 0
+        unknown = document_ids
+        if self._track_primary_keys(handle):
+            primary_keys = self._pk_index.primary_keys(collection_name, document_ids)
+            deleted = self._delete_primary_keys(handle, [pk for pks in primary_keys.values() for pk in pks])
+            # Written by a process not sharing MILVUS_PK_INDEX_PATH, or never stored
+            unknown = [document_id for document_id in document_ids if document_id not in primary_keys]
+        if unknown:
+            deleted += self._delete_by_document_ids(handle, unknown)
+        self._pk_index.remove_documents(collection_name, document_ids)
+        return deleted
+
+    def _delete_by_document_ids(self, handle: CollectionHandle, document_ids: List[str]) -> int:
+        """Delete the chunks of documents in one expression, servers before Milvus 2.3 get the primary keys
+        queried first."""
+        if self._expression_deletes:
+            result = handle.collection.delete(f"documentId in {json.dumps(document_ids)}", timeout=MILVUS_TIMEOUT)
+            self._flush_scheduler.record(handle.collection.name, result.delete_count)
+            return result.delete_count
+        deleted = 0
+        while True:
+            # A query returns at most MILVUS_QUERY_MAX_ROWS rows, query again until none are left
+            stored_chunks = handle.collection.query(
+                f"documentId in {json.dumps(document_ids)}",
+                output_fields=["id"],
+                limit=MILVUS_QUERY_MAX_ROWS,
+                # The rows deleted by the previous round must not come back
+                consistency_level="Strong",
+                timeout=MILVUS_TIMEOUT,
+            )
+            deleted += self._delete_primary_keys(handle, [stored_chunk["id"] for stored_chunk in stored_chunks])
+            if len(stored_chunks) < MILVUS_QUERY_MAX_ROWS:
+                return deleted
+
+    def _delete_primary_keys(self, handle: CollectionHandle, ids: List[int]) -> int:
+        for start in range(0, len(ids), MILVUS_DELETE_BATCH_SIZE):
+            handle.collection.delete(f"id in {ids[start:start + MILVUS_DELETE_BATCH_SIZE]}", timeout=MILVUS_TIMEOUT)
+        self._flush_scheduler.record(handle.collection.name, len(ids))
+        return len(ids)
+
     def _create_index(self):
         # TODO: verify index/search params passed by os.environ
         self.index_params = MILVUS_INDEX_PARAMS or None
@@ -244,11 +551,23 @@ class MilvusDataStore(DataStore):
             # If no index on the collection, create one
             if len(self.col.indexes) == 0:
                 if self.index_params is not None:
-                    # Convert the string format to JSON format parameters passed by MILVUS_INDEX_PARAMS
-                    self.index_params = json.loads(self.index_params)
+                    # MILVUS_INDEX_PARAMS is already parsed, only convert a string format
+                    if isinstance(self.index_params, str):
+                        self.index_params = json.loads(self.index_params)
                     logger.info("Create Milvus index: {}".format(self.index_params))
                     # Create an index on the 'embedding' field with the index params found in init
                     self.col.create_index(EMBEDDING_FIELD, index_params=self.index_params)
+                elif MILVUS_AUTO_INDEX:
+                    try:
+                        # The index for the current size of the collection, rebuilt as it grows
+                        self.index_params = self._index_manager.create(self.col)
+                    # If create fails, most likely due to being Zilliz Cloud instance, create the default index
+                    except MilvusException:
+                        logger.info("Attempting creation of Milvus default index")
+                        i_p = {"metric_type": "IP", "index_type": "IVF_FLAT", "params": {"nlist": 2048}}
+                        self.col.create_index(EMBEDDING_FIELD, index_params=i_p)
+                        self.index_params = i_p
+                        logger.info("Creation of Milvus default index successful")
                 else:
                     # If no index param supplied, to first create an HNSW index for Milvus
                     try:
@@ -279,212 +598,314 @@ class MilvusDataStore(DataStore):
                         break
 
             self.col.load()
+            with self._collections_lock:
+                self._collections[(self.alias, self.col.name)] = CollectionHandle(self.col, self._schema_ver)
 
-            if self.search_params is None:
+            if self.search_params is None and not MILVUS_AUTO_INDEX:
                 # The default search params
                 self.search_params = {
                         "metric_type": "IP",
                         "param": {"nprobe": 1000},
                         "round_decimal": -1
                     }
-            logger.info("Milvus search parameters: {}".format(self.search_params))
+            logger.info("Milvus search parameters: {}".format(
+                self.search_params or "derived from the index of every collection"))
         except Exception as e:
             logger.error("Failed to create index, error: {}".format(e))
             
+    def _chunk_batches(self, rows: List[Tuple[str, DocumentChunk]]) -> Iterator[List[Tuple[str, DocumentChunk]]]:
+        """Split (document_id, chunk) rows into batches bounded by MILVUS_UPSERT_BATCH_SIZE rows
+        and approximately MILVUS_UPSERT_BATCH_BYTES of payload."""
+        batch: List[Tuple[str, DocumentChunk]] = []
+        batch_bytes = 0
+        for row in rows:
+            document_id, chunk = row
+            metadata = chunk.metadata or DocumentChunkMetadata()
+            row_bytes = OUTPUT_DIM * 4 + sum(
+                len((value or "").encode("utf-8"))
+                for value in (
+                    document_id,
+                    metadata.title,
+                    metadata.created_at,
+                    metadata.authors,
+                    metadata.abstract,
+                    metadata.keywords,
+                    metadata.category,
+                    chunk.text,
+                )
+            )
+            if batch and (len(batch) >= MILVUS_UPSERT_BATCH_SIZE or batch_bytes + row_bytes > MILVUS_UPSERT_BATCH_BYTES):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(row)
+            batch_bytes += row_bytes
+        if batch:
+            yield batch
+
+    def _chunk_columns(self, batch: List[Tuple[str, DocumentChunk]], schema_ver: str) -> List[List[Any]]:
+        """Build the column arrays of a schema version (without the auto id) for a batch of rows."""
+        metadatas = [chunk.metadata or DocumentChunkMetadata() for _, chunk in batch]
+        columns = [
+            [document_id for document_id, _ in batch],
+            [metadata.title or "Unknown" for metadata in metadatas],
+            [metadata.created_at or "Unknown" for metadata in metadatas],
+            [metadata.authors or "Unknown" for metadata in metadatas],
+            [metadata.abstract or "Unknown" for metadata in metadatas],
+            [metadata.keywords or "Unknown" for metadata in metadatas],
+            [metadata.category or "Unknown" for metadata in metadatas],
+            [chunk.text for _, chunk in batch],
+            # One float32 matrix, pymilvus converts it in a single pass
+            np.stack([chunk.embedding for _, chunk in batch]).astype(np.float32, copy=False),
+        ]
+        if schema_ver == "V4":
+            columns += [
+                [chunk.chunk_hash or generate_chunk_hash(chunk.text) for _, chunk in batch],
+                [chunk.chunk_index or 0 for _, chunk in batch],
+            ]
+        return columns
+
+    async def _insert_rows(
+        self, destination: Tuple[str, Optional[str]], rows: List[Tuple[str, DocumentChunk]]
+    ) -> List[Optional[bool]]:
+        """Insert (document_id, chunk) rows into a (collection, partition), one columnar insert per batch.
+
+        Returns:
+            List[Optional[bool]]: Whether each row was inserted, None for the rows of a batch that was
+                                  rejected without being applied (see WriteBuffer).
+        """
+        collection_name, partition_name = destination
+        inserted: List[Optional[bool]] = [False] * len(rows)
+        start = 0
+        for batch in self._chunk_batches(rows):
+            offset = start
+            start += len(batch)
+            try:
+                insert_result = await self._run(
+                    collection_name,
+                    lambda handle: self._insert(
+                        handle, self._chunk_columns(batch, handle.schema_ver), partition_name
+                    ),
+                    idempotent=False,
+                )
+            except Exception as e:
+                logger.error("Failed to insert {} records into '{}/{}', error: {}"
+                             .format(len(batch), collection_name, partition_name, e))
+                if _rejected(e):
+                    inserted[offset:start] = [None] * len(batch)
+                continue
+
+            # Attribute the inserted rows back to their position
+            succ_index = list(getattr(insert_result, "succ_index", None) or [])
+            if not succ_index and insert_result and insert_result.insert_count == len(batch):
+                succ_index = range(len(batch))
+            for i in succ_index:
+                inserted[offset + i] = True
+            if len(succ_index) < len(batch):
+                logger.error("Only {} of {} records inserted into '{}/{}'"
+                             .format(len(succ_index), len(batch), collection_name, partition_name))
+        return inserted
+
     async def _upsert(self, document_chunks: Dict[str, List[DocumentChunk]]) -> Dict[str, Dict[str, str]]:
+        """Insert the chunks grouped by (collection, partition) through the write buffer, which
+        inserts them together with the chunks of concurrent upserts to the same destination.
+
+        Returns:
+            Dict[str, Dict[str, str]]: The number of inserted chunks for every document id.
+        """
         try:
-            
             # The doc id's to return for the upsert
-            document_ids_count: Dict[str, Dict[str, str]] = {}
-            
+            insert_counts: Dict[str, int] = {document_id: 0 for document_id in document_chunks}
 
-            # Prepare data for insertion
+            # Group the rows by their destination
+            groups: Dict[Tuple[str, Optional[str]], List[Tuple[str, DocumentChunk]]] = {}
             for document_id, chunk_list in document_chunks.items():
-                insert_count = 0
                 for chunk in chunk_list:
-                    documentId_value = document_id
-                    title_value = chunk.metadata.title or "Unknown"
-                    date_value = chunk.metadata.created_at or "Unknown"
-                    author_value = chunk.metadata.authors or "Unknown"
-                    abstract_value = chunk.metadata.abstract or "Unknown"
-                    keywords_value = chunk.metadata.keywords or "Unknown"
-                    category_value = chunk.metadata.category or "Unknown"
-                    embeddingElement = chunk.text
-                    content_vector_element = chunk.embedding
-
-
-                    doc = [
-                        [documentId_value],
-                        [title_value],
-                        [date_value],
-                        [author_value],
-                        [abstract_value],
-                        [keywords_value],
-                        [category_value],
-                        [embeddingElement],
-                        [content_vector_element]
-                    ]
-                    
-                    # Update the collection context
-                    self._update_collection(chunk.collection or MILVUS_COLLECTION)
-
-                    # Insert the data directly
-                    insert_result = self.col.insert(data=doc, partition_name=chunk.partition)
-                    insert_count += 1
-
-                    if not insert_result:
-                        logger.error(f"Failed to insert document with title: {title_value} and content: {embeddingElement}")
-                    else:
-                        self.col.flush()  # Flush the data to ensure it's persisted
-                # Append the doc_id to the list we are returning
-                document_ids_count[document_id] = {"count": str(insert_count)}
-
-            return document_ids_count
+                    key = (chunk.collection or MILVUS_COLLECTION, chunk.partition)
+                    groups.setdefault(key, []).append((document_id, chunk))
+
+            inserted = await asyncio.gather(*[self._write_buffer.write(key, rows) for key, rows in groups.items()])
+
+            inserted_collections = set()
+            for ((collection_name, _), rows), row_inserted in zip(groups.items(), inserted):
+                # Attribute the inserted rows back to their documents
+                for (document_id, _), ok in zip(rows, row_inserted):
+                    if ok:
+                        insert_counts[document_id] += 1
+                        inserted_collections.add(collection_name)
+
+            if MILVUS_FLUSH_ON_UPSERT:
+                # Flush at most once per collection to ensure the data is persisted
+                await self._flush_collections(list(inserted_collections))
+
+            return {document_id: {"count": str(count)} for document_id, count in insert_counts.items()}
         except Exception as e:
             logger.error("Failed to insert records, error: {}".format(e))
             return []
 
 
+    def _search_params(self, handle: CollectionHandle, limit: int, precision: SearchPrecision) -> Dict[str, Any]:
+        """The search params matching the index of the collection, or MILVUS_SEARCH_PARAMS, at the precision."""
+        if self.search_params:
+            return self._index_manager.scale_search_params(self.search_params, limit, precision)
+        return self._index_manager.search_params(
+            self._index_manager.index_params(handle.collection), limit, precision
+        )
+
+    def _search_group(
+        self, query: QueryWithEmbedding
+    ) -> Tuple[str, Optional[Tuple[str, ...]], Optional[str], int, SearchPrecision]:
+        """The (collection, partitions, filter expression, limit, precision) a query is searched with."""
+        # Set the filter to expression that is valid for Milvus
+        # Given the query object, extract the filter
+        filter_object = query.filter  # This will extract the filter from the query
+
+        # Initialize an empty list to store individual filter expressions
+        expressions = []
+
+        # Check if document_id is set and add its expression
+        document_id = getattr(filter_object, "document_id", None)
+        if document_id:
+            expressions.append(f"documentId == '{document_id}'")
+
+        # Check if authors is set and add its expression
+        # Here, assuming authors is a single string. If it's a list, the logic would be different.
+        authors = getattr(filter_object, "authors", None)
+        if authors:
+            expressions.append(f"authors == '{authors}'")
+
+        # Combine individual expressions with "AND" operator to get the final filter expression
+        # If no filter fields are set, set filter_expr to None
+        filter_expr = " AND ".join(expressions) if expressions else None
+
+        collection_name = query.collection or MILVUS_COLLECTION
+
+        # set partition
+        partition_names = None
+
+        #  partition name
+        partition_name = query.partition or MILVUS_COLLECTION_PARTITION
+        if partition_name:
+            partition_names = (partition_name,)
+
+        # The precision tunes how much of the index is searched, not how many hits are fetched
+        precision = query.searchprecision or SearchPrecision.high
+
+        return collection_name, partition_names, filter_expr, query.top_k, precision
+
+    def _query_result(self, query: QueryWithEmbedding, collection_name: str, hits: Any) -> QueryResult:
+        """Build the QueryResult of a query from its search hits."""
+        # Sort the hits by score
+        sorted_results = sorted(hits, key=lambda x: x.score, reverse=True)
+
+        results = []
+        # Parse every result from the sorted results
+        for hit in sorted_results:
+            # Extracting document details
+            doc_id = hit.id
+            score = hit.score
+            entity = hit.entity
+
+            # Creating metadata dictionary
+            metadata = {
+                "created_at": entity.date,
+                "authors": entity.authors,
+                "title": entity.title,
+                "abstract": entity.abstract,
+                "keywords": entity.keywords,
+                "category": entity.category,
+                "document_id": entity.documentId
+            }
+
+            chunk = DocumentChunkWithScore(
+                id=doc_id,
+                text=entity.content,
+                collection=collection_name,
+                partition=query.partition or None,
+                metadata=DocumentChunkMetadata(**metadata),
+                score=score,
+            )
+
+            results.append(chunk)
+
+        return QueryResult(query=query.query, results=results)
+
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
     ) -> List[QueryResult]:
         """Query the QueryWithEmbedding against the MilvusDocumentSearch
 
-        Search the embedding and its filter in the collection.
+        The queries searching the same collection, partitions and filter with the same limit and
+        precision are searched together, one multi-vector search per MILVUS_SEARCH_BATCH_HITS requested hits,
+        and the hits of every vector are handed back to its query.
 
         Args:
             queries (List[QueryWithEmbedding]): The list of searches to perform.
 
         Returns:
-            List[QueryResult]: Results for each search.
+            List[QueryResult]: Results for each search, in the order of queries.
         """
-        # Async to perform the query, adapted from pinecone implementation
-        async def _single_query(query: QueryWithEmbedding) -> QueryResult:
+        # Indices of the queries by search group
+        groups: Dict[Tuple[str, Optional[Tuple[str, ...]], Optional[str], int, SearchPrecision], List[int]] = {}
+        for i, query in enumerate(queries):
+            groups.setdefault(self._search_group(query), []).append(i)
+
+        results: List[QueryResult] = [QueryResult(query=query.query, results=[]) for query in queries]
+
+        async def _search(
+            collection_name: str,
+            partition_names: Optional[Tuple[str, ...]],
+            filter_expr: Optional[str],
+            limit_value: int,
+            precision: SearchPrecision,
+            batch: List[int],
+        ) -> None:
             try:
-                # Initialize default search parameters if not set
-                if not self.search_params:
-                    self.search_params = {
-                        "metric_type": "IP",
-                        "param": {"nprobe": 1000},
-                        "round_decimal": -1
-                    }
-
-                
-                # Set the filter to expression that is valid for Milvus
-                # Given the query object, extract the filter
-                filter_object = query.filter  # This will extract the filter from the query
-
-                # Initialize an empty list to store individual filter expressions
-                expressions = []
-
-                # Check if document_id is set and add its expression
-                document_id = getattr(filter_object, "document_id", None)
-                if document_id:
-                    expressions.append(f"documentId == '{document_id}'")
-
-                # Check if authors is set and add its expression
-                # Here, assuming authors is a single string. If it's a list, the logic would be different.
-                authors = getattr(filter_object, "authors", None)
-                if authors:
-                    expressions.append(f"authors == '{authors}'")
-
-                # Combine individual expressions with "AND" operator to get the final filter expression
-                filter_expr = " AND ".join(expressions)
-
-                # If no filter fields are set, set filter_expr to None
-                filter_expr = filter_expr if expressions else None
-
-                # Update the collection context
-                collection_name = query.collection or MILVUS_COLLECTION
-                self._update_collection(collection_name)
-                
-                # set partition
-                partition_names = None
-
-                #  partition name
-                partition_name = query.partition or MILVUS_COLLECTION_PARTITION
-                if partition_name:
-                    partition_names = [partition_name]
-
-                
-                #new functionality to have frexible search
-                if query.searchprecision == SearchPrecision.low:
-                    limit_value = query.top_k * 20
-                elif query.searchprecision == SearchPrecision.medium:
-                    limit_value = query.top_k * 10
-                else:
-                    limit_value = query.top_k
-                    
-                
-                # Perform our search
-                res = self.col.search(
-                    [query.embedding],  # Embedding from QueryWithEmbedding
-                    "content_vector",
-                    param=self.search_params,
-                    output_fields=["documentId", "title", "date", "authors", "abstract", "keywords", "category", "content"],
-                    limit=limit_value,  
-                    expr=filter_expr,  # Milvus filter expression
-                    partition_names=partition_names
+                # Perform our search, one row of the float32 matrix per query
+                res = await self._run(
+                    collection_name,
+                    lambda handle: handle.collection.search(
+                        np.stack([queries[i].embedding for i in batch]),
+                        EMBEDDING_FIELD,
+                        param=self._search_params(handle, limit_value, precision),
+                        output_fields=["documentId", "title", "date", "authors", "abstract", "keywords", "category", "content"],
+                        limit=limit_value,
+                        expr=filter_expr,  # Milvus filter expression
+                        partition_names=list(partition_names) if partition_names else None,
+                        timeout=MILVUS_TIMEOUT,
+                    ),
                 )
-
-
-                if not res:
-                    return QueryResult(query=query.query, results=[])
-
-
-                
-                # Directly use res[0] for the results
-                sorted_results = sorted(res[0], key=lambda x: x.score, reverse=True)
-
-                results = []
-                # Parse every result from the sorted results
-                for hit in sorted_results:
-                    # Extracting document details
-                    doc_id = hit.id
-                    score = hit.score
-                    entity = hit.entity
-                    
-                    title = entity.title
-                    date = entity.date
-                    authors = entity.authors
-                    abstract = entity.abstract
-                    keywords = entity.keywords
-                    category = entity.category
-                    contents = entity.content
-                    documentId = entity.documentId
-                    
-                    # Creating metadata dictionary
-                    metadata = {
-                        "created_at": date,
-                        "authors": authors,
-                        "title": title,
-                        "abstract": abstract,
-                        "keywords": keywords,
-                        "category": category,
-                        "document_id": documentId
-                    }
-
-                    chunk = DocumentChunkWithScore(
-                        id=doc_id,
-                        text=contents,
-                        collection=collection_name,
-                        partition=query.partition or None,
-                        metadata=DocumentChunkMetadata(**metadata),
-                        score=score,
-                    )
-
-                    results.append(chunk)
-
-                return QueryResult(query=query.query, results=results)
-
             except Exception as e:
-                logger.error("Failed to query, error: {}".format(e))
-                return QueryResult(query=query.query, results=[])
+                logger.error("Failed to query {} vectors in '{}', error: {}".format(len(batch), collection_name, e))
+                return
+
+            if not res:
+                return
+
+            # The hits of the j-th vector belong to the j-th query of the batch
+            for j, i in enumerate(batch):
+                try:
+                    results[i] = self._query_result(queries[i], collection_name, res[j])
+                except Exception as e:
+                    logger.error("Failed to query, error: {}".format(e))
+
+        searches = []
+        for (collection_name, partition_names, filter_expr, limit_value, precision), indices in groups.items():
+            # Bound the hits of one search, and so the size of its response
+            vectors_per_search = max(1, MILVUS_SEARCH_BATCH_HITS // max(limit_value, 1))
+            for start in range(0, len(indices), vectors_per_search):
+                searches.append(_search(
+                    collection_name,
+                    partition_names,
+                    filter_expr,
+                    limit_value,
+                    precision,
+                    indices[start:start + vectors_per_search],
+                ))
+        # The searches run concurrently in the Milvus executor
+        await asyncio.gather(*searches)
 
-        results: List[QueryResult] = await asyncio.gather(
-            *[_single_query(query) for query in queries]
-        )
         return results
 
     async def _delete(
@@ -493,43 +914,92 @@ class MilvusDataStore(DataStore):
     ) -> bool:
         """Delete the entities based on documentId.
 
+        The documents are deleted per collection, MILVUS_DELETE_BATCH_SIZE documents per delete
+        expression, without querying their chunks first.
+
         Args:
             documentIds List[str]: The DocumentDelete with documentIds to delete and collection. 
         """
 
         delete_count = 0  # Count of total deleted records (chunks)
+        deleted_collections = set()
+
+        # The document ids to delete by collection
+        groups: Dict[str, List[str]] = {}
+        for doc in documents_delete:
+            groups.setdefault(doc.collection or MILVUS_COLLECTION, []).append(doc.document_id)
+
         try:
-            for doc in documents_delete:
-                # Update the collection context
-                self._update_collection(doc.collection or MILVUS_COLLECTION)
-                    
-                # Step 1: Search for the documentId to get the primary key (id)
-                search_results = self.col.query(f"documentId == '{doc.document_id}'")
-
-                # Step 2: Extract the primary keys from the search results
-                primary_keys_to_delete = [result['id'] for result in search_results]
-
-                # Check if there are primary keys to delete
-                if primary_keys_to_delete:
-                    # Step 3: Delete the entities using the primary keys
-                    delete_expr = f"id in {primary_keys_to_delete}"
-                    self.col.delete(delete_expr)
-                    delete_count += len(primary_keys_to_delete)
+            for collection_name, document_ids in groups.items():
+                document_ids = list(dict.fromkeys(document_ids))
+                for start in range(0, len(document_ids), MILVUS_DELETE_BATCH_SIZE):
+                    batch = document_ids[start:start + MILVUS_DELETE_BATCH_SIZE]
+                    count = await self._run(collection_name, lambda handle: self._delete_documents(handle, batch))
+                    if count > 0:
+                        delete_count += count
+                        deleted_collections.add(collection_name)
 
         except Exception as e:
-            #logger.error("Failed to delete by ids, error: {}".format(e))
+            logger.error("Failed to delete documents, error: {}".format(e))
             return False  # Indicate that the delete operation failed
 
         logger.info("{:d} records deleted".format(delete_count))
 
         if delete_count > 0:
-            # This setting performs flushes after delete. Small delete == bad to use
-            self.col.flush()
+            if MILVUS_FLUSH_ON_DELETE:
+                # Small deletes make small segments, off by default
+                await self._flush_collections(list(deleted_collections))
             return True  # Indicate that the delete operation succeeded
         else:
             #logger.error("Failed to delete by ids")
             return False
 
+    async def _get_chunk_hashes(
+        self,
+        document_id: str,
+        collection_name: Optional[str],
+        partition_name: str,
+        metadata: DocumentChunkMetadata,
+    ) -> Optional[Dict[str, List[int]]]:
+        """The primary keys of the stored chunks of a document by chunk hash, None for V3 collections."""
+        stored_chunks = await self._run(
+            collection_name,
+            lambda handle: None if handle.schema_ver != "V4" else handle.collection.query(
+                f"documentId == '{document_id}'",
+                output_fields=["id", "chunkHash", "title", "authors", "date"],
+                partition_names=[partition_name],
+                # Chunks inserted by a previous upsert of the document must be seen
+                consistency_level="Strong",
+                timeout=MILVUS_TIMEOUT,
+            ),
+        )
+        if stored_chunks is None:
+            return None
+        chunk_hashes: Dict[str, List[int]] = {}
+        for stored_chunk in stored_chunks:
+            # Chunks of another document with the same id are neither kept nor deleted
+            if (stored_chunk["title"], stored_chunk["authors"], stored_chunk["date"]) != (
+                metadata.title, metadata.authors, metadata.created_at
+            ):
+                continue
+            chunk_hashes.setdefault(stored_chunk["chunkHash"], []).append(stored_chunk["id"])
+        return chunk_hashes
+
+    async def _delete_chunks(
+        self,
+        collection_name: Optional[str],
+        ids: List[int]
+    ) -> int:
+        """Delete chunks by primary key, without flushing."""
+        def delete(handle: CollectionHandle) -> None:
+            handle.collection.delete(f"id in {ids}", timeout=MILVUS_TIMEOUT)
+            self._flush_scheduler.record(handle.collection.name, len(ids))
+            if self._pk_index is not None:
+                self._pk_index.remove_keys(handle.collection.name, ids)
+
+        await self._run(collection_name, delete)
+        return len(ids)
+
     async def _raw_upsert(
         self,
         document: List[List[Any]],
@@ -539,9 +1009,15 @@ class MilvusDataStore(DataStore):
         """
         Insert data
         """
-        # Update the collection context
-        self._update_collection(collection_name or MILVUS_COLLECTION)
-        result = self.col.insert(data=document, partition_name=partition_name)
+        def insert(handle: CollectionHandle) -> Any:
+            data = document
+            if handle.schema_ver == "V4" and len(data) == len(SCHEMA_V3) - 1:
+                # SCHEMA_V3 columns, add the chunk hashes and indexes
+                contents = data[7]  # The content column
+                data = list(data) + [[generate_chunk_hash(content) for content in contents], list(range(len(contents)))]
+            return self._insert(handle, data, partition_name)
+
+        result = await self._run(collection_name, insert, idempotent=False)
         return result
 
 
@@ -549,7 +1025,19 @@ class MilvusDataStore(DataStore):
             self
         ) -> Any:  
         """
-        Flush
+        Flush every collection with rows written since its last flush
+        """
+        await self._flush_collections()
+        return True
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        The datastore metrics, the Milvus connection pool, flush and write buffer metrics
         """
-        self.col.flush()
-        return True 
\ No newline at end of file
+        return {
+            **super().metrics(),
+            "milvus_pool": self._pool.stats(),
+            "milvus_flush": self._flush_scheduler.stats(),
+            "milvus_write_buffer": self._write_buffer.stats(),
+            "milvus_index": self._index_manager.stats(),
+        }
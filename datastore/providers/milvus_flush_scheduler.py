@@ -0,0 +1,145 @@
+"""
+Deferred flushes of Milvus collections.
+
+A flush seals the growing segments of a collection: flushing after every write blocks
+the writer and leaves many small segments, which slow searches down. The scheduler
+counts the rows written (inserted or deleted) to every collection since its last flush
+and flushes it in a background thread once MILVUS_FLUSH_ROWS rows are pending or the
+oldest of them is MILVUS_FLUSH_INTERVAL seconds old. flush() flushes the pending
+collections right away, e.g. before a checkpoint. Milvus keeps unflushed rows, they are
+searchable and not lost, a flush only makes them durable in sealed segments sooner.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from loguru import logger
+
+
+MILVUS_FLUSH_ROWS = int(os.environ.get("MILVUS_FLUSH_ROWS") or 50000)  # 0 disables the row threshold
+MILVUS_FLUSH_INTERVAL = float(os.environ.get("MILVUS_FLUSH_INTERVAL") or 300)  # Seconds, 0 disables the age threshold
+
+
+class FlushScheduler:
+    def __init__(
+        self,
+        flush: Callable[[str], None],
+        max_rows: int = MILVUS_FLUSH_ROWS,
+        max_age: float = MILVUS_FLUSH_INTERVAL,
+    ):
+        """Create a flush scheduler.
+
+        Args:
+            flush (Callable[[str], None]): Flushes a collection by name, blocking until it is done.
+            max_rows (int, optional): Pending rows that trigger the flush of a collection.
+                                      Defaults to MILVUS_FLUSH_ROWS.
+            max_age (float, optional): Age in seconds of the oldest pending row that triggers the flush of
+                                       a collection. Defaults to MILVUS_FLUSH_INTERVAL.
+        """
+        self._flush = flush
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Pending rows and the time of the first of them, by collection
+        self._pending_rows: Dict[str, int] = {}
+        self._pending_since: Dict[str, float] = {}
+        # One flush of a collection at a time
+        self._collection_locks: Dict[str, threading.Lock] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Metrics
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.errors = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def record(self, collection: str, rows: int) -> None:
+        """Count rows written to collection, without flushing it."""
+        if rows <= 0:
+            return
+        with self._lock:
+            self._pending_rows[collection] = self._pending_rows.get(collection, 0) + rows
+            # The first pending rows set a new deadline
+            due = collection not in self._pending_since
+            self._pending_since.setdefault(collection, time.monotonic())
+            due = due or (self.max_rows > 0 and self._pending_rows[collection] >= self.max_rows)
+            if self._thread is None and (self.max_rows > 0 or self.max_age > 0):
+                self._thread = threading.Thread(target=self._run, name="milvus-flush", daemon=True)
+                self._thread.start()
+        if due:
+            self._wake.set()
+
+    def flush(self, collections: Optional[Sequence[str]] = None) -> List[str]:
+        """Flush the pending collections (or the given ones among them) now, return the flushed ones."""
+        with self._lock:
+            names = list(self._pending_rows) if collections is None else [
+                collection for collection in collections if collection in self._pending_rows
+            ]
+        return [collection for collection in names if self._flush_collection(collection)]
+
+    def _due(self) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                collection for collection, rows in self._pending_rows.items()
+                if (self.max_rows > 0 and rows >= self.max_rows)
+                or (self.max_age > 0 and now - self._pending_since[collection] >= self.max_age)
+            ]
+
+    def _next_deadline(self) -> Optional[float]:
+        """Seconds until the oldest pending rows are due, None if no age threshold applies."""
+        with self._lock:
+            if self.max_age <= 0 or not self._pending_since:
+                return None
+            return max(0.0, min(self._pending_since.values()) + self.max_age - time.monotonic())
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(timeout=self._next_deadline() if self.max_age > 0 else None)
+            self._wake.clear()
+            for collection in self._due():
+                self._flush_collection(collection)
+
+    def _flush_collection(self, collection: str) -> bool:
+        with self._lock:
+            collection_lock = self._collection_locks.setdefault(collection, threading.Lock())
+        # A flush already running for the collection covers the rows it took, wait for it
+        with collection_lock:
+            with self._lock:
+                rows = self._pending_rows.pop(collection, 0)
+                self._pending_since.pop(collection, None)
+            if not rows:
+                return False
+            started = time.perf_counter()
+            try:
+                self._flush(collection)
+            except Exception as e:
+                logger.error("Failed to flush collection '{}', error: {}".format(collection, e))
+                with self._lock:
+                    # Retried one interval later, or with the next rows
+                    self._pending_rows[collection] = self._pending_rows.get(collection, 0) + rows
+                    self._pending_since[collection] = time.monotonic()
+                    self.errors += 1
+                return False
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.flushes += 1
+                self.rows_flushed += rows
+                self.flush_seconds += seconds
+                self.max_flush_seconds = max(self.max_flush_seconds, seconds)
+            logger.info("Flushed {} rows of collection '{}' in {:.2f}s".format(rows, collection, seconds))
+            return True
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+                "pending_rows": sum(self._pending_rows.values()),
+                "errors": self.errors,
+                "mean_flush_seconds": self.flush_seconds / self.flushes if self.flushes else 0.0,
+                "max_flush_seconds": self.max_flush_seconds,
+            }
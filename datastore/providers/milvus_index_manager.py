@@ -0,0 +1,372 @@
+"""
+Vector index selection and tuning by collection size.
+
+The index of a collection is chosen from its row count, never counted below
+MILVUS_INDEX_EXPECTED_ROWS, and MILVUS_INDEX_MEMORY_BUDGET:
+
+- FLAT (exact search) up to MILVUS_FLAT_MAX_ROWS rows, where scanning is as fast as probing;
+- HNSW while its graph and vectors fit in the memory budget, the fastest at high recall;
+- IVF_FLAT, with nlist ~ 4 * sqrt(rows), while the raw vectors fit;
+- IVF_SQ8 (vectors quantized to one byte per dimension) beyond that.
+
+A new collection is empty: it is indexed for the corpus it is expected to hold (HNSW for the
+default million rows), so that searches stay fast as it fills up even when rebuilds are off.
+
+check() compares the index of a collection with the one chosen for its current size and
+rebuilds it when the index type changes or the ideal nlist moved by MILVUS_NLIST_REBUILD_RATIO
+or more. A collection only changes index type once it is MILVUS_INDEX_HYSTERESIS past the
+threshold, so a collection hovering around one does not flip between types.
+
+Milvus keeps one index per vector field and cannot search a collection while that index is
+dropped and built again, so a rebuild is a pause of the collection, not a background job.
+Every process of the datastore shares file locks per collection in MILVUS_INDEX_LOCK_DIR:
+
+- an operation holds the collection's gate lock shared (operation());
+- a rebuild first takes the collection's rebuild lock, so that one process at a time
+  rebuilds, then holds the turnstile lock, which holds back the operations starting
+  anew, and takes the gate lock exclusively once the running operations are done
+  (exclusive()). It releases both once the collection is loaded again.
+
+Operations therefore wait for a rebuild, in any process sharing the lock directory, instead
+of failing or loading the collection in the middle of the build. Processes on other hosts do
+not share the locks: rebuilds are off unless MILVUS_INDEX_CHECK_INTERVAL is set (checking the
+collections every so many seconds in a background thread), and are only safe to enable where
+every process of the datastore shares MILVUS_INDEX_LOCK_DIR. A rebuild touches a marker file
+that the other processes compare to re-read the index they derive search parameters from.
+
+The manager records the chosen configurations and derives the search parameters from the
+index, probing fewer IVF clusters (or a shorter HNSW candidate list) for lower search precisions.
+"""
+
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from loguru import logger
+from pymilvus import Collection
+
+from models.models import SearchPrecision
+
+
+MILVUS_AUTO_INDEX = (os.environ.get("MILVUS_AUTO_INDEX") or "true").lower() == "true"
+MILVUS_INDEX_MEMORY_BUDGET = int(os.environ.get("MILVUS_INDEX_MEMORY_BUDGET") or 4 * 1024 ** 3)  # Bytes per collection
+MILVUS_FLAT_MAX_ROWS = int(os.environ.get("MILVUS_FLAT_MAX_ROWS") or 20000)
+MILVUS_INDEX_EXPECTED_ROWS = int(os.environ.get("MILVUS_INDEX_EXPECTED_ROWS") or 1000000)  # Smallest row count indexed for
+MILVUS_NLIST_REBUILD_RATIO = float(os.environ.get("MILVUS_NLIST_REBUILD_RATIO") or 4)
+MILVUS_INDEX_HYSTERESIS = float(os.environ.get("MILVUS_INDEX_HYSTERESIS") or 0.2)
+MILVUS_INDEX_CHECK_INTERVAL = float(os.environ.get("MILVUS_INDEX_CHECK_INTERVAL") or 0)  # Seconds, 0 disables rebuilds
+MILVUS_INDEX_LOCK_DIR = os.environ.get("MILVUS_INDEX_LOCK_DIR") or "./data/milvus-index"
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+# Neighbour lists of all HNSW layers, about 2 * M links of 4 bytes per vector, plus overhead
+HNSW_BYTES_PER_LINK = 8
+# From the smallest to the largest collections
+INDEX_TYPES = ("FLAT", "HNSW", "IVF_FLAT", "IVF_SQ8")
+
+# Search tiers by precision: the share of the IVF clusters probed (1 / divisor), the smallest HNSW ef
+NPROBE_DIVISORS = {SearchPrecision.high: 16, SearchPrecision.medium: 32, SearchPrecision.low: 64}
+MIN_EF = {SearchPrecision.high: 64, SearchPrecision.medium: 32, SearchPrecision.low: 16}
+
+
+def _nlist(rows: int) -> int:
+    """About 4 * sqrt(rows) clusters, as a power of two between 64 and 65536."""
+    return int(min(65536, max(64, 2 ** round(math.log2(4 * math.sqrt(max(rows, 1)))))))
+
+
+class IndexManager:
+    def __init__(
+        self,
+        field: str,
+        dim: int,
+        metric_type: str = "IP",
+        memory_budget: int = MILVUS_INDEX_MEMORY_BUDGET,
+        flat_max_rows: int = MILVUS_FLAT_MAX_ROWS,
+        expected_rows: int = MILVUS_INDEX_EXPECTED_ROWS,
+        nlist_rebuild_ratio: float = MILVUS_NLIST_REBUILD_RATIO,
+        hysteresis: float = MILVUS_INDEX_HYSTERESIS,
+        timeout: Optional[float] = None,
+        lock_dir: str = MILVUS_INDEX_LOCK_DIR,
+    ):
+        """Create an index manager.
+
+        Args:
+            field (str): The vector field.
+            dim (int): The dimension of its vectors.
+            metric_type (str, optional): The metric of the indexes. Defaults to "IP".
+            memory_budget (int, optional): Bytes the index of one collection may take.
+                                           Defaults to MILVUS_INDEX_MEMORY_BUDGET.
+            flat_max_rows (int, optional): Largest collection searched exactly. Defaults to MILVUS_FLAT_MAX_ROWS.
+            expected_rows (int, optional): Rows the collections are indexed for at least, whatever they hold.
+                                           Defaults to MILVUS_INDEX_EXPECTED_ROWS.
+            nlist_rebuild_ratio (float, optional): Change of the ideal nlist that rebuilds an IVF index.
+                                                   Defaults to MILVUS_NLIST_REBUILD_RATIO.
+            hysteresis (float, optional): Share of a threshold the row count must pass it by to change
+                                          the index type. Defaults to MILVUS_INDEX_HYSTERESIS.
+            timeout (Optional[float], optional): Timeout of index builds and loads in seconds.
+            lock_dir (str, optional): Directory of the locks shared by the processes, see operation.
+                                      Defaults to MILVUS_INDEX_LOCK_DIR.
+        """
+        self.field = field
+        self.dim = dim
+        self.metric_type = metric_type
+        self.memory_budget = memory_budget
+        self.flat_max_rows = flat_max_rows
+        self.expected_rows = expected_rows
+        self.nlist_rebuild_ratio = nlist_rebuild_ratio
+        self.hysteresis = hysteresis
+        self.timeout = timeout
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        # The gate and turnstile lock files of every thread, and how deep it is in operations
+        self._local = threading.local()
+        # The index params of every collection, with the rebuild marker they were read at,
+        # and the row count they were chosen for
+        self._indexes: Dict[str, Tuple[Dict[str, Any], int]] = {}
+        self._configs: Dict[str, Dict[str, Any]] = {}
+        self._thread: Optional[threading.Thread] = None
+        # Metrics
+        self.rebuilds = 0
+        self.rebuild_seconds = 0.0
+
+    def _index_type(self, rows: int) -> str:
+        vector_bytes = rows * self.dim * 4
+        if rows <= self.flat_max_rows:
+            return "FLAT"
+        elif vector_bytes + rows * 2 * HNSW_M * HNSW_BYTES_PER_LINK <= self.memory_budget:
+            return "HNSW"
+        elif vector_bytes <= self.memory_budget:
+            return "IVF_FLAT"
+        return "IVF_SQ8"
+
+    def choose(self, rows: int, current: Optional[str] = None) -> Dict[str, Any]:
+        """The index params for a collection of rows vectors, currently indexed with the current index type."""
+        rows = max(rows, self.expected_rows)
+        index_type = self._index_type(rows)
+        if current in INDEX_TYPES and index_type != current:
+            # Only leave the current type once the collection is past the threshold by the hysteresis
+            if INDEX_TYPES.index(index_type) > INDEX_TYPES.index(current):
+                if INDEX_TYPES.index(self._index_type(int(rows * (1 - self.hysteresis)))) <= INDEX_TYPES.index(current):
+                    index_type = current
+            elif INDEX_TYPES.index(self._index_type(int(rows * (1 + self.hysteresis)))) >= INDEX_TYPES.index(current):
+                index_type = current
+
+        if index_type == "HNSW":
+            params = {"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION}
+        elif index_type in ("IVF_FLAT", "IVF_SQ8"):
+            params = {"nlist": _nlist(rows)}
+        else:
+            params = {}
+        return {"metric_type": self.metric_type, "index_type": index_type, "params": params}
+
+    def needs_rebuild(self, current: Dict[str, Any], chosen: Dict[str, Any]) -> bool:
+        if current.get("index_type") != chosen["index_type"]:
+            return True
+        if "nlist" in chosen["params"]:
+            nlist = int(_params(current).get("nlist") or 0)
+            if nlist <= 0:
+                return True
+            ratio = chosen["params"]["nlist"] / nlist
+            return ratio >= self.nlist_rebuild_ratio or ratio <= 1 / self.nlist_rebuild_ratio
+        return False
+
+    def index_params(self, collection: Collection) -> Optional[Dict[str, Any]]:
+        """The params of the index of the vector field of collection, None if it has none.
+        Read again once another process rebuilt it."""
+        marker = self._rebuilt_at(collection.name)
+        with self._lock:
+            cached = self._indexes.get(collection.name)
+        if cached is not None and cached[1] == marker:
+            return cached[0]
+        for index in collection.indexes:
+            if index.field_name == self.field:
+                index_params = dict(index.params)
+                with self._lock:
+                    self._indexes[collection.name] = (index_params, marker)
+                return index_params
+        return None
+
+    def create(self, collection: Collection) -> Dict[str, Any]:
+        """Create the index chosen for the current (or expected) size of an unindexed collection."""
+        rows = collection.num_entities
+        chosen = self.choose(rows)
+        logger.info("Create Milvus index for {} rows of '{}': {}".format(rows, collection.name, chosen))
+        collection.create_index(self.field, index_params=chosen, timeout=self.timeout)
+        self._record(collection.name, chosen, rows)
+        return chosen
+
+    def check(self, collection: Collection) -> bool:
+        """Rebuild the index of collection if it does not suit its size anymore. Returns whether it was rebuilt."""
+        current = self.index_params(collection)
+        if current is None:
+            return False
+        rows = collection.num_entities
+        chosen = self.choose(rows, current.get("index_type"))
+        if not self.needs_rebuild(current, chosen):
+            return False
+
+        started = time.perf_counter()
+        with self.exclusive(collection.name) as acquired:
+            if not acquired:
+                # Another process is rebuilding it
+                return False
+            # It may have been rebuilt by another process in the meantime
+            current = self.index_params(collection)
+            if current is None or not self.needs_rebuild(current, self.choose(rows, current.get("index_type"))):
+                return False
+            logger.info("Rebuild the Milvus index of '{}' for {} rows: {} -> {}".format(collection.name, rows, current, chosen))
+            # The index of a loaded collection cannot be dropped, the operations wait until it is loaded again
+            collection.release(timeout=self.timeout)
+            try:
+                collection.drop_index(timeout=self.timeout)
+                # Returns once the index is built
+                collection.create_index(self.field, index_params=chosen, timeout=self.timeout)
+            finally:
+                collection.load(timeout=self.timeout)
+                self._mark_rebuilt(collection.name)
+        seconds = time.perf_counter() - started
+        self._record(collection.name, chosen, rows)
+        with self._lock:
+            self.rebuilds += 1
+            self.rebuild_seconds += seconds
+        logger.info("Rebuilt the Milvus index of '{}' in {:.1f}s".format(collection.name, seconds))
+        return True
+
+    def _lock_path(self, name: str, kind: str) -> str:
+        return os.path.join(self.lock_dir, "{}.{}".format(name, kind))
+
+    def _open_lock(self, name: str, kind: str) -> IO:
+        os.makedirs(self.lock_dir, exist_ok=True)
+        return open(self._lock_path(name, kind), "a")
+
+    def _thread_lock(self, name: str, kind: str) -> IO:
+        """The lock file of this thread: flock locks of different open files conflict, even in one process."""
+        files = self._local.__dict__.setdefault("files", {})
+        lock = files.get((name, kind))
+        if lock is None:
+            lock = files[(name, kind)] = self._open_lock(name, kind)
+        return lock
+
+    @contextmanager
+    def operation(self, name: str) -> Iterator[None]:
+        """Hold the gate of a collection while operating on it, waiting while its index is rebuilt by any process.
+        Blocks the calling thread, run it off the event loop."""
+        depth = self._local.__dict__.get("depth", 0)
+        if depth:
+            # Already inside an operation of this thread
+            yield
+            return
+        turnstile = self._thread_lock(name, "turnstile")
+        gate = self._thread_lock(name, "gate")
+        # Pass the turnstile, held by a rebuild waiting for the gate
+        fcntl.flock(turnstile, fcntl.LOCK_SH)
+        fcntl.flock(turnstile, fcntl.LOCK_UN)
+        fcntl.flock(gate, fcntl.LOCK_SH)
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            fcntl.flock(gate, fcntl.LOCK_UN)
+
+    @contextmanager
+    def exclusive(self, name: str) -> Iterator[bool]:
+        """Hold the operations on a collection back, in every process, and wait for the running ones to finish.
+        Yields False, without waiting, when another process is rebuilding the collection."""
+        with self._open_lock(name, "rebuild") as rebuild:
+            try:
+                fcntl.flock(rebuild, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            # Closing the files releases the locks
+            with self._open_lock(name, "turnstile") as turnstile, self._open_lock(name, "gate") as gate:
+                fcntl.flock(turnstile, fcntl.LOCK_EX)
+                fcntl.flock(gate, fcntl.LOCK_EX)
+                yield True
+
+    def _rebuilt_at(self, name: str) -> int:
+        try:
+            return os.stat(self._lock_path(name, "rebuilt")).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _mark_rebuilt(self, name: str) -> None:
+        self._open_lock(name, "rebuilt").close()
+        os.utime(self._lock_path(name, "rebuilt"))
+
+    def _record(self, name: str, index_params: Dict[str, Any], rows: int) -> None:
+        with self._lock:
+            self._indexes[name] = (index_params, self._rebuilt_at(name))
+            self._configs[name] = {"rows": rows, "index": index_params, "chosen_at": time.time()}
+
+    def search_params(
+        self, index_params: Optional[Dict[str, Any]], limit: int, precision: SearchPrecision = SearchPrecision.high
+    ) -> Dict[str, Any]:
+        """Search params matching an index and precision.
+
+        At high precision about 1/16 of the IVF clusters are probed and the HNSW ef is at least 64,
+        medium and low precision halve and quarter both. FLAT indexes are always searched exactly.
+        """
+        param: Dict[str, Any] = {}
+        index_type = (index_params or {}).get("index_type")
+        if index_type in ("IVF_FLAT", "IVF_SQ8", "IVF_PQ"):
+            param["nprobe"] = max(8, int(_params(index_params).get("nlist") or 1024) // NPROBE_DIVISORS[precision])
+        elif index_type == "HNSW":
+            # ef cannot be below the number of hits
+            param["ef"] = max(MIN_EF[precision], limit)
+        return {"metric_type": (index_params or {}).get("metric_type", self.metric_type), "param": param, "round_decimal": -1}
+
+    @staticmethod
+    def scale_search_params(
+        search_params: Dict[str, Any], limit: int, precision: SearchPrecision = SearchPrecision.high
+    ) -> Dict[str, Any]:
+        """Fixed search params (MILVUS_SEARCH_PARAMS) at a precision.
+
+        High precision searches with the configured nprobe and ef, medium and low precision
+        with half and a quarter of them, like the tiers of search_params.
+        """
+        param = dict(search_params.get("param") or {})
+        if "nprobe" in param:
+            param["nprobe"] = max(1, int(param["nprobe"]) * NPROBE_DIVISORS[SearchPrecision.high] // NPROBE_DIVISORS[precision])
+        if "ef" in param:
+            param["ef"] = max(limit, int(param["ef"]) * MIN_EF[precision] // MIN_EF[SearchPrecision.high])
+        return {**search_params, "param": param}
+
+    def start(self, collections: Callable[[], Iterable[Collection]], interval: float = MILVUS_INDEX_CHECK_INTERVAL) -> None:
+        """Check the collections returned by collections every interval seconds in a background thread."""
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                for collection in collections():
+                    try:
+                        self.check(collection)
+                    except Exception as e:
+                        logger.error("Failed to check the Milvus index of '{}', error: {}".format(collection.name, e))
+
+        self._thread = threading.Thread(target=run, name="milvus-index", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rebuilds": self.rebuilds,
+                "rebuild_seconds": self.rebuild_seconds,
+                "collections": {name: dict(config) for name, config in self._configs.items()},
+            }
+
+
+def _params(index_params: Dict[str, Any]) -> Dict[str, Any]:
+    """The index specific params, stored as a JSON string by some pymilvus versions."""
+    params = index_params.get("params") or {}
+    if isinstance(params, str):
+        params = json.loads(params)
+    return params
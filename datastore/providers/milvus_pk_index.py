@@ -0,0 +1,104 @@
+"""
+Local sidecar index of the Milvus primary keys of every document.
+
+The primary keys returned by every insert are recorded by (collection, document id), so
+a document can be deleted with an `id in [...]` expression without querying Milvus for
+its chunks first. A collection the index has not seen being filled is backfilled once
+with a query iterator over its (id, documentId) pairs before the index is trusted for it,
+as from Milvus 2.3. Documents without primary keys in the index are deleted by documentId.
+
+The index is off unless MILVUS_PK_INDEX_PATH is set.
+"""
+
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+MILVUS_PK_INDEX_PATH = os.environ.get("MILVUS_PK_INDEX_PATH")
+
+# Parameters bound per SQLite statement, below SQLITE_MAX_VARIABLE_NUMBER
+_SQL_BATCH = 500
+
+
+class PrimaryKeyIndex:
+    def __init__(self, path: str):
+        """Open (or create) a primary key index.
+
+        Args:
+            path (str): The SQLite database file.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS primary_keys (
+                    collection TEXT, document_id TEXT, pk INTEGER, PRIMARY KEY (collection, pk)
+                );
+                CREATE INDEX IF NOT EXISTS primary_keys_document ON primary_keys (collection, document_id);
+                CREATE TABLE IF NOT EXISTS tracked (collection TEXT PRIMARY KEY);
+                """
+            )
+
+    def add(self, collection: str, rows: Iterable[Tuple[str, int]]) -> None:
+        """Record the (document id, primary key) rows inserted into collection."""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO primary_keys VALUES (?, ?, ?)",
+                [(collection, document_id, pk) for document_id, pk in rows],
+            )
+
+    def primary_keys(self, collection: str, document_ids: Sequence[str]) -> Dict[str, List[int]]:
+        """The primary keys of the documents of collection, by document id."""
+        primary_keys: Dict[str, List[int]] = {}
+        with self._lock:
+            for start in range(0, len(document_ids), _SQL_BATCH):
+                batch = document_ids[start:start + _SQL_BATCH]
+                for document_id, pk in self._db.execute(
+                    f"SELECT document_id, pk FROM primary_keys WHERE collection = ? "
+                    f"AND document_id IN ({', '.join('?' * len(batch))})",
+                    [collection, *batch],
+                ):
+                    primary_keys.setdefault(document_id, []).append(pk)
+        return primary_keys
+
+    def remove_documents(self, collection: str, document_ids: Sequence[str]) -> None:
+        with self._lock, self._db:
+            for start in range(0, len(document_ids), _SQL_BATCH):
+                batch = document_ids[start:start + _SQL_BATCH]
+                self._db.execute(
+                    f"DELETE FROM primary_keys WHERE collection = ? AND document_id IN ({', '.join('?' * len(batch))})",
+                    [collection, *batch],
+                )
+
+    def remove_keys(self, collection: str, pks: Sequence[int]) -> None:
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM primary_keys WHERE collection = ? AND pk = ?", [(collection, pk) for pk in pks]
+            )
+
+    def is_tracked(self, collection: str) -> bool:
+        """Whether the index holds every primary key of collection."""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM tracked WHERE collection = ?", (collection,)).fetchone() is not None
+
+    def track(self, collection: str) -> None:
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO tracked VALUES (?)", (collection,))
+
+    def forget(self, collection: str) -> None:
+        """Drop the primary keys of a collection, e.g. dropped and created again."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM primary_keys WHERE collection = ?", (collection,))
+            self._db.execute("DELETE FROM tracked WHERE collection = ?", (collection,))
+
+
+def get_pk_index() -> Optional[PrimaryKeyIndex]:
+    """A primary key index at MILVUS_PK_INDEX_PATH, None unless it is set."""
+    if not MILVUS_PK_INDEX_PATH:
+        return None
+    return PrimaryKeyIndex(MILVUS_PK_INDEX_PATH)
@@ -0,0 +1,154 @@
+"""
+Cross-request coalescing of Milvus inserts.
+
+Chat memories arrive as many concurrent upserts of one or two chunks, each paying for
+its own insert RPC. The buffer holds the rows written to a (collection, partition) for
+up to MILVUS_WRITE_BUFFER_MAX_WAIT_MS (or until MILVUS_WRITE_BUFFER_ROWS rows are
+waiting), inserts them together and resolves every caller with the outcome of its own
+rows.
+
+A row that is rejected fails its whole insert batch, and so the rows of every write
+coalesced with it. The insert function reports the rows of a batch that was rejected
+without being applied (None instead of True/False); when several writes were coalesced,
+those rows are inserted again one write at a time, so that only the write carrying the
+rejected row fails, as it would have without the buffer. Rows whose batch may have been
+applied (e.g. a timeout) are never sent again.
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+
+MILVUS_WRITE_BUFFER_MAX_WAIT_MS = float(os.environ.get("MILVUS_WRITE_BUFFER_MAX_WAIT_MS") or 10)  # 0 disables buffering
+MILVUS_WRITE_BUFFER_ROWS = int(os.environ.get("MILVUS_WRITE_BUFFER_ROWS") or 1000)
+
+
+class WriteBuffer:
+    def __init__(
+        self,
+        insert: Callable[[Hashable, List[Any]], Awaitable[Sequence[Optional[bool]]]],
+        max_wait_ms: float = MILVUS_WRITE_BUFFER_MAX_WAIT_MS,
+        max_rows: int = MILVUS_WRITE_BUFFER_ROWS,
+    ):
+        """Create a write buffer.
+
+        Args:
+            insert: Coroutine function inserting the rows of a destination, returning whether each row was inserted,
+                    None for the rows of a batch rejected without being applied.
+            max_wait_ms (float, optional): How long the first rows of a destination wait for others.
+            max_rows (int, optional): Number of waiting rows of a destination that dispatches them right away.
+        """
+        self._insert = insert
+        self.max_wait = max_wait_ms / 1000
+        self.max_rows = max_rows
+        # (rows, future, enqueue time) of the writes waiting, by destination
+        self._pending: Dict[Hashable, List[Tuple[List[Any], asyncio.Future, float]]] = {}
+        self._pending_rows: Dict[Hashable, int] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        # Metrics
+        self.batches = 0
+        self.writes = 0
+        self.rows = 0
+        self.max_seen_batch_rows = 0
+        self.queue_delay = 0.0
+        self.retried_writes = 0
+
+    async def write(self, destination: Hashable, rows: List[Any]) -> List[bool]:
+        """Insert rows into destination together with the rows of concurrent callers."""
+        if not rows:
+            return []
+        if self.max_wait <= 0 or len(rows) >= self.max_rows:
+            # Nothing to gain from waiting
+            self._count(1, len(rows), 0.0)
+            return [bool(ok) for ok in await self._insert(destination, rows)]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(destination, []).append((rows, future, time.perf_counter()))
+        self._pending_rows[destination] = self._pending_rows.get(destination, 0) + len(rows)
+
+        if self._pending_rows[destination] >= self.max_rows:
+            self._dispatch(destination)
+        elif destination not in self._timers:
+            self._timers[destination] = loop.call_later(self.max_wait, self._dispatch, destination)
+
+        return await future
+
+    def _dispatch(self, destination: Hashable) -> None:
+        """Start inserting everything waiting for destination."""
+        timer = self._timers.pop(destination, None)
+        if timer is not None:
+            timer.cancel()
+        writes = self._pending.pop(destination, [])
+        self._pending_rows.pop(destination, None)
+        if not writes:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(destination, writes))
+        # Keep a reference until the task is done
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, destination: Hashable, writes: List[Tuple[List[Any], asyncio.Future, float]]) -> None:
+        started = time.perf_counter()
+        rows = [row for write_rows, _, _ in writes for row in write_rows]
+        self._count(len(writes), len(rows), sum(started - enqueued for _, _, enqueued in writes))
+
+        try:
+            inserted = list(await self._insert(destination, rows))
+        except Exception as e:
+            for _, future, _ in writes:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Hand every caller the outcome of its own rows
+        outcomes = []
+        start = 0
+        for write_rows, _, _ in writes:
+            outcomes.append(inserted[start:start + len(write_rows)])
+            start += len(write_rows)
+        # Rows rejected together with the rows of other writes
+        retry = [i for i, outcome in enumerate(outcomes) if None in outcome] if len(writes) > 1 else []
+        retried = await asyncio.gather(*[self._retry(destination, writes[i][0], outcomes[i]) for i in retry])
+        for i, outcome in zip(retry, retried):
+            outcomes[i] = outcome
+        for (_, future, _), outcome in zip(writes, outcomes):
+            if not future.done():
+                future.set_result([bool(ok) for ok in outcome])
+
+    async def _retry(self, destination: Hashable, rows: List[Any], outcome: List[Optional[bool]]) -> List[Optional[bool]]:
+        """Insert the rows of one write that were rejected together with the rows of other writes on their own."""
+        self.retried_writes += 1
+        rejected = [i for i, ok in enumerate(outcome) if ok is None]
+        try:
+            retried = list(await self._insert(destination, [rows[i] for i in rejected]))
+        except Exception:
+            return outcome
+        outcome = list(outcome)
+        for i, ok in zip(rejected, retried):
+            outcome[i] = ok
+        return outcome
+
+    def _count(self, writes: int, rows: int, queue_delay: float) -> None:
+        self.batches += 1
+        self.writes += writes
+        self.rows += rows
+        self.max_seen_batch_rows = max(self.max_seen_batch_rows, rows)
+        self.queue_delay += queue_delay
+
+    def stats(self) -> Dict[str, float]:
+        """How many writes and rows each batch coalesced, and how long the writes waited."""
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "rows": self.rows,
+            "mean_writes_per_batch": self.writes / self.batches if self.batches else 0.0,
+            "mean_rows_per_batch": self.rows / self.batches if self.batches else 0.0,
+            "max_rows_per_batch": self.max_seen_batch_rows,
+            "mean_queue_delay_ms": self.queue_delay / self.writes * 1000 if self.writes else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "retried_writes": self.retried_writes,
+        }
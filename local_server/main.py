@@ -1,7 +1,12 @@
 # This is a version of the main.py file found in ../../../server/main.py for testing the plugin locally.
 # Use the command `poetry run dev` to run this.
+import time
+# Measure how long importing the server modules takes
+_import_started = time.perf_counter()
+
 import uvicorn
 from fastapi import FastAPI, HTTPException, Body
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
 
@@ -21,7 +26,11 @@ from datastore.factory import get_datastore
 
 from starlette.responses import FileResponse
 
-from services.data_processing import process_and_upload_documents_url, get_document_content
+from services.data_processing import process_and_upload_documents_url, get_document_content, warm_up
+from services.readiness import WarmUp
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+readiness = WarmUp(IMPORT_SECONDS)
 
 
 app = FastAPI()
@@ -70,6 +79,13 @@ async def get_openapi(request):
     file_path = "./local_server/openapi.yaml"
     return FileResponse(file_path, media_type="text/json")
 
+@app.get("/health/ready")
+async def ready():
+    if not readiness.ready:
+        return JSONResponse(status_code=503, content=readiness.status())
+    return readiness.status()
+
+
 @app.post(
     "/upsert",
     response_model=UpsertResponse,
@@ -148,10 +164,20 @@ async def get_document(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.get(
+    "/metrics"
+    )
+async def metrics():
+    return datastore.metrics()
+
+
 @app.on_event("startup")
 async def startup():
     global datastore
     datastore = await get_datastore()
+    logger.info("Server modules imported in {:.2f}s".format(IMPORT_SECONDS))
+    # Load the models in the background, /health/ready turns green when done
+    readiness.start(warm_up)
 
 def start():
     uvicorn.run("local_server.main:app", host="0.0.0.0", port=PORT, reload=True)
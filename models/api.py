@@ -5,9 +5,9 @@ from models.models import (
     QueryGroupResult,
     DocumentDelete,
     Partition,
-    Collection
+    Collection,
+    BaseModel
 )
-from pydantic import BaseModel
 from typing import List, Dict, Any
 
 
@@ -1,8 +1,36 @@
-from pydantic import BaseModel
+import numpy as np
+from pydantic import BaseModel as PydanticBaseModel
 from typing import List, Optional
 from enum import Enum
 from pydantic import validator
 
+
+class BaseModel(PydanticBaseModel):
+    class Config:
+        # Embeddings are float32 arrays in Python and only become lists in JSON
+        json_encoders = {np.ndarray: lambda array: array.tolist()}
+
+
+class Embedding(np.ndarray):
+    """A float32 embedding vector. Lists are converted once, float32 arrays are kept as they are."""
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, np.ndarray) and value.dtype == np.float32 and value.ndim == 1:
+            return value
+        array = np.asarray(value, dtype=np.float32)
+        if array.ndim != 1:
+            raise ValueError("embedding must be a vector")
+        return array
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type="array", items={"type": "number"})
+
 class Collection(str, Enum):
     QGRMemory = "QGRMemory"
     KleeMemory = "KleeMemory"
@@ -39,7 +67,9 @@ class DocumentChunk(BaseModel):
     collection: Optional[Collection] = None
     partition: Optional[Partition] = None
     metadata: Optional[DocumentChunkMetadata] = None
-    embedding: Optional[List[float]] = None
+    embedding: Optional[Embedding] = None
+    chunk_hash: Optional[str] = None
+    chunk_index: Optional[int] = None
 
 class DocumentChunkWithScore(DocumentChunk):
     score: float
@@ -62,7 +92,7 @@ class DocumentGroupWithScores(BaseModel):
     collection: Optional[str] = None
     partition: Optional[str] = None
     metadata: Optional[DocumentMetadata] = None
-    embedding: Optional[List[float]] = None
+    embedding: Optional[Embedding] = None
     scores: List[float]  
     
 class Query(BaseModel):
@@ -74,7 +104,7 @@ class Query(BaseModel):
     searchprecision: Optional[SearchPrecision] = None
     
 class QueryWithEmbedding(Query):
-    embedding: List[float]
+    embedding: Embedding
 
 class QueryResult(BaseModel):
     query: str
@@ -90,7 +120,7 @@ class DocumentGroupWithScores(BaseModel):
     collection: Optional[str] = None
     partition: Optional[str] = None
     metadata: Optional[DocumentMetadata] = None
-    embedding: Optional[List[float]] = None
+    embedding: Optional[Embedding] = None
     scores: List[float]  
     
 class QueryGroupResult(BaseModel):
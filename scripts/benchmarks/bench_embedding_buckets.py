@@ -0,0 +1,74 @@
+# scripts/benchmarks/bench_embedding_buckets.py
+
+from services.embedders import EMBEDDING_BACKENDS, get_embedder
+from services.text_splitter import LATEX_SEPARATORS
+import services.data_processing as qgr
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+def load_chunks(folder_path, max_chunks, length=512):
+    """Chunk the latex_doc of the paper JSON files of folder_path the way process_json.py does."""
+    chunks = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(root, file), 'r', encoding='utf-8') as json_file:
+                content = json.load(json_file).get("latex_doc") or ""
+            chunks.extend(qgr.splitText(qgr.clean_latex(content), LATEX_SEPARATORS, length))
+            if len(chunks) >= max_chunks:
+                return chunks[:max_chunks]
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folder_path", required=True, help="A folder of paper JSON files.")
+    parser.add_argument("--sbert_model_name", default='sentence-transformers/multi-qa-MiniLM-L6-cos-v1', help="The name of the SentenceTransformer model.")
+    parser.add_argument("--backend", default="sentence-transformers", choices=EMBEDDING_BACKENDS, help="The embedding backend.")
+    parser.add_argument("--batch_size", default=64, type=int, help="Texts per batch.")
+    parser.add_argument("--max_chunks", default=5000, type=int, help="Maximum number of chunks to embed.")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.folder_path, args.max_chunks)
+    # Queries are short, mix some in like the server does
+    texts = chunks + [chunk[:60] for chunk in chunks[::10]]
+    embedder = get_embedder(args.sbert_model_name, args.backend)
+    embedder.encode(texts[:args.batch_size], args.batch_size)  # Warm up
+
+    # Fixed size batches in input order
+    started = time.perf_counter()
+    unbucketed = np.concatenate([
+        embedder._encode(texts[i:i + args.batch_size], args.batch_size)
+        for i in range(0, len(texts), args.batch_size)
+    ])
+    unbucketed_seconds = time.perf_counter() - started
+
+    # Length bucketed batches
+    before = embedder.stats()
+    started = time.perf_counter()
+    bucketed = embedder.encode(texts, args.batch_size)
+    bucketed_seconds = time.perf_counter() - started
+    after = embedder.stats()
+
+    unbucketed = unbucketed / np.linalg.norm(unbucketed, axis=1)[:, None]
+    tokens = after["tokens"] - before["tokens"]
+    print(json.dumps({
+        "texts": len(texts),
+        "tokens": tokens,
+        "unbucketed_tokens_per_second": tokens / unbucketed_seconds,
+        "bucketed_tokens_per_second": tokens / bucketed_seconds,
+        "speedup": unbucketed_seconds / bucketed_seconds,
+        "padding_ratio": after["padding_ratio"],
+        "unbucketed_padding_ratio": after["unbucketed_padding_ratio"],
+        "max_cosine_drift": float(1 - np.sum(unbucketed * bucketed, axis=1).min()),
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
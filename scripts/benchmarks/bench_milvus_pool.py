@@ -0,0 +1,110 @@
+# scripts/benchmarks/bench_milvus_pool.py
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+# A throwaway collection, created before the datastore module reads MILVUS_COLLECTION
+os.environ.setdefault("MILVUS_COLLECTION", "bench_pool_" + uuid.uuid4().hex[:8])
+
+import datastore.providers.milvus_datastore as milvus_datastore
+from datastore.providers.milvus_datastore import MILVUS_COLLECTION, MilvusDataStore, OUTPUT_DIM
+from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding
+from pymilvus import utility
+
+
+def random_vectors(rng, count):
+    vectors = rng.standard_normal((count, OUTPUT_DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def fill(datastore, rng, rows):
+    """Insert rows random chunks into the chats partition (the default search partition)."""
+    vectors = random_vectors(rng, rows)
+    chunks = [
+        DocumentChunk.construct(
+            text=f"chunk {i}",
+            partition="chats",
+            metadata=DocumentChunkMetadata.construct(document_id=f"doc{i // 10}", title=f"title {i // 10}"),
+            embedding=vectors[i],
+        )
+        for i in range(rows)
+    ]
+    documents = {}
+    for chunk in chunks:
+        documents.setdefault(chunk.metadata.document_id, []).append(chunk)
+    await datastore._upsert(documents)
+    await datastore.flush()
+
+
+async def load(datastore, rng, concurrency, requests, top_k):
+    """concurrency clients each sending requests single-query searches in a row, return the latencies."""
+    latencies = []
+
+    async def client():
+        for vector in random_vectors(rng, requests):
+            query = QueryWithEmbedding(query="bench", embedding=vector, top_k=top_k)
+            started = time.perf_counter()
+            await datastore._query([query])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - started
+
+
+async def run(args):
+    rng = np.random.default_rng(args.seed)
+    results = []
+    datastore = None
+    try:
+        for i, pool_size in enumerate(args.pool_sizes):
+            # The pool is built from MILVUS_POOL_SIZE when the datastore connects
+            milvus_datastore.MILVUS_POOL_SIZE = pool_size
+            datastore = MilvusDataStore(create_new=(i == 0), consistency_level="Strong")
+            if i == 0:
+                await fill(datastore, rng, args.rows)
+            # Open the collection handle of every alias before measuring
+            await load(datastore, rng, pool_size, 1, args.top_k)
+
+            latencies, seconds = await load(datastore, rng, args.concurrency, args.requests, args.top_k)
+            latencies_ms = np.array(latencies) * 1000
+            results.append({
+                "pool_size": len(datastore._pool.aliases),
+                "searches": len(latencies),
+                "searches_per_second": len(latencies) / seconds,
+                "p50_ms": float(np.percentile(latencies_ms, 50)),
+                "p99_ms": float(np.percentile(latencies_ms, 99)),
+                "pool": datastore._pool.stats(),
+            })
+            datastore._executor.shutdown(wait=True)
+    finally:
+        if datastore is not None and not args.keep:
+            utility.drop_collection(MILVUS_COLLECTION, using=datastore.alias)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool_sizes", default=[1, 2, 4, 8], type=int, nargs="+", help="Connection pool sizes to compare.")
+    parser.add_argument("--concurrency", default=32, type=int, help="Number of concurrent clients.")
+    parser.add_argument("--requests", default=50, type=int, help="Searches sent by every client.")
+    parser.add_argument("--rows", default=20000, type=int, help="Random chunks inserted into the collection.")
+    parser.add_argument("--top_k", default=5, type=int, help="Hits per search.")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the random vectors.")
+    parser.add_argument("--keep", action="store_true", help="Keep the collection instead of dropping it.")
+    args = parser.parse_args()
+
+    # Every client needs an executor thread for its searches to overlap
+    milvus_datastore.MILVUS_EXECUTOR_WORKERS = max(milvus_datastore.MILVUS_EXECUTOR_WORKERS, args.concurrency)
+    results = asyncio.run(run(args))
+    print(json.dumps({"collection": MILVUS_COLLECTION, "concurrency": args.concurrency, "results": results}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# scripts/benchmarks/bench_text_normalizer.py
+
+from services.text_normalizer import DESCRIPTION_NORMALIZER, LATEX_NORMALIZER
+import argparse
+import json
+import os
+import random
+import re
+import time
+
+
+def reference_clean_description(description):
+    """clean_description before the TextNormalizer."""
+    description = re.sub(r'http\S+|www.\S+', '', description, flags=re.MULTILINE)
+    description = re.sub(r'\d+:\d+:\d+|\d+:\d+', '', description)
+    description = re.sub(r'\S{30,}', '', description)
+    description = re.sub(r'[^a-zA-Z0-9 \n\.]', '', description)
+    description = re.sub(r'\n+', '\n', description)
+    description = re.sub(r' +', ' ', description)
+    return description
+
+
+def reference_clean_latex(latex_content):
+    """clean_latex before the TextNormalizer."""
+    cleaned_content = re.sub(r'[\u2022-\u5424]', '', latex_content)
+    cleaned_content = re.sub(r'[^\x00-\x7F]+', '', cleaned_content)
+    cleaned_content = re.sub(r' +', ' ', cleaned_content)
+    return cleaned_content
+
+
+CASES = [
+    (reference_clean_description, DESCRIPTION_NORMALIZER),
+    (reference_clean_latex, LATEX_NORMALIZER),
+]
+
+# Fragments the random texts are made of, chosen to hit the edges of every rule
+FRAGMENTS = [
+    "a", "Z", "7", " ", "  ", "\n", "\n\n", "\t", ".", ":", "12:30", "1:2:3", "$x^2$", "\\section{A}",
+    "http://example.org/a?b=1", "www.x", "www y", "httpz", "w", "ww", "é", "…", "•", "中文", "吤", "吥",
+    "x" * 29, "y" * 31, "#", "\r", "\x00",
+]
+
+
+def random_text(rng, max_fragments):
+    return "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, max_fragments)))
+
+
+def blocks(text, rng):
+    """Cut text into blocks of random sizes."""
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, 64)
+        yield text[start:end]
+        start = end
+
+
+def check_equivalence(texts, rng):
+    """Compare normalize() and stream() with the reference functions, return the mismatches."""
+    mismatches = []
+    for text in texts:
+        for reference, normalizer in CASES:
+            expected = reference(text)
+            if normalizer.normalize(text) != expected:
+                mismatches.append({"function": reference.__name__, "mode": "normalize", "text": text[:200]})
+            if "".join(normalizer.stream(blocks(text, rng))) != expected:
+                mismatches.append({"function": reference.__name__, "mode": "stream", "text": text[:200]})
+    return mismatches
+
+
+def load_contents(folder_path, max_files):
+    """The raw latex_doc of the paper JSON files of folder_path."""
+    contents = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(root, file), 'r', encoding='utf-8') as json_file:
+                contents.append(json.load(json_file).get("latex_doc") or "")
+            if len(contents) >= max_files:
+                return contents
+    return contents
+
+
+def throughput(function, contents):
+    started = time.perf_counter()
+    for content in contents:
+        function(content)
+    return sum(len(content) for content in contents) / (time.perf_counter() - started) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folder_path", help="A folder of paper JSON files, only the random texts are checked without it.")
+    parser.add_argument("--max_files", default=500, type=int, help="Maximum number of files to normalize.")
+    parser.add_argument("--random_texts", default=20000, type=int, help="Number of random texts to check.")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the random texts.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [random_text(rng, 60) for _ in range(args.random_texts)]
+    results = {"random_texts": len(texts)}
+    mismatches = check_equivalence(texts, rng)
+
+    if args.folder_path:
+        contents = load_contents(args.folder_path, args.max_files)
+        mismatches += check_equivalence(contents, rng)
+        results["files"] = len(contents)
+        results["characters"] = sum(len(content) for content in contents)
+        for reference, normalizer in CASES:
+            name = reference.__name__[len("reference_"):]
+            before = throughput(reference, contents)
+            after = throughput(normalizer.normalize, contents)
+            results[name] = {"reference_mb_per_second": before, "mb_per_second": after, "speedup": after / before}
+
+    results["mismatches"] = len(mismatches)
+    results["first_mismatches"] = mismatches[:5]
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# scripts/benchmarks/bench_text_splitter.py
+
+from services.text_splitter import LATEX_COMMAND_SEPARATORS, TextSplitter
+import services.data_processing as qgr
+import argparse
+import json
+import os
+import time
+
+
+def load_contents(folder_path, max_files):
+    """The cleaned latex_doc of the paper JSON files of folder_path."""
+    contents = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(root, file), 'r', encoding='utf-8') as json_file:
+                content = json.load(json_file).get("latex_doc") or ""
+            contents.append(qgr.clean_latex(content))
+            if len(contents) >= max_files:
+                return contents
+    return contents
+
+
+def langchain_split(contents, separators, length, overlap):
+    """Split the contents the way splitText did with langchain: create_documents, then split_documents."""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(
+        separators=list(separators),
+        chunk_size=length,
+        chunk_overlap=overlap,
+        length_function=len,
+    )
+    chunks = []
+    for content in contents:
+        documents = splitter.split_documents(splitter.create_documents([content]))
+        chunks.append([document.page_content for document in documents])
+    return chunks
+
+
+def native_split(contents, separators, length, overlap):
+    splitter = TextSplitter(separators, length, overlap)
+    return [list(splitter.split(content)) for content in contents]
+
+
+def timed(split, contents, separators, length, overlap):
+    started = time.perf_counter()
+    chunks = split(contents, separators, length, overlap)
+    return chunks, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folder_path", required=True, help="A folder of paper JSON files.")
+    parser.add_argument("--max_files", default=500, type=int, help="Maximum number of files to split.")
+    parser.add_argument("--length", default=512, type=int, help="Maximum number of characters of a chunk.")
+    parser.add_argument("--overlap", default=20, type=int, help="Characters shared by consecutive chunks.")
+    args = parser.parse_args()
+
+    from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
+    langchain_separators = RecursiveCharacterTextSplitter.get_separators_for_language(Language.LATEX)
+
+    contents = load_contents(args.folder_path, args.max_files)
+    characters = sum(len(content) for content in contents)
+
+    # Same separators as langchain's LatexTextSplitter: the output must be identical
+    reference, langchain_seconds = timed(langchain_split, contents, langchain_separators, args.length, args.overlap)
+    same, same_seconds = timed(native_split, contents, langchain_separators, args.length, args.overlap)
+    # The LaTeX commands as they appear in the text (LATEX_COMMAND_SEPARATORS=true)
+    native, native_seconds = timed(native_split, contents, LATEX_COMMAND_SEPARATORS, args.length, args.overlap)
+
+    print(json.dumps({
+        "files": len(contents),
+        "characters": characters,
+        "langchain_chunks": sum(len(chunks) for chunks in reference),
+        "langchain_mb_per_second": characters / langchain_seconds / 1e6,
+        "native_mb_per_second": characters / same_seconds / 1e6,
+        "speedup": langchain_seconds / same_seconds,
+        "files_differing": sum(a != b for a, b in zip(reference, same)),
+        "latex_command_separators_chunks": sum(len(chunks) for chunks in native),
+        "latex_command_separators_mb_per_second": characters / native_seconds / 1e6,
+        "latex_command_separators_files_differing": sum(a != b for a, b in zip(reference, native)),
+    }, indent=4))
+
+
+if __name__ == "__main__":
+    main()
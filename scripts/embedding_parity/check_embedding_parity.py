@@ -0,0 +1,65 @@
+# scripts/embedding_parity/check_embedding_parity.py
+
+from services.embedders import EMBEDDING_BACKENDS, check_parity, get_embedder
+import argparse
+import json
+import os
+import sys
+
+
+def load_texts(texts_file, json_folder, max_texts, length=512):
+    """
+    Collect the texts to compare: one text per line of texts_file, and the abstract
+    and the first chunks of the latex_doc of every JSON file in json_folder.
+    """
+    texts = []
+    if texts_file:
+        with open(texts_file, 'r', encoding='utf-8') as f:
+            texts.extend(line.strip() for line in f if line.strip())
+
+    if json_folder:
+        for root, dirs, files in os.walk(json_folder):
+            for file in files:
+                if not file.endswith('.json'):
+                    continue
+                with open(os.path.join(root, file), 'r', encoding='utf-8') as json_file:
+                    data = json.load(json_file)
+                if data.get("abstract"):
+                    texts.append(data["abstract"][:length])
+                content = data.get("latex_doc") or ""
+                texts.extend(content[i:i + length] for i in range(0, min(len(content), 4 * length), length))
+                if len(texts) >= max_texts:
+                    break
+
+    return texts[:max_texts]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sbert_model_name", default='sentence-transformers/multi-qa-MiniLM-L6-cos-v1', help="The name of the SentenceTransformer model.")
+    parser.add_argument("--backend", required=True, choices=EMBEDDING_BACKENDS, help="The embedding backend to check.")
+    parser.add_argument("--reference_backend", default="sentence-transformers", choices=EMBEDDING_BACKENDS, help="The backend the index was built with.")
+    parser.add_argument("--texts_file", help="A text file with one text per line.")
+    parser.add_argument("--json_folder", help="A folder of paper JSON files (see process_json).")
+    parser.add_argument("--max_texts", default=1000, type=int, help="Maximum number of texts to compare.")
+    parser.add_argument("--max_mean_drift", default=0.01, type=float, help="Fail when the mean cosine drift is larger.")
+    args = parser.parse_args()
+
+    texts = load_texts(args.texts_file, args.json_folder, args.max_texts)
+    if not texts:
+        print("No texts to compare, use --texts_file or --json_folder")
+        sys.exit(2)
+
+    reference = get_embedder(args.sbert_model_name, args.reference_backend)
+    candidate = get_embedder(args.sbert_model_name, args.backend)
+    report = check_parity(reference, candidate, texts)
+    print(json.dumps(report, indent=4))
+
+    if report["mean_drift"] > args.max_mean_drift:
+        print(f"Mean cosine drift {report['mean_drift']:.5f} is above {args.max_mean_drift}, keep the {args.reference_backend} backend or re-index")
+        sys.exit(1)
+    print(f"The {args.backend} backend can replace {args.reference_backend} without re-indexing")
+
+
+if __name__ == "__main__":
+    main()
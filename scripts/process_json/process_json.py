@@ -3,15 +3,18 @@
 # Importing qgr package functions
 import services.data_processing as qgr
 
-from pymilvus import Collection
-from sentence_transformers import SentenceTransformer
 import argparse
 import json
 import os
 import shutil
 #Text splitter
-from langchain.text_splitter import LatexTextSplitter
+from services.text_splitter import LATEX_SEPARATORS
 from datastore.factory import get_datastore
+from services.dedup import get_deduplicator
+from services.embedders import embedder_id
+from services.embedding_cache import get_embedding_cache
+from services.embedding_executor import EmbeddingExecutor
+from concurrent.futures.process import BrokenProcessPool
 import asyncio
 
 
@@ -41,6 +44,70 @@ def stringify_authors_or_keywords(value):
     else:
         return "Unknown"
     
+def prepare_document(entry, partition_name):
+    """
+    Truncate and clean the metadata of a JSON entry and split its content into chunks.
+    """
+    date_value = entry.get("date", "") or "Unknown"  # Use "Unknown" if date is None or empty
+    if len(date_value) > 1000:
+        date_value = qgr.clean_description(date_value)
+    date_value = date_value[:250]  # Truncate to 256 characters
+
+    keywords = entry.get("keywords", "") or "Unknown"  # Use "Unknown" if keywords is None or empty
+    keywords_value = stringify_authors_or_keywords(keywords)[:1004]
+    if len(keywords_value) > 1000:
+        keywords_value = qgr.clean_description(keywords_value)
+    keywords_value = keywords_value[:1004]  # Truncate to 1024 characters
+    
+    authors = entry.get("authors", "") or "Unknown" 
+    author_value = stringify_authors_or_keywords(authors)[:1000]
+    if len(author_value) > 1000:
+        author_value = qgr.clean_description(author_value)
+    author_value = author_value[:1000]  # Truncate to 1024 characters
+    
+    title_value = entry.get("title", "") or "Unknown"
+    if len(title_value) > 1000:
+        title_value = qgr.clean_description(title_value)
+    title_value = title_value[:900]  # Truncate to 1024 characters
+    
+    abstract_value = entry.get("abstract", "") or "Unknown"
+    if len(abstract_value) > 4000:
+        abstract_value = qgr.clean_description(abstract_value)
+    abstract_value = abstract_value[:4000]  # Truncate to 4096 characters
+
+    category_value = entry.get("category", "") or "Unknown"
+    if len(category_value) > 1000:
+        category_value = qgr.clean_description(category_value)
+    category_value = category_value[:250]  # Truncate to 256 characters
+    
+    content = entry.get("latex_doc", "")
+    
+    if partition_name == "notes":
+        content = qgr.clean_description(content)
+    else:
+        content = qgr.clean_latex(content)
+    
+    docslatex = qgr.splitText(content, LATEX_SEPARATORS, 512)            
+
+    chunks = []
+    for chunk in docslatex:
+        if len(chunk) > 512:
+            chunks.append(qgr.clean_description(chunk))
+        else:
+            chunks.append(chunk)
+
+    return {
+        "document_id": qgr.generate_document_id(title_value, author_value, date_value),
+        "title": title_value,
+        "date": date_value,
+        "authors": author_value,
+        "abstract": abstract_value,
+        "keywords": keywords_value,
+        "category": category_value,
+        "chunks": chunks,
+    }
+
+
 async def insert_data_json_into_milvus(
         collection_name,
         partition_name,
@@ -48,136 +115,155 @@ async def insert_data_json_into_milvus(
         folder_path,
         folder_path_not_processed,
         processed_file_name,
-        files_processed_save_max=100
+        files_processed_save_max=100,
+        workers=1,
+        max_pending=8
     ):
+    """
+    Read, chunk and insert the JSON files of folder_path. The chunks are embedded by a pool
+    of worker processes, each loading the SBERT model once; up to max_pending documents
+    wait for their embeddings while the next files are read and chunked.
+    """
 
     files_process_max=12000
     
-    # Load the pre-trained SBERT model
-    sbert_model = SentenceTransformer(sbert_model_name) 
+    # The pre-trained SBERT model is loaded by every worker process
+    executor = EmbeddingExecutor(sbert_model_name, kind="process", max_workers=workers, queue_depth=max_pending)
+    cache = get_embedding_cache(embedder_id(sbert_model_name))
+    # Near-duplicate documents and chunks are skipped when DEDUP_ENABLED
+    deduplicator = get_deduplicator()
 
     # Initialize a list to keep track of processed file paths
     processed_files = qgr.load_processed_files(processed_file_name)
 
+    # Documents waiting for their embeddings, in file order, None once all files are read
+    pending = asyncio.Queue(maxsize=max_pending)
+
+    def move_not_processed(file_path, e):
+        print(f"file not fully processed: {file_path}")
+        print(f"Error details: {str(e)}")
+
+        # Move the file to the "notprocessed" folder
+        destination_path = os.path.join(folder_path_not_processed, os.path.basename(file_path))
+        shutil.move(file_path, destination_path)
+
+    async def read_files():
+        files_read = 0
+        for file_path, category in qgr.iter_json_files(folder_path):
+            if files_read >= files_process_max:
+                break
+            try:
+                entry = qgr.read_json_entry(file_path, category)
+                document = prepare_document(entry, partition_name)
+                if deduplicator is not None:
+                    # Recorded once the chunks are inserted
+                    document["deduplication"] = await asyncio.to_thread(
+                        deduplicator.deduplicate, document["document_id"], entry.get("latex_doc") or "", document["chunks"]
+                    )
+                    document["chunks"] = [document["chunks"][i] for i in document["deduplication"].kept]
+            except Exception as e:
+                move_not_processed(file_path, e)
+                continue
+
+            # Start embedding now, the result is awaited when the document is inserted
+            texts = [chunk[:512] for chunk in document["chunks"]]
+            embeddings = asyncio.ensure_future(
+                cache.aget_or_compute(texts, lambda uncached: executor.embed(uncached, qgr.EMBEDDING_BATCH_SIZE))
+            )
+            await pending.put((file_path, entry, document, embeddings))
+            files_read += 1
+        await pending.put(None)
+
+    reader = asyncio.create_task(read_files())
     files_processed = 0
-    while files_processed < files_process_max:
-        try:
-            entry, file_path = qgr.process_file_from_folder(folder_path)
-        except Exception as e:
-            print(f"error folder_path: {folder_path}")
-            print(f"Error details: {str(e)}")
-            break
-
-        if entry is None:
-            break
-        
-        try:
-            date_value = entry.get("date", "") or "Unknown"  # Use "Unknown" if date is None or empty
-            if len(date_value) > 1000:
-                date_value = qgr.clean_description(date_value)
-            date_value = date_value[:250]  # Truncate to 256 characters
-
-            keywords = entry.get("keywords", "") or "Unknown"  # Use "Unknown" if keywords is None or empty
-            keywords_value = stringify_authors_or_keywords(keywords)[:1004]
-            if len(keywords_value) > 1000:
-                keywords_value = qgr.clean_description(keywords_value)
-            keywords_value = keywords_value[:1004]  # Truncate to 1024 characters
-            
-            authors = entry.get("authors", "") or "Unknown" 
-            author_value = stringify_authors_or_keywords(authors)[:1000]
-            if len(author_value) > 1000:
-                author_value = qgr.clean_description(author_value)
-            author_value = author_value[:1000]  # Truncate to 1024 characters
-            
-            title_value = entry.get("title", "") or "Unknown"
-            if len(title_value) > 1000:
-                title_value = qgr.clean_description(title_value)
-            title_value = title_value[:900]  # Truncate to 1024 characters
-            
-            abstract_value = entry.get("abstract", "") or "Unknown"
-            if len(abstract_value) > 4000:
-                abstract_value = qgr.clean_description(abstract_value)
-            abstract_value = abstract_value[:4000]  # Truncate to 4096 characters
-
-            category_value = entry.get("category", "") or "Unknown"
-            if len(category_value) > 1000:
-                category_value = qgr.clean_description(category_value)
-            category_value = category_value[:250]  # Truncate to 256 characters
-            
-            content = entry.get("latex_doc", "")
-            
-            if partition_name == "notes":
-                content = qgr.clean_description(content)
-            else:
-                content = qgr.clean_latex(content)
-            
-            docslatex = qgr.splitText(content, LatexTextSplitter, 512)            
-    
-            documentId_value = qgr.generate_document_id(title_value, author_value, date_value)
-
-            # Save the document as a JSON file
-            save_document_as_json(documentId_value, entry, base_folder="../../data/json_source")
-
-            for chunk in docslatex:
-                if len(chunk.page_content) > 512:
-                    embeddingElement = qgr.clean_description(chunk.page_content)
-                else:
-                    embeddingElement = chunk.page_content  # Access the page_content attribute
-                content_vector_element = qgr.convertToVector(embeddingElement, sbert_model, 512)  # Provide the model and length
-
-                # Create a dictionary for the document
-                doc = [
-                    [documentId_value],
-                    [title_value],
-                    [date_value],
-                    [author_value],
-                    [abstract_value],
-                    [keywords_value],
-                    [category_value],
-                    [embeddingElement],
-                    [content_vector_element]
-                ]
-                #insert data
-                #To Do: use different collection_name, currently set global a default
-                insert_result = await datastore.raw_upsert(doc, collection_name, partition_name)
-                
-                if not insert_result:
-                    title = entry.get("title", "")
-                    print(f"fail: {title_value} : {embeddingElement}")
-
-
-            # Delete the file after insertion
-            os.remove(file_path)
-
-            # Append the successfully processed file path to the list
-            processed_files.append(file_path)
-
-            files_processed += 1  # Increment the counter
-
-            # Flush the data and save the processed file paths every 1000 files
-            if files_processed % files_processed_save_max == 0:
-                await datastore.flush()
-
-                with open(processed_file_name, 'w') as json_file:
-                    json.dump(processed_files, json_file)
-                print(f"Flushed and saved processed files at {files_processed}")
-
-        except Exception as e:
-            print(f"file not fully processed: {file_path}")
-            print(f"Error details: {str(e)}")
-
-            # Move the file to the "notprocessed" folder
-            destination_path = os.path.join(folder_path_not_processed, os.path.basename(file_path))
-            shutil.move(file_path, destination_path)
-
-    # Flush the data
-    await datastore.flush()
-
-    print(f"Flushed and saved processed files at {files_processed}")
-
-    # Save the updated list of processed file paths to the JSON file
-    with open(processed_file_name, 'w') as json_file:
-        json.dump(processed_files, json_file)
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            file_path, entry, document, embeddings = item
+
+            try:
+                content_vectors = await embeddings
+            except BrokenProcessPool:
+                # A worker died, nothing more can be embedded
+                raise
+            except Exception as e:
+                move_not_processed(file_path, e)
+                continue
+
+            try:
+                documentId_value = document["document_id"]
+
+                # Save the document as a JSON file
+                save_document_as_json(documentId_value, entry, base_folder="../../data/json_source")
+
+                chunks = document["chunks"]
+                if chunks:
+                    # One column per field, one row per chunk
+                    doc = [
+                        [documentId_value] * len(chunks),
+                        [document["title"]] * len(chunks),
+                        [document["date"]] * len(chunks),
+                        [document["authors"]] * len(chunks),
+                        [document["abstract"]] * len(chunks),
+                        [document["keywords"]] * len(chunks),
+                        [document["category"]] * len(chunks),
+                        chunks,
+                        content_vectors  # float32 array, no per-element conversion
+                    ]
+                    #insert data
+                    #To Do: use different collection_name, currently set global a default
+                    insert_result = await datastore.raw_upsert(doc, collection_name, partition_name)
+
+                    if not insert_result:
+                        print(f"fail: {document['title']}")
+                        raise RuntimeError(f"Failed to insert the chunks of {documentId_value}")
+
+                if deduplicator is not None:
+                    await asyncio.to_thread(deduplicator.record, [document["deduplication"]])
+
+                # Delete the file after insertion
+                os.remove(file_path)
+
+                # Append the successfully processed file path to the list
+                processed_files.append(file_path)
+
+                files_processed += 1  # Increment the counter
+
+                # Flush the data and save the processed file paths every 1000 files
+                if files_processed % files_processed_save_max == 0:
+                    await datastore.flush()
+
+                    with open(processed_file_name, 'w') as json_file:
+                        json.dump(processed_files, json_file)
+                    print(f"Flushed and saved processed files at {files_processed}")
+
+            except Exception as e:
+                move_not_processed(file_path, e)
+
+        await reader
+    except BaseException:
+        # Stop reading and drop the embeddings still queued, the files stay in folder_path
+        reader.cancel()
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[3].cancel()
+        raise
+    finally:
+        executor.shutdown()
+
+        # Flush the data
+        await datastore.flush()
+
+        print(f"Flushed and saved processed files at {files_processed}")
+        if deduplicator is not None:
+            print(f"Near-duplicates skipped: {deduplicator.stats()}")
+
+        # Save the updated list of processed file paths to the JSON file
+        with open(processed_file_name, 'w') as json_file:
+            json.dump(processed_files, json_file)
         
         
 
@@ -194,6 +280,8 @@ async def main():
     parser.add_argument("--folder_path_not_processed", required=True, help="The path to the folder where unprocessed files will be moved.")
     parser.add_argument("--processed_file_name", required=True, help="The name of the file where processed files will be listed.")
     parser.add_argument("--files_processed_save_max", default=100, type=int, help="Steps to flush processed data.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of embedding worker processes, each loading the model once.")
+    parser.add_argument("--max_pending", default=8, type=int, help="Maximum number of documents waiting for their embeddings.")
     
     args = parser.parse_args()
 
@@ -205,6 +293,8 @@ async def main():
     folder_path_not_processed = args.folder_path_not_processed
     processed_file_name = args.processed_file_name
     files_processed_save_max = args.files_processed_save_max
+    workers = args.workers
+    max_pending = args.max_pending
 
     # Call the insert_data_into_milvus function
     await insert_data_json_into_milvus(
@@ -214,7 +304,9 @@ async def main():
         folder_path,
         folder_path_not_processed,
         processed_file_name,
-        files_processed_save_max
+        files_processed_save_max,
+        workers,
+        max_pending
     )
 
     # If you have other asynchronous tasks, put them here
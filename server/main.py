@@ -1,6 +1,11 @@
+import time
+# Measure how long importing the server modules takes
+_import_started = time.perf_counter()
+
 import os
 import uvicorn
 from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
@@ -17,7 +22,11 @@ from models.api import (
 )
 from datastore.factory import get_datastore
 
-from services.data_processing import process_and_upload_documents_url, get_document_content
+from services.data_processing import process_and_upload_documents_url, get_document_content, warm_up
+from services.readiness import WarmUp
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+readiness = WarmUp(IMPORT_SECONDS)
 
 bearer_scheme = HTTPBearer()
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN")
@@ -43,6 +52,17 @@ sub_app = FastAPI(
 )
 app.mount("/sub", sub_app)
 
+# Health probes are served without the bearer token
+health_app = FastAPI()
+app.mount("/health", health_app)
+
+
+@health_app.get("/ready")
+async def ready():
+    if not readiness.ready:
+        return JSONResponse(status_code=503, content=readiness.status())
+    return readiness.status()
+
 
 @app.post(
     "/upsert",
@@ -121,10 +141,20 @@ async def get_document(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.get(
+    "/metrics"
+    )
+async def metrics():
+    return datastore.metrics()
+
+
 @app.on_event("startup")
 async def startup():
     global datastore
     datastore = await get_datastore()
+    logger.info("Server modules imported in {:.2f}s".format(IMPORT_SECONDS))
+    # Load the models in the background, /health/ready turns green when done
+    readiness.start(warm_up)
 
 
 def start():
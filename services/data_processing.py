@@ -16,108 +16,144 @@ For detailed descriptions of each function, refer to the function-level docstrin
 
 import os
 import json
-import re
+import asyncio
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import math
 import hashlib
+from functools import lru_cache
 from typing import List
 import numpy as np
-import pandas as pd
 from datetime import datetime
 from urllib.parse import urlparse
-import requests
+from loguru import logger
 
 from models.models import Document, DocumentChunk, DocumentChunkMetadata, Partition, Collection
-from typing import Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 
 
-# The powerfull transformers models
-from sentence_transformers import SentenceTransformer
+from services.dedup import Deduplication, get_deduplicator
+from services.embedders import EMBEDDING_BACKEND, embedder_id
+from services.embedding_cache import get_embedding_cache
+from services.embedding_executor import PRIORITY_INGEST, PRIORITY_QUERY, get_embedding_executor
+from services.text_normalizer import DESCRIPTION_NORMALIZER, LATEX_NORMALIZER
+from services.text_splitter import LATEX_SEPARATORS, get_content_defined_splitter, get_text_splitter
 
-#tokenize
-from transformers import GPT2Tokenizer
 
-# Initialize the tokenizer
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-
-#Text splitter
-from langchain.text_splitter import LatexTextSplitter
-
-
-# Load the pre-trained SBERT model once
-sbert_model = SentenceTransformer('sentence-transformers/multi-qa-MiniLM-L6-cos-v1') 
+# The pre-trained SBERT model is owned by the embedding executor, which loads it on first use or in warm_up()
+SBERT_MODEL_NAME = os.environ.get("SBERT_MODEL_NAME") or 'sentence-transformers/multi-qa-MiniLM-L6-cos-v1'
+embedding_executor = get_embedding_executor(SBERT_MODEL_NAME, EMBEDDING_BACKEND)
+# Embeddings of different backends are cached apart
+EMBEDDING_ID = embedder_id(SBERT_MODEL_NAME, EMBEDDING_BACKEND)
 
 # default values
 MILVUS_COLLECTION = os.environ.get("MILVUS_COLLECTION") #Default Collection
 CATEGORY = "ChatGPT"
 PARTITION = "chats"
 MAX_TOKEN_COUNT = 2000  # Set your maximum token count based on your GPT model's limitatio
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE") or 64)  # Chunks per SBERT forward pass
+# Documents longer than STREAMING_UPSERT_CHARS are cleaned, split, embedded and inserted as a stream
+STREAMING_UPSERT_CHARS = int(os.environ.get("STREAMING_UPSERT_CHARS") or 1000000)
+STREAMING_BATCH_SIZE = int(os.environ.get("STREAMING_BATCH_SIZE") or 256)  # Chunks per streamed batch
+STREAMING_SEGMENT_CHARS = int(os.environ.get("STREAMING_SEGMENT_CHARS") or 262144)  # Characters cleaned and split at a time
+# Documents are cleaned and split by a pool of CHUNKING_WORKERS processes, for requests of at least CHUNKING_POOL_MIN_CHARS
+CHUNKING_WORKERS = int(os.environ.get("CHUNKING_WORKERS") or os.cpu_count() or 1)  # 1 chunks in the request process
+CHUNKING_POOL_MIN_CHARS = int(os.environ.get("CHUNKING_POOL_MIN_CHARS") or 200000)
+_chunking_pool: Optional[ProcessPoolExecutor] = None
+_chunking_pool_lock = threading.Lock()
+# Documents of these partitions are split with content-defined boundaries and re-indexed incrementally, none by default
+INCREMENTAL_UPSERT_PARTITIONS = [
+    partition.strip() for partition in (os.environ.get("INCREMENTAL_UPSERT_PARTITIONS") or "").split(",") if partition.strip()
+]
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    """The GPT2 tokenizer, loaded on first use."""
+    #tokenize
+    from transformers import GPT2Tokenizer
+    return GPT2Tokenizer.from_pretrained("gpt2")
+
+
+def warm_up():
+    """Load the SBERT model and the tokenizer, so the first requests do not pay for it."""
+    embedding_executor.warm_up()
+    get_tokenizer()
+
 
 #using sentence level embedding
-def get_embeddings(texts: List[str]) -> List[List[float]]:
+def get_embeddings(texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> np.ndarray:
     """
     Embed texts using the pre-trained SBERT model.
 
     Args:
         texts: The list of texts to embed.
+        batch_size: How many texts are encoded per forward pass.
 
     Returns:
-        A list of embeddings, each of which is a list of floats.
+        A float32 array with one normalized embedding per row.
     """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
     # Truncate each sentence in texts to the first 512 characters
     truncated_texts = [text[:512] for text in texts]
 
-    # Generate the sentence embeddings using SBERT
-    embeddings = sbert_model.encode(truncated_texts)
+    # Generate the normalized sentence embeddings using SBERT, batch_size texts at a time.
+    # Only the texts that are not cached yet go through the model.
+    normalized_embeddings = get_embedding_cache(EMBEDDING_ID).get_or_compute(
+        truncated_texts, lambda uncached_texts: embedding_executor.encode(uncached_texts, batch_size)
+    )
 
-    # Normalize the embeddings
-    normalized_embeddings = embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
+    return normalized_embeddings
 
-    return normalized_embeddings.tolist()
+
+async def aget_embeddings(
+    texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE, priority: int = PRIORITY_INGEST
+) -> np.ndarray:
+    """
+    Embed texts like get_embeddings, running the model in the embedding executor
+    so the event loop is not blocked. Texts of PRIORITY_QUERY go before the ingestion.
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    truncated_texts = [text[:512] for text in texts]
+
+    normalized_embeddings = await get_embedding_cache(EMBEDDING_ID).aget_or_compute(
+        truncated_texts, lambda uncached_texts: embedding_executor.embed(uncached_texts, batch_size, priority)
+    )
+
+    return normalized_embeddings
+
+
+async def aget_query_embeddings(texts: List[str]) -> np.ndarray:
+    """Embed query texts, ahead of the chunks being ingested, see aget_embeddings."""
+    return await aget_embeddings(texts, priority=PRIORITY_QUERY)
 
 
 def clean_description(description):
-    if pd.isnull(description):
+    if description is None or (isinstance(description, float) and math.isnan(description)):
         return ''
-    # Remove URLs
-    description = re.sub(r'http\S+|www.\S+', '', description, flags=re.MULTILINE)
-    # Remove timestamps
-    description = re.sub(r'\d+:\d+:\d+|\d+:\d+', '', description)
-    # Remove sequences of characters that are longer than a certain threshold (e.g., 30)
-    description = re.sub(r'\S{30,}', '', description)
-    # Remove special characters
-    description = re.sub(r'[^a-zA-Z0-9 \n\.]', '', description)
-    # Replace multiple consecutive newlines with a single space
-    description = re.sub(r'\n+', '\n', description)
-    # Remove extra spaces
-    description = re.sub(r' +', ' ', description)
-    return description
+    # Remove URLs, timestamps, sequences longer than 30 characters and special characters,
+    # then collapse repeated newlines and spaces
+    return DESCRIPTION_NORMALIZER.normalize(description)
 
 def clean_latex(latex_content):
-    cleaned_content = re.sub(r'[\u2022-\u5424]', '', latex_content)
-    cleaned_content = re.sub(r'[^\x00-\x7F]+', '', cleaned_content)
-    # Remove extra spaces
-    cleaned_content = re.sub(r' +', ' ', cleaned_content)
-    return cleaned_content
+    # Remove non-ASCII characters and extra spaces
+    return LATEX_NORMALIZER.normalize(latex_content)
 
 
-def splitText(content, splitter, length, overlap=20):
+def splitText(content, separators, length, overlap=20):
+    """Yield the chunks of content, split along separators (e.g. LATEX_SEPARATORS) into at most length characters."""
+    return get_text_splitter(tuple(separators), length, overlap).split(content)
 
-    text_splitter = splitter(
-        chunk_size = length,
-        chunk_overlap  = overlap,
-        length_function = len,
-    )
-    textsDocument = text_splitter.create_documents([content])
-    texts = text_splitter.split_documents(textsDocument)
-    return texts
-
-
-def process_file_from_folder(folder_path):
-    if os.path.exists(folder_path) and os.access(folder_path, os.R_OK):
-        pass
-    else:
-        print("Directory does not exist or is not readable")
 
+def iter_json_files(folder_path):
+    """Yield (file_path, category) of every JSON file below folder_path, the category being its relative folder."""
     for root, dirs, files in os.walk(folder_path):
         # Get the relative path from the root folder to the current directory
         rel_path = os.path.relpath(root, folder_path)
@@ -131,19 +167,32 @@ def process_file_from_folder(folder_path):
 
         for file in files:
             if file.endswith('.json'):
-                file_path = os.path.join(root, file)
-                with open(file_path, 'r') as json_file:
-                    data = json.load(json_file)
-                    entry = {
-                        "title": data.get("title", "Unknown"),
-                        "date": data.get("date", "Unknown"),
-                        "authors": ", ".join(data.get("authors", [])) if isinstance(data.get("authors"), list) else "Unknown",
-                        "autkeywordshors": ", ".join(data.get("keywords", [])) if isinstance(data.get("keywords"), list) else "Unknown",
-                        "abstract": data.get("abstract"),
-                        "latex_doc": data.get("latex_doc"),
-                        "category": category
-                    }
-                return entry, file_path
+                yield os.path.join(root, file), category
+
+
+def read_json_entry(file_path, category):
+    with open(file_path, 'r') as json_file:
+        data = json.load(json_file)
+        entry = {
+            "title": data.get("title", "Unknown"),
+            "date": data.get("date", "Unknown"),
+            "authors": ", ".join(data.get("authors", [])) if isinstance(data.get("authors"), list) else "Unknown",
+            "autkeywordshors": ", ".join(data.get("keywords", [])) if isinstance(data.get("keywords"), list) else "Unknown",
+            "abstract": data.get("abstract"),
+            "latex_doc": data.get("latex_doc"),
+            "category": category
+        }
+    return entry
+
+
+def process_file_from_folder(folder_path):
+    if os.path.exists(folder_path) and os.access(folder_path, os.R_OK):
+        pass
+    else:
+        print("Directory does not exist or is not readable")
+
+    for file_path, category in iter_json_files(folder_path):
+        return read_json_entry(file_path, category), file_path
     return None, None
 
 
@@ -152,121 +201,304 @@ def generate_document_id(title, authors, date):
     return hashlib.sha256(combined_str.encode()).hexdigest()
 
 
-def get_document_chunks(documents: List[Document], chunk_token_size: Optional[int]) -> Dict[str, List[DocumentChunk]]:
-    """Convert a list of documents into a dictionary from document id to list of document chunks."""
-    document_chunks: Dict[str, List[DocumentChunk]] = {}
- 
-    for doc in documents:
-        # Extracting the metadata and content from the document
-        # Default values if metadata is None
-        title_value = "Unknown"
-        current_date = str(datetime.now().strftime("%Y-%m-%d"))
-        date_value = current_date
-        author_value = "Unknown"
-        abstract_value = "Unknown"
-        keywords_value = "Unknown"
-        category_value = "Unknown"
-
-        # Update the values if metadata is provided
-        if doc.metadata is not None:
-            title_value = doc.metadata.title or "Unknown"
-            date_value = doc.metadata.created_at or current_date
-            author_value = doc.metadata.authors or "Unknown"
-            abstract_value = doc.metadata.abstract or "Unknown"
-            keywords_value = doc.metadata.keywords or "Unknown"
-            category_value = doc.metadata.category or "Unknown"
-            
-            
-       
-        content = doc.text
-        partition_name = doc.partition or PARTITION
-        collection_name = doc.collection or MILVUS_COLLECTION
+def generate_chunk_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
 
-        if len(date_value) > 1000:
-            date_value = clean_description(date_value)
-        date_value = date_value[:250]  # Truncate to 256 characters
 
-        if len(keywords_value) > 1000:
-            keywords_value = clean_description(keywords_value)
-        keywords_value = keywords_value[:1004]  # Truncate to 1024 characters
-        
-        if len(author_value) > 1000:
-            author_value = clean_description(author_value)
-        author_value = author_value[:1000]  # Truncate to 1024 characters
-        
-        if len(title_value) > 1000:
-            title_value = clean_description(title_value)
-        title_value = title_value[:900]  # Truncate to 1024 characters
-        
-        if len(abstract_value) > 4000:
-            abstract_value = clean_description(abstract_value)
-        abstract_value = abstract_value[:4000]  # Truncate to 4096 characters
+def has_stable_id(doc: Document) -> bool:
+    """Whether the id of the document comes from its metadata alone.
+
+    Without a title and a creation date the id falls back to "Unknown" and the current
+    day, which every such document upserted on the same day shares.
+    """
+    return doc.metadata is not None and bool(doc.metadata.title) and bool(doc.metadata.created_at)
+
+
+def is_incremental(doc: Document) -> bool:
+    """Whether the document is re-indexed incrementally, see DataStore.upsert_incremental."""
+    return (doc.partition or PARTITION) in INCREMENTAL_UPSERT_PARTITIONS and has_stable_id(doc)
+
+
+def get_document_metadata(doc: Document) -> Tuple[str, DocumentChunkMetadata]:
+    """The document id and the cleaned, truncated chunk metadata of a document."""
+    # Extracting the metadata and content from the document
+    # Default values if metadata is None
+    title_value = "Unknown"
+    current_date = str(datetime.now().strftime("%Y-%m-%d"))
+    date_value = current_date
+    author_value = "Unknown"
+    abstract_value = "Unknown"
+    keywords_value = "Unknown"
+    category_value = "Unknown"
+
+    # Update the values if metadata is provided
+    if doc.metadata is not None:
+        title_value = doc.metadata.title or "Unknown"
+        date_value = doc.metadata.created_at or current_date
+        author_value = doc.metadata.authors or "Unknown"
+        abstract_value = doc.metadata.abstract or "Unknown"
+        keywords_value = doc.metadata.keywords or "Unknown"
+        category_value = doc.metadata.category or "Unknown"
+
+    if len(date_value) > 1000:
+        date_value = clean_description(date_value)
+    date_value = date_value[:250]  # Truncate to 256 characters
+
+    if len(keywords_value) > 1000:
+        keywords_value = clean_description(keywords_value)
+    keywords_value = keywords_value[:1004]  # Truncate to 1024 characters
+    
+    if len(author_value) > 1000:
+        author_value = clean_description(author_value)
+    author_value = author_value[:1000]  # Truncate to 1024 characters
+    
+    if len(title_value) > 1000:
+        title_value = clean_description(title_value)
+    title_value = title_value[:900]  # Truncate to 1024 characters
+    
+    if len(abstract_value) > 4000:
+        abstract_value = clean_description(abstract_value)
+    abstract_value = abstract_value[:4000]  # Truncate to 4096 characters
+
+    if len(category_value) > 1000:
+        category_value = clean_description(category_value)
+    category_value = category_value[:250]  # Truncate to 256 characters
+
+    documentId_value = generate_document_id(title_value, author_value, date_value)
+
+    #doc_id = doc.id or documentId_value
+    doc_id = documentId_value
+
+    chunk_metadata = DocumentChunkMetadata(
+        created_at=date_value,
+        authors=author_value,
+        title=title_value,
+        abstract=abstract_value,
+        keywords=keywords_value,
+        category=category_value,
+        document_id=doc_id,
+    )
+    return doc_id, chunk_metadata
 
-        if len(category_value) > 1000:
-            category_value = clean_description(category_value)
-        category_value = category_value[:250]  # Truncate to 256 characters
-        
-        
-        if partition_name == "notes":
-            content = clean_description(content)
-        else:
-            content = clean_latex(content)
-        docslatex = splitText(content, LatexTextSplitter, chunk_token_size)
 
+def iter_chunk_texts(doc: Document, chunk_token_size: int, segment_chars: Optional[int] = None) -> Iterator[str]:
+    """Yield the cleaned texts of the chunks of a document.
 
-        documentId_value = generate_document_id(title_value, author_value, date_value)
+    With segment_chars, the content is cleaned and split segment by segment, cut at
+    newlines about every segment_chars characters, so that the whole cleaned content
+    is never held in memory. Chunks then also break at the segment ends.
 
-        #doc_id = doc.id or documentId_value
-        doc_id = documentId_value
+    The documents of INCREMENTAL_UPSERT_PARTITIONS are split with content-defined
+    boundaries.
+    """
+    content = doc.text
+    partition_name = doc.partition or PARTITION
+
+    normalizer = DESCRIPTION_NORMALIZER if partition_name == "notes" else LATEX_NORMALIZER
+    if segment_chars is None:
+        segments = [normalizer.normalize(content)]
+    else:
+        segments = normalizer.stream(content[i:i + segment_chars] for i in range(0, len(content), segment_chars))
 
-        # Create DocumentChunk objects for each chunk
-        doc_chunks = []
-        for chunk in docslatex:
-            if len(chunk.page_content) > chunk_token_size:
-                embeddingElement = clean_description(chunk.page_content)
+    if is_incremental(doc):
+        split = get_content_defined_splitter(chunk_token_size).split
+    else:
+        split = lambda segment: splitText(segment, LATEX_SEPARATORS, chunk_token_size)
+
+    for segment in segments:
+        for chunk in split(segment):
+            if len(chunk) > chunk_token_size:
+                yield clean_description(chunk)
             else:
-                embeddingElement = chunk.page_content
-
-            content_vector_element = get_embeddings([embeddingElement])[0]
-            
-            chunk_metadata = DocumentChunkMetadata(
-                created_at=date_value,
-                authors=author_value,
-                title=title_value,
-                abstract=abstract_value,
-                keywords=keywords_value,
-                category=category_value,
-                document_id=doc_id,
+                yield chunk
+
+
+def iter_document_chunks(
+    doc: Document,
+    doc_id: str,
+    chunk_metadata: DocumentChunkMetadata,
+    chunk_token_size: int,
+    segment_chars: Optional[int] = None,
+) -> Iterator[DocumentChunk]:
+    """Yield the chunks of a document, without their embeddings, see iter_chunk_texts.
+
+    Every chunk carries the hash of its text and its index in the document.
+    """
+    collection_name = doc.collection or MILVUS_COLLECTION
+    partition_name = doc.partition or PARTITION
+
+    # Create DocumentChunk objects for each chunk
+    for index, embeddingElement in enumerate(iter_chunk_texts(doc, chunk_token_size, segment_chars)):
+        yield DocumentChunk(
+            id=f"{doc_id}_{index}",
+            text=embeddingElement,
+            collection=collection_name,
+            partition=partition_name,
+            metadata=chunk_metadata,
+            chunk_hash=generate_chunk_hash(embeddingElement),
+            chunk_index=index,
+        )
+
+
+def chunk_document(doc: Document, chunk_token_size: int) -> Tuple[str, Dict[str, Any], List[Tuple[str, str]]]:
+    """The document id, chunk metadata and (text, hash) chunk records of a document.
+
+    This is the work of a chunking pool worker: plain values, cheap to send back.
+    """
+    doc_id, chunk_metadata = get_document_metadata(doc)
+    records = [(text, generate_chunk_hash(text)) for text in iter_chunk_texts(doc, chunk_token_size)]
+    return doc_id, chunk_metadata.dict(), records
+
+
+def get_chunking_pool() -> Optional[ProcessPoolExecutor]:
+    """The process pool chunking the documents of large upserts, None if CHUNKING_WORKERS < 2."""
+    global _chunking_pool
+    if CHUNKING_WORKERS < 2:
+        return None
+    with _chunking_pool_lock:
+        if _chunking_pool is None:
+            # Forking a process running gRPC channels, torch and executor threads can deadlock the workers
+            _chunking_pool = ProcessPoolExecutor(
+                max_workers=CHUNKING_WORKERS, mp_context=multiprocessing.get_context("spawn")
             )
+        return _chunking_pool
+
 
-            doc_chunk = DocumentChunk(
-                id=f"{doc_id}_{len(doc_chunks)}",
-                text=embeddingElement,
+async def chunk_documents(documents: List[Document], chunk_token_size: int) -> List[Tuple[str, Dict[str, Any], List[Tuple[str, str]]]]:
+    """chunk_document of every document, in order.
+
+    Requests of several documents totalling CHUNKING_POOL_MIN_CHARS are fanned out
+    to the chunking pool, one document per task, smaller ones are chunked in place.
+    """
+    global _chunking_pool
+    pool = get_chunking_pool()
+    if pool is None or len(documents) < 2 or sum(len(doc.text) for doc in documents) < CHUNKING_POOL_MIN_CHARS:
+        return [chunk_document(doc, chunk_token_size) for doc in documents]
+
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.gather(
+            *[loop.run_in_executor(pool, chunk_document, doc, chunk_token_size) for doc in documents]
+        )
+    except BrokenProcessPool:
+        # A worker died, start a new pool for the next requests and chunk these in place
+        logger.warning("Chunking pool broken, chunking in the request process")
+        with _chunking_pool_lock:
+            if _chunking_pool is pool:
+                _chunking_pool = None
+        return [chunk_document(doc, chunk_token_size) for doc in documents]
+
+
+async def embed_document_chunks(chunks: List[DocumentChunk]) -> List[DocumentChunk]:
+    """Embed the chunks together, in batches of EMBEDDING_BATCH_SIZE, and assign the float32 vectors back."""
+    embeddings = await aget_embeddings([chunk.text for chunk in chunks])
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk.embedding = embedding
+    return chunks
+
+
+async def get_document_chunks(
+    documents: List[Document], chunk_token_size: Optional[int]
+) -> Tuple[Dict[str, List[DocumentChunk]], List[Deduplication]]:
+    """Convert a list of documents into a dictionary from document id to list of document chunks.
+
+    The chunks of every document are embedded together afterwards, in batches of
+    EMBEDDING_BATCH_SIZE, instead of one SBERT call per chunk. With DEDUP_ENABLED,
+    near-duplicate documents and repeated chunks are dropped before embedding, the chunk
+    indexes stay contiguous over the kept chunks, and the deduplications to record
+    once the chunks are stored are returned with them. The
+    documents are cleaned and split in the chunking pool, see chunk_documents.
+    """
+    document_chunks: Dict[str, List[DocumentChunk]] = {}
+    deduplications: List[Deduplication] = []
+    # Every chunk of the request
+    all_chunks: List[DocumentChunk] = []
+    deduplicator = get_deduplicator()
+    loop = asyncio.get_running_loop()
+ 
+    for doc, (doc_id, metadata, records) in zip(documents, await chunk_documents(documents, chunk_token_size)):
+        if deduplicator is not None:
+            # The index lookups hit SQLite, keep them off the event loop
+            deduplication = await loop.run_in_executor(
+                None, deduplicator.deduplicate, doc_id, doc.text, [text for text, _ in records]
+            )
+            deduplications.append(deduplication)
+            kept = deduplication.kept
+        else:
+            kept = range(len(records))
+        chunk_metadata = DocumentChunkMetadata.construct(**metadata)
+        collection_name = doc.collection or MILVUS_COLLECTION
+        partition_name = doc.partition or PARTITION
+        # The records are already validated, build the models without validating them again
+        # The chunks are numbered among the kept ones, like the chunks inserted by process_json.py
+        doc_chunks = [
+            DocumentChunk.construct(
+                id=f"{doc_id}_{index}",
+                text=records[record][0],
                 collection=collection_name,
                 partition=partition_name,
                 metadata=chunk_metadata,
-                embedding=content_vector_element
-            )   
-
-            doc_chunks.append(doc_chunk)
-            
+                embedding=None,
+                chunk_hash=records[record][1],
+                chunk_index=index,
+            )
+            for index, record in enumerate(kept)
+        ]
         document_chunks[doc_id] = doc_chunks
+        all_chunks.extend(doc_chunks)
+
+    await embed_document_chunks(all_chunks)
+
+    return document_chunks, deduplications
+
+
+async def stream_document_chunks(
+    doc: Document,
+    doc_id: str,
+    chunk_metadata: DocumentChunkMetadata,
+    chunk_token_size: int,
+    batch_size: int = STREAMING_BATCH_SIZE,
+    segment_chars: int = STREAMING_SEGMENT_CHARS,
+) -> AsyncIterator[List[DocumentChunk]]:
+    """Yield the embedded chunks of a large document, batch_size chunks at a time.
 
+    Cleaning, splitting and embedding run lazily: the next batch is embedded while
+    the caller consumes the current one, so at most two batches and one segment of
+    cleaned text are held in memory whatever the document size.
+    """
+    chunks = iter_document_chunks(doc, doc_id, chunk_metadata, chunk_token_size, segment_chars)
+
+    def next_batch() -> Optional[asyncio.Future]:
+        batch = list(itertools.islice(chunks, batch_size))
+        return asyncio.ensure_future(embed_document_chunks(batch)) if batch else None
 
-    return document_chunks
+    pending = next_batch()
+    try:
+        while pending is not None:
+            batch = await pending
+            pending = next_batch()
+            yield batch
+    finally:
+        if pending is not None:
+            pending.cancel()
 
 
-def convertToVector(sentence, model, length):
+def convertToVector(sentence, model, length, model_name=None):
     # Truncate the sentence 
     sentence = sentence[:length]
 
-    # Generate the sentence embedding using SBERT
-    embedding = model.encode(sentence)
+    def encode(sentences):
+        # Generate the sentence embedding using SBERT
+        embedding = model.encode(sentences[0])
 
-    # Normalize the embeddings
-    embedding = embedding / np.linalg.norm(embedding)
+        # Normalize the embeddings
+        return [embedding / np.linalg.norm(embedding)]
 
-    return embedding.tolist()  
+    if model_name is None:
+        # Without the model name the embedding cannot be cached
+        return encode([sentence])[0].tolist()
+
+    return get_embedding_cache(model_name).get_or_compute([sentence], encode)[0].tolist()
 
 
 
@@ -297,6 +529,8 @@ class UnsupportedCollectionError(Exception):
         super().__init__(self.message)        
 
 def process_and_upload_documents_url(documents_url, collection, partition):
+    import requests
+
     errors = []
     if collection not in Collection.__members__:
         raise UnsupportedCollectionError("Unsupported Collection: " + str(collection))
@@ -367,7 +601,7 @@ def get_document_content(document_id: str) -> dict:
     document_text = json.dumps(document_content) if isinstance(document_content, dict) else document_content
 
     # Tokenize and count the tokens
-    tokens = tokenizer.encode(document_text)
+    tokens = get_tokenizer().encode(document_text)
     token_count = len(tokens)
     
     if token_count > MAX_TOKEN_COUNT:
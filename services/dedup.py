@@ -0,0 +1,266 @@
+"""
+Near-duplicate suppression at ingest.
+
+Every document and chunk gets a 64-bit SimHash of its 3-word shingles, texts without words
+get none and are never duplicates. Two texts are
+near-duplicates when their fingerprints differ in at most DEDUP_MAX_HAMMING bits. The
+fingerprints are kept in a persistent SQLite LSH index: each fingerprint is cut into
+DEDUP_MAX_HAMMING + 1 bands, and a near-duplicate shares at least one band with it
+(pigeonhole), so only the fingerprints of matching bands are compared.
+
+- A document that is a near-duplicate of another document (e.g. another arXiv version
+  of the same paper) is linked to it and none of its chunks are embedded.
+- A chunk that is a near-duplicate of an earlier chunk of the same document is skipped.
+  Chunks are not compared across documents: a chunk skipped for another document would
+  be lost from search once that document is deleted.
+
+deduplicate() only looks the fingerprints up, record() adds the document fingerprints
+once the kept chunks are stored, so a failed insert does not hide the document from its
+next upsert, and forget() drops them when the document is deleted.
+
+The stage is off unless DEDUP_ENABLED is set, stats() reports the vectors it saved.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+DEDUP_ENABLED = (os.environ.get("DEDUP_ENABLED") or "false").lower() == "true"
+DEDUP_INDEX_PATH = os.environ.get("DEDUP_INDEX_PATH") or "./data/dedup.sqlite"
+DEDUP_MAX_HAMMING = int(os.environ.get("DEDUP_MAX_HAMMING") or 3)  # Differing bits out of 64
+
+SHINGLE_WORDS = 3
+# Shingles whose bits are counted at a time
+_SHINGLE_BLOCK = 65536
+
+_WORD = re.compile(r"\w+")
+
+
+def simhash(text: str) -> Optional[int]:
+    """64-bit SimHash of the lowercased word shingles of text, None if text has no words."""
+    words = _WORD.findall(text.lower())
+    if not words:
+        # Every such text would get the same fingerprint
+        return None
+    if len(words) <= SHINGLE_WORDS:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+
+    # For every bit, the number of shingle hashes having it set
+    counts = np.zeros(64, dtype=np.int64)
+    for start in range(0, len(shingles), _SHINGLE_BLOCK):
+        digests = b"".join(
+            hashlib.blake2b(shingle.encode(), digest_size=8).digest()
+            for shingle in shingles[start:start + _SHINGLE_BLOCK]
+        )
+        bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+        counts += bits.sum(axis=0, dtype=np.int64)
+    fingerprint = np.packbits(counts * 2 > len(shingles), bitorder="little")
+    return int.from_bytes(fingerprint.tobytes(), "little")
+
+
+def _signed(value: int) -> int:
+    """value as a signed 64-bit integer, the SQLite INTEGER range."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class NearDuplicateIndex:
+    def __init__(self, path: str, max_hamming: int = DEDUP_MAX_HAMMING):
+        """Open (or create) a persistent SimHash LSH index.
+
+        Args:
+            path (str): The SQLite database file.
+            max_hamming (int, optional): Maximum number of differing bits of near-duplicates.
+                                         Defaults to DEDUP_MAX_HAMMING.
+        """
+        self.max_hamming = max_hamming
+        self._bands = max_hamming + 1
+        self._band_bits = 64 // self._bands
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    id INTEGER PRIMARY KEY, kind TEXT, fingerprint INTEGER, document_id TEXT
+                );
+                CREATE TABLE IF NOT EXISTS bands (kind TEXT, band INTEGER, value INTEGER, fingerprint_id INTEGER);
+                CREATE INDEX IF NOT EXISTS bands_lookup ON bands (kind, band, value);
+                CREATE TABLE IF NOT EXISTS links (document_id TEXT PRIMARY KEY, duplicate_of TEXT);
+                """
+            )
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('bands', ?)", (str(self._bands),))
+        stored_bands = int(self._db.execute("SELECT value FROM meta WHERE key = 'bands'").fetchone()[0])
+        if stored_bands != self._bands:
+            raise ValueError(
+                f"The index at {path} was built for a maximum Hamming distance of {stored_bands - 1}, not {max_hamming}"
+            )
+
+    def _band_values(self, fingerprint: int) -> List[int]:
+        mask = (1 << self._band_bits) - 1
+        values = [(fingerprint >> (band * self._band_bits)) & mask for band in range(self._bands - 1)]
+        # The last band takes the remaining bits
+        values.append(fingerprint >> ((self._bands - 1) * self._band_bits))
+        return [_signed(value) for value in values]
+
+    def matches(self, kind: str, fingerprint: int) -> Set[str]:
+        """The document ids of the near-duplicates of fingerprint."""
+        clauses = " OR ".join("(b.band = ? AND b.value = ?)" for _ in range(self._bands))
+        parameters: List = [kind]
+        for band, value in enumerate(self._band_values(fingerprint)):
+            parameters += [band, value]
+        with self._lock:
+            candidates = self._db.execute(
+                f"SELECT f.fingerprint, f.document_id FROM bands b JOIN fingerprints f ON f.id = b.fingerprint_id "
+                f"WHERE b.kind = ? AND ({clauses})",
+                parameters,
+            ).fetchall()
+        return {
+            document_id for candidate, document_id in candidates
+            if bin((candidate & ((1 << 64) - 1)) ^ fingerprint).count("1") <= self.max_hamming
+        }
+
+    def find(self, kind: str, fingerprint: int, exclude_document_id: Optional[str] = None) -> Optional[str]:
+        """The document id of a near-duplicate of fingerprint, None if there is none."""
+        for document_id in self.matches(kind, fingerprint):
+            if document_id != exclude_document_id:
+                return document_id
+        return None
+
+    def add(self, fingerprints: Iterable[Tuple[str, int, str]], links: Iterable[Tuple[str, str]] = ()) -> None:
+        """Add the (kind, fingerprint, document id) fingerprints and (document id, duplicate of) links at once."""
+        with self._lock, self._db:
+            for kind, fingerprint, document_id in fingerprints:
+                cursor = self._db.execute(
+                    "INSERT INTO fingerprints (kind, fingerprint, document_id) VALUES (?, ?, ?)",
+                    (kind, _signed(fingerprint), document_id),
+                )
+                self._db.executemany(
+                    "INSERT INTO bands VALUES (?, ?, ?, ?)",
+                    [(kind, band, value, cursor.lastrowid) for band, value in enumerate(self._band_values(fingerprint))],
+                )
+            self._db.executemany("INSERT OR REPLACE INTO links VALUES (?, ?)", list(links))
+
+    def remove_documents(self, document_ids: Sequence[str]) -> None:
+        """Drop the fingerprints of the documents and the links from and to them."""
+        with self._lock, self._db:
+            for document_id in document_ids:
+                self._db.execute(
+                    "DELETE FROM bands WHERE fingerprint_id IN (SELECT id FROM fingerprints WHERE document_id = ?)",
+                    (document_id,),
+                )
+                self._db.execute("DELETE FROM fingerprints WHERE document_id = ?", (document_id,))
+                self._db.execute("DELETE FROM links WHERE document_id = ? OR duplicate_of = ?", (document_id, document_id))
+
+    def duplicate_of(self, document_id: str) -> Optional[str]:
+        """The document a document was found to duplicate."""
+        with self._lock:
+            row = self._db.execute("SELECT duplicate_of FROM links WHERE document_id = ?", (document_id,)).fetchone()
+        return row[0] if row else None
+
+
+class Deduplication(NamedTuple):
+    """The chunks of a document to store, and the fingerprints to record once they are stored."""
+    document_id: str
+    kept: List[int]
+    duplicate_of: Optional[str]
+    # (kind, fingerprint) pairs not in the index yet
+    fingerprints: List[Tuple[str, int]]
+
+
+class Deduplicator:
+    def __init__(self, index_path: str = DEDUP_INDEX_PATH, max_hamming: int = DEDUP_MAX_HAMMING):
+        self.index = NearDuplicateIndex(index_path, max_hamming)
+        self._stats_lock = threading.Lock()
+        self.documents = 0
+        self.documents_skipped = 0
+        self.chunks = 0
+        self.chunks_skipped = 0
+
+    def deduplicate(self, document_id: str, text: str, chunk_texts: Sequence[str]) -> Deduplication:
+        """Look a document and its chunks up, without indexing them, see record().
+
+        No chunk is kept when the document is a near-duplicate of another document. The
+        fingerprints of the document itself are ignored, it is being upserted again. The
+        chunks are only compared with the earlier chunks of the document.
+        """
+        fingerprint = simhash(text)
+        duplicate_of = None
+        fingerprints: List[Tuple[str, int]] = []
+        if fingerprint is not None:
+            duplicate_of = self.index.find("document", fingerprint, exclude_document_id=document_id)
+            if duplicate_of is None and document_id not in self.index.matches("document", fingerprint):
+                fingerprints.append(("document", fingerprint))
+        kept: List[int] = []
+        if duplicate_of is None:
+            # The fingerprints of the chunks kept so far, to skip the repeated chunks of this document
+            seen = NearDuplicateIndex(":memory:", self.index.max_hamming)
+            for i, chunk_text in enumerate(chunk_texts):
+                chunk_fingerprint = simhash(chunk_text)
+                if chunk_fingerprint is not None:
+                    if seen.find("chunk", chunk_fingerprint) is not None:
+                        continue
+                    seen.add([("chunk", chunk_fingerprint, document_id)])
+                kept.append(i)
+
+        with self._stats_lock:
+            self.documents += 1
+            self.documents_skipped += duplicate_of is not None
+            self.chunks += len(chunk_texts)
+            self.chunks_skipped += len(chunk_texts) - len(kept)
+        return Deduplication(document_id, kept, duplicate_of, fingerprints)
+
+    def record(self, deduplications: Sequence[Deduplication]) -> None:
+        """Index the documents of deduplications, once their chunks are stored, in one transaction."""
+        self.index.add(
+            [
+                (kind, fingerprint, deduplication.document_id)
+                for deduplication in deduplications
+                for kind, fingerprint in deduplication.fingerprints
+            ],
+            [
+                (deduplication.document_id, deduplication.duplicate_of)
+                for deduplication in deduplications
+                if deduplication.duplicate_of is not None
+            ],
+        )
+
+    def forget(self, document_ids: Sequence[str]) -> None:
+        """Drop the fingerprints and links of deleted documents."""
+        self.index.remove_documents(document_ids)
+
+    def stats(self) -> Dict[str, int]:
+        """Documents and chunks seen and skipped, vectors_saved counts the chunks not embedded."""
+        with self._stats_lock:
+            return {
+                "documents": self.documents,
+                "documents_skipped": self.documents_skipped,
+                "chunks": self.chunks,
+                "chunks_skipped": self.chunks_skipped,
+                "vectors_saved": self.chunks_skipped,
+            }
+
+
+_deduplicator: Optional[Deduplicator] = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator() -> Optional[Deduplicator]:
+    """The process-wide deduplicator, None unless DEDUP_ENABLED."""
+    global _deduplicator
+    if not DEDUP_ENABLED:
+        return None
+    with _deduplicator_lock:
+        if _deduplicator is None:
+            _deduplicator = Deduplicator()
+        return _deduplicator
@@ -0,0 +1,303 @@
+"""
+Embedding backends.
+
+EMBEDDING_BACKEND selects how the SBERT model runs:
+
+- "sentence-transformers": the reference PyTorch implementation.
+- "onnx": the transformer exported to ONNX and run with ONNX Runtime on CPU.
+- "onnx-int8": the ONNX export with dynamically int8-quantized weights.
+
+The ONNX files are exported once into EMBEDDING_ONNX_DIR (this step needs
+sentence-transformers and torch); afterwards only onnxruntime and the tokenizer are
+loaded. The processes sharing the directory take turns through an fcntl lock per model,
+so a single one exports while the others wait for its files.
+
+Inputs are scheduled by token length: they are sorted, grouped into buckets of at
+most EMBEDDING_BATCH_TOKENS padded tokens (and at most batch_size texts), encoded
+bucket by bucket and put back in their original order, so short chunks and queries
+are not padded to the longest text of a mixed batch. stats() reports tokens/sec and
+the padding ratio.
+
+check_parity() reports the cosine drift of a backend against the reference,
+use it (or scripts/embedding_parity) before switching an index to another backend.
+"""
+
+import fcntl
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND") or "sentence-transformers"
+EMBEDDING_ONNX_DIR = os.environ.get("EMBEDDING_ONNX_DIR") or "./data/onnx"
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS") or 16384)  # Padded tokens per forward pass
+
+EMBEDDING_BACKENDS = ("sentence-transformers", "onnx", "onnx-int8")
+# Exports of an older version are exported again, version 1 named the inputs in tokenizer order
+ONNX_EXPORT_VERSION = 2
+
+
+class Embedder(ABC):
+    """Turns texts into normalized float32 embeddings."""
+
+    backend: str
+    tokenizer = None
+    max_seq_length = 512
+
+    def __init__(self, model_name: str, batch_tokens: int = EMBEDDING_BATCH_TOKENS):
+        self.model_name = model_name
+        self.batch_tokens = batch_tokens
+        self._stats_lock = threading.Lock()
+        self.texts = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.unbucketed_padded_tokens = 0
+        self.seconds = 0.0
+
+    @abstractmethod
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """Raw (not normalized) embeddings of texts, encoded as one batch."""
+        raise NotImplementedError
+
+    def _token_lengths(self, texts: List[str]) -> np.ndarray:
+        """Number of tokens of each text after truncation."""
+        if self.tokenizer is None:
+            return np.array([len(text) for text in texts])
+        input_ids = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)["input_ids"]
+        return np.array([len(ids) for ids in input_ids])
+
+    def _buckets(self, lengths: np.ndarray, batch_size: int) -> List[np.ndarray]:
+        """Group text indices, longest first, into buckets of at most batch_tokens padded tokens."""
+        order = np.argsort(-lengths, kind="stable")
+        buckets = []
+        start = 0
+        while start < len(order):
+            # The first text of a bucket is its longest, every text is padded to it
+            longest = max(int(lengths[order[start]]), 1)
+            size = min(batch_size, max(1, self.batch_tokens // longest), len(order) - start)
+            buckets.append(order[start:start + size])
+            start += size
+        return buckets
+
+    def encode(self, texts: Sequence[str], batch_size: int) -> np.ndarray:
+        """Normalized float32 embeddings of texts, one row per text."""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        started = time.perf_counter()
+        lengths = self._token_lengths(texts)
+        embeddings = None
+        padded_tokens = 0
+        for bucket in self._buckets(lengths, batch_size):
+            bucket_embeddings = np.asarray(self._encode([texts[i] for i in bucket], len(bucket)), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), bucket_embeddings.shape[1]), dtype=np.float32)
+            # Back to the original order
+            embeddings[bucket] = bucket_embeddings
+            padded_tokens += len(bucket) * int(lengths[bucket].max())
+        elapsed = time.perf_counter() - started
+
+        # What fixed batch_size batches in input order would have been padded to
+        unbucketed = sum(
+            len(lengths[i:i + batch_size]) * int(lengths[i:i + batch_size].max())
+            for i in range(0, len(lengths), batch_size)
+        )
+        with self._stats_lock:
+            self.texts += len(texts)
+            self.tokens += int(lengths.sum())
+            self.padded_tokens += padded_tokens
+            self.unbucketed_padded_tokens += unbucketed
+            self.seconds += elapsed
+
+        return embeddings / np.linalg.norm(embeddings, axis=1)[:, None]
+
+    def stats(self) -> Dict[str, float]:
+        """Throughput and padding of the texts encoded so far."""
+        with self._stats_lock:
+            return {
+                "texts": self.texts,
+                "tokens": self.tokens,
+                "tokens_per_second": self.tokens / self.seconds if self.seconds else 0.0,
+                "padding_ratio": 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0,
+                "unbucketed_padding_ratio": (
+                    1 - self.tokens / self.unbucketed_padded_tokens if self.unbucketed_padded_tokens else 0.0
+                ),
+            }
+
+
+class SentenceTransformerEmbedder(Embedder):
+    backend = "sentence-transformers"
+
+    def __init__(self, model_name: str):
+        super().__init__(model_name)
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size)
+
+
+def export_onnx(model_name: str, model_dir: str) -> None:
+    """Export the transformer, tokenizer and pooling settings of a sentence-transformers model."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model
+    pooling_mode = "mean"
+    for module in model:
+        if hasattr(module, "get_pooling_mode_str"):
+            pooling_mode = module.get_pooling_mode_str()
+
+    os.makedirs(model_dir, exist_ok=True)
+    # embedder.json marks a complete export, it is written last
+    config_path = os.path.join(model_dir, "embedder.json")
+    if os.path.exists(config_path):
+        os.remove(config_path)
+    model.tokenizer.save_pretrained(model_dir)
+
+    tokens = model.tokenizer(["Export the embedding model"], return_tensors="pt")
+    # The exporter binds the inputs in the order of the forward() parameters, name them in that order
+    input_names = [name for name in inspect.signature(transformer.forward).parameters if name in tokens]
+    inputs = {name: tokens[name] for name in input_names}
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    transformer.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            (inputs,),
+            os.path.join(model_dir, "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    # Derived from the previous export
+    quantized_path = os.path.join(model_dir, QuantizedOnnxEmbedder.model_file)
+    if os.path.exists(quantized_path):
+        os.remove(quantized_path)
+    with open(config_path, "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "pooling": pooling_mode,
+            "max_seq_length": model.max_seq_length,
+            "export_version": ONNX_EXPORT_VERSION,
+        }, f)
+
+
+class OnnxEmbedder(Embedder):
+    backend = "onnx"
+    model_file = "model.onnx"
+
+    def __init__(self, model_name: str, onnx_dir: str = EMBEDDING_ONNX_DIR):
+        super().__init__(model_name)
+        self.model_dir = os.path.join(onnx_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        os.makedirs(onnx_dir, exist_ok=True)
+        with open(self.model_dir + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not self._exported():
+                    export_onnx(model_name, self.model_dir)
+                self._prepare()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(self.model_dir, "embedder.json")) as f:
+            config = json.load(f)
+        self.pooling = config["pooling"]
+        self.max_seq_length = config["max_seq_length"]
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        options = onnxruntime.SessionOptions()
+        # Set by the embedding executor for process pool workers, 0 lets onnxruntime use every core
+        options.intra_op_num_threads = int(os.environ.get("EMBEDDING_INTRA_OP_THREADS") or 0)
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(self.model_dir, self.model_file), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def _exported(self) -> bool:
+        """Whether the model was exported, by the current export version."""
+        config_path = os.path.join(self.model_dir, "embedder.json")
+        if not os.path.exists(os.path.join(self.model_dir, "model.onnx")) or not os.path.exists(config_path):
+            return False
+        with open(config_path) as f:
+            return json.load(f).get("export_version") == ONNX_EXPORT_VERSION
+
+    def _prepare(self) -> None:
+        """Create the model file of this backend from the exported model, under the export lock."""
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        tokens = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        feed = {name: tokens[name].astype(np.int64) for name in self.input_names}
+        hidden = self.session.run(None, feed)[0]
+        mask = tokens["attention_mask"][:, :, None].astype(np.float32)
+        if self.pooling == "cls":
+            return hidden[:, 0]
+        elif self.pooling == "max":
+            return np.where(mask > 0, hidden, -1e9).max(axis=1)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+class QuantizedOnnxEmbedder(OnnxEmbedder):
+    backend = "onnx-int8"
+    model_file = "model-int8.onnx"
+
+    def _prepare(self) -> None:
+        quantized_path = os.path.join(self.model_dir, self.model_file)
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            # Renamed into place, an interrupted quantization leaves no model file behind
+            partial_path = os.path.join(self.model_dir, "model-int8.partial.onnx")
+            quantize_dynamic(os.path.join(self.model_dir, "model.onnx"), partial_path, weight_type=QuantType.QInt8)
+            os.replace(partial_path, quantized_path)
+
+
+def get_embedder(model_name: str, backend: str = EMBEDDING_BACKEND) -> Embedder:
+    """Create the embedder of model_name for backend."""
+    if backend == "sentence-transformers":
+        return SentenceTransformerEmbedder(model_name)
+    elif backend == "onnx":
+        return OnnxEmbedder(model_name)
+    elif backend == "onnx-int8":
+        return QuantizedOnnxEmbedder(model_name)
+    else:
+        raise ValueError(f"Unsupported embedding backend: {backend}")
+
+
+def embedder_id(model_name: str, backend: str = EMBEDDING_BACKEND) -> str:
+    """Name of the embeddings of model_name computed by backend, e.g. for cache keys."""
+    return model_name if backend == "sentence-transformers" else f"{model_name}@{backend}"
+
+
+def check_parity(reference: Embedder, candidate: Embedder, texts: Sequence[str], batch_size: int = 32) -> Dict[str, float]:
+    """Cosine drift (1 - cosine similarity) of the candidate embeddings against the reference ones."""
+    expected = reference.encode(texts, batch_size)
+    actual = candidate.encode(texts, batch_size)
+    drift = 1.0 - np.sum(expected * actual, axis=1)
+    return {
+        "texts": len(texts),
+        "mean_drift": float(drift.mean()),
+        "p99_drift": float(np.quantile(drift, 0.99)),
+        "max_drift": float(drift.max()),
+        "min_cosine": float(1.0 - drift.max()),
+    }
@@ -0,0 +1,321 @@
+"""
+Content-addressed cache for sentence embeddings.
+
+Embeddings are keyed by a hash of (model name, text), where text is the already
+truncated input of the model. The cache has two tiers:
+
+- an in-process LRU of at most EMBEDDING_CACHE_SIZE vectors;
+- an optional on-disk tier in EMBEDDING_CACHE_DIR, shared by every process using the
+  same directory. Vectors are appended to float32 shard files that are read through
+  numpy memory maps, and an append-only index file maps each key to (shard, row).
+  Writers serialize through an fcntl lock; readers only ever see complete records
+  because a vector is written before its index entry. A writer cut short leaves a
+  partial record behind, the next writer truncates the files to whole records first.
+
+The tiers have separate locks so that memory lookups never wait for disk I/O;
+aget_or_compute looks up the memory tier on the event loop and runs the disk tier in
+the default executor.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE") or 10000)  # Vectors kept in memory, 0 disables
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")  # Disk tier location, unset disables
+EMBEDDING_CACHE_SHARD_ROWS = int(os.environ.get("EMBEDDING_CACHE_SHARD_ROWS") or 65536)  # Vectors per shard file
+
+KEY_SIZE = 16  # Bytes of the blake2b digest used as key
+INDEX_RECORD = np.dtype([("key", f"S{KEY_SIZE}"), ("shard", "<u4"), ("row", "<u4")])
+
+
+def embedding_key(model_name: str, text: str) -> bytes:
+    """Content address of the embedding of text by model_name."""
+    return hashlib.blake2b(f"{model_name}\0{text}".encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+
+class _DiskTier:
+    """Memory-mapped float32 shards plus an append-only hash index in one directory."""
+
+    def __init__(self, path: str, shard_rows: int):
+        self.path = path
+        self.shard_rows = shard_rows
+        self.dim: Optional[int] = None
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._index_offset = 0  # Bytes of the index file already read
+        self._maps: Dict[int, np.memmap] = {}
+        os.makedirs(path, exist_ok=True)
+        self._lock_path = os.path.join(path, "lock")
+        self._index_path = os.path.join(path, "index.bin")
+        self._dim_path = os.path.join(path, "dim")
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.path, "shard-{:05d}.f32".format(shard))
+
+    def _refresh(self) -> None:
+        """Read the index records appended since the last refresh, by this or other processes."""
+        if self.dim is None:
+            if not os.path.exists(self._dim_path):
+                return
+            with open(self._dim_path) as f:
+                self.dim = int(f.read())
+        try:
+            with open(self._index_path, "rb") as f:
+                f.seek(self._index_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A record still being written is picked up by a later refresh
+        complete = len(data) - len(data) % INDEX_RECORD.itemsize
+        if complete == 0:
+            return
+        records = np.frombuffer(data[:complete], dtype=INDEX_RECORD)
+        for key, shard, row in zip(records["key"].tolist(), records["shard"].tolist(), records["row"].tolist()):
+            self._index[key] = (shard, row)
+        self._index_offset += complete
+
+    def _vector(self, shard: int, row: int) -> Optional[np.ndarray]:
+        mapped = self._maps.get(shard)
+        if mapped is None or row >= mapped.shape[0]:
+            # The shard grew since it was mapped, map it again
+            rows = os.path.getsize(self._shard_path(shard)) // (self.dim * 4)
+            if row >= rows:
+                return None
+            mapped = np.memmap(self._shard_path(shard), dtype=np.float32, mode="r", shape=(rows, self.dim))
+            self._maps[shard] = mapped
+        return np.array(mapped[row])
+
+    def get(self, keys: Sequence[bytes]) -> List[Optional[np.ndarray]]:
+        if any(key not in self._index for key in keys):
+            self._refresh()
+        results: List[Optional[np.ndarray]] = []
+        for key in keys:
+            location = self._index.get(key)
+            results.append(None if location is None else self._vector(*location))
+        return results
+
+    def put(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.dim is None and not os.path.exists(self._dim_path):
+                    with open(self._dim_path, "w") as f:
+                        f.write(str(vectors.shape[1]))
+                self._refresh()
+                if self.dim != vectors.shape[1]:
+                    return
+
+                # Skip what another process stored in the meantime
+                new = [i for i, key in enumerate(keys) if key not in self._index]
+                shard = 0
+                while os.path.exists(self._shard_path(shard + 1)):
+                    shard += 1
+                rows = self._truncate(self._shard_path(shard), self.dim * 4)
+                self._truncate(self._index_path, INDEX_RECORD.itemsize)
+
+                records = np.zeros(len(new), dtype=INDEX_RECORD)
+                start = 0
+                while start < len(new):
+                    if rows >= self.shard_rows:
+                        shard += 1
+                        rows = 0
+                    take = new[start:start + self.shard_rows - rows]
+                    with open(self._shard_path(shard), "ab") as f:
+                        f.write(np.ascontiguousarray(vectors[take], dtype=np.float32).tobytes())
+                    for j, i in enumerate(take):
+                        records[start + j] = (keys[i], shard, rows + j)
+                    rows += len(take)
+                    start += len(take)
+
+                # Index entries go last so readers never see a vector that is not written yet
+                with open(self._index_path, "ab") as f:
+                    f.write(records.tobytes())
+                self._refresh()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def _truncate(path: str, record_size: int) -> int:
+        """Drop the partial record a writer cut short left at the end of path, return the number of records."""
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+        if size % record_size:
+            os.truncate(path, size - size % record_size)
+        return size // record_size
+
+
+class EmbeddingCache:
+    """Two-tier (memory LRU, then disk) cache of normalized embeddings for one model."""
+
+    def __init__(
+        self,
+        model_name: str,
+        max_items: int = EMBEDDING_CACHE_SIZE,
+        cache_dir: Optional[str] = EMBEDDING_CACHE_DIR,
+        shard_rows: int = EMBEDDING_CACHE_SHARD_ROWS,
+    ):
+        self.model_name = model_name
+        self.max_items = max_items
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._disk: Optional[_DiskTier] = None
+        if cache_dir:
+            model_dir = hashlib.blake2b(model_name.encode("utf-8"), digest_size=8).hexdigest()
+            self._disk = _DiskTier(os.path.join(cache_dir, model_dir), shard_rows)
+        self._lock = threading.Lock()  # Memory tier and counters
+        self._disk_lock = threading.Lock()  # Disk tier, held during its file I/O
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        if self.max_items <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, keys: Sequence[bytes]) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """Embeddings of keys found in the memory tier, and the positions of the other keys."""
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing.append(i)
+                else:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                    self.hits_memory += 1
+        return results, missing
+
+    def _get_disk(self, keys: Sequence[bytes], results: List[Optional[np.ndarray]], missing: List[int]) -> List[int]:
+        """Fill results with the embeddings of the missing keys found on disk, return the positions still missing."""
+        if missing and self._disk is not None:
+            with self._disk_lock:
+                vectors = self._disk.get([keys[i] for i in missing])
+            still_missing = []
+            with self._lock:
+                for i, vector in zip(missing, vectors):
+                    if vector is None:
+                        still_missing.append(i)
+                    else:
+                        results[i] = vector
+                        self._remember(keys[i], vector)
+                        self.hits_disk += 1
+            missing = still_missing
+        with self._lock:
+            self.misses += len(missing)
+        return missing
+
+    def _put_memory(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                # A row of vectors would keep the whole batch alive
+                self._remember(key, vector.copy())
+
+    def _put_disk(self, keys: Sequence[bytes], vectors: np.ndarray) -> None:
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.put(keys, vectors)
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Cached embeddings of texts, None where the text is not cached."""
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        results, missing = self._get_memory(keys)
+        self._get_disk(keys, results, missing)
+        return results
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]]) -> None:
+        """Store the embeddings of texts in both tiers."""
+        if len(texts) == 0:
+            return
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        self._put_memory(keys, vectors)
+        self._put_disk(keys, vectors)
+
+    @staticmethod
+    def _stack(
+        texts: Sequence[str],
+        cached: List[Optional[np.ndarray]],
+        missing: List[str],
+        computed: np.ndarray,
+    ) -> np.ndarray:
+        """Stack the computed embeddings with the cached ones in the order of texts."""
+        if missing:
+            by_text = dict(zip(missing, computed))
+            cached = [by_text[text] if vector is None else vector for text, vector in zip(texts, cached)]
+        if not cached:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(cached)
+
+    def get_or_compute(
+        self, texts: Sequence[str], compute: Callable[[List[str]], Sequence[Sequence[float]]]
+    ) -> np.ndarray:
+        """Embeddings of texts, calling compute once for the distinct texts that are not cached."""
+        cached = self.get_many(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+        computed = np.asarray(compute(missing) if missing else [], dtype=np.float32)
+        if missing:
+            self.put_many(missing, computed)
+        return self._stack(texts, cached, missing, computed)
+
+    async def aget_or_compute(
+        self, texts: Sequence[str], compute: Callable[[List[str]], Awaitable[Sequence[Sequence[float]]]]
+    ) -> np.ndarray:
+        """Like get_or_compute, awaiting compute.
+
+        Only the memory tier is used on the event loop: the shard reads and the locked
+        appends of the disk tier run in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        cached, missing_positions = self._get_memory(keys)
+        if missing_positions and self._disk is not None:
+            missing_positions = await loop.run_in_executor(None, self._get_disk, keys, cached, missing_positions)
+        else:
+            self._get_disk(keys, cached, missing_positions)
+        missing = list(dict.fromkeys(texts[i] for i in missing_positions))
+        computed = np.asarray(await compute(missing) if missing else [], dtype=np.float32)
+        if missing:
+            missing_keys = [embedding_key(self.model_name, text) for text in missing]
+            self._put_memory(missing_keys, computed)
+            if self._disk is not None:
+                await loop.run_in_executor(None, self._put_disk, missing_keys, computed)
+        return self._stack(texts, cached, missing, computed)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit and miss counters of the cache."""
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+            "disk_items": len(self._disk) if self._disk is not None else 0,
+        }
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache(model_name: str) -> EmbeddingCache:
+    """The process-wide cache of model_name."""
+    cache = _caches.get(model_name)
+    if cache is None:
+        cache = _caches.setdefault(model_name, EmbeddingCache(model_name))
+    return cache
@@ -0,0 +1,231 @@
+"""
+Embedding executor: runs SBERT encoding off the asyncio event loop.
+
+The executor owns the embedder (see services/embedders.py) and a pool of workers:
+
+- "thread" (default): a thread pool sharing one embedder. torch and onnxruntime release the GIL
+  while encoding, so the event loop keeps serving requests.
+- "process": a pool of spawned processes (forking a process that already runs torch
+  threads can deadlock the child) where every worker loads its own embedder. The CPU
+  cores are split between the workers, each one limits torch/onnxruntime to its share
+  of intra-op threads.
+
+The embedder is only loaded on first use, or by warm_up(). embed() is the awaitable
+API used by the async datastore code, encode() the blocking one. At most EMBEDDING_EXECUTOR_QUEUE_DEPTH embed() calls are queued or running at a
+time, further callers wait for a free slot.
+
+Queries must not wait behind the ingestion of large upserts: embed() calls are split into
+jobs of at most EMBEDDING_EXECUTOR_JOB_SIZE texts, the pool is given at most one job per
+worker, and the next job is taken from the queries (PRIORITY_QUERY) before the ingestion
+(PRIORITY_INGEST). A query therefore waits for at most one job per worker, however much is
+being ingested. Queries do not take queue depth slots.
+"""
+
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services.embedders import EMBEDDING_BACKEND, Embedder, get_embedder
+
+
+EMBEDDING_EXECUTOR = os.environ.get("EMBEDDING_EXECUTOR") or "thread"  # "thread" or "process"
+EMBEDDING_EXECUTOR_WORKERS = int(os.environ.get("EMBEDDING_EXECUTOR_WORKERS") or 1)
+EMBEDDING_EXECUTOR_QUEUE_DEPTH = int(os.environ.get("EMBEDDING_EXECUTOR_QUEUE_DEPTH") or 64)
+EMBEDDING_EXECUTOR_JOB_SIZE = int(os.environ.get("EMBEDDING_EXECUTOR_JOB_SIZE") or 256)  # Texts per pool job
+
+# Jobs of lower priority values run first
+PRIORITY_QUERY = 0
+PRIORITY_INGEST = 1
+
+WARM_UP_TIMEOUT = 600  # Seconds the process workers wait for each other to be warmed up
+
+# The embedder of a process pool worker
+_worker_embedder: Optional[Embedder] = None
+
+
+def _init_process_worker(model_name: str, backend: str, threads: int) -> None:
+    global _worker_embedder
+    # Do not oversubscribe the cores shared with the other workers
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["EMBEDDING_INTRA_OP_THREADS"] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_embedder = get_embedder(model_name, backend)
+
+
+def _process_encode(texts: Sequence[str], batch_size: int) -> np.ndarray:
+    return _worker_embedder.encode(texts, batch_size)
+
+
+def _process_warm_up(barrier: Any) -> None:
+    _worker_embedder.encode(["warm up"], 1)
+    # Hold this worker until every worker has taken a warm-up task, so that none takes two
+    barrier.wait()
+
+
+class EmbeddingExecutor:
+    def __init__(
+        self,
+        model_name: str,
+        backend: str = EMBEDDING_BACKEND,
+        kind: str = EMBEDDING_EXECUTOR,
+        max_workers: int = EMBEDDING_EXECUTOR_WORKERS,
+        queue_depth: int = EMBEDDING_EXECUTOR_QUEUE_DEPTH,
+        job_size: int = EMBEDDING_EXECUTOR_JOB_SIZE,
+    ):
+        """Create an embedding executor.
+
+        Args:
+            model_name (str): The sentence-transformers model to load.
+            backend (str, optional): The embedding backend running it. Defaults to EMBEDDING_BACKEND.
+            kind (str, optional): "thread" or "process" pool. Defaults to EMBEDDING_EXECUTOR.
+            max_workers (int, optional): Number of pool workers. Defaults to EMBEDDING_EXECUTOR_WORKERS.
+            queue_depth (int, optional): Maximum number of embed() calls in flight.
+                                         Defaults to EMBEDDING_EXECUTOR_QUEUE_DEPTH.
+            job_size (int, optional): Maximum number of texts of a pool job. Defaults to EMBEDDING_EXECUTOR_JOB_SIZE.
+        """
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unsupported embedding executor: {kind}")
+        self.model_name = model_name
+        self.backend = backend
+        self.kind = kind
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.job_size = job_size
+        self._embedder: Optional[Embedder] = None
+        self._embedder_lock = threading.Lock()
+        self._pool: Executor
+        self._mp_context = multiprocessing.get_context("spawn")
+        if kind == "process":
+            self._pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=self._mp_context,
+                initializer=_init_process_worker,
+                initargs=(model_name, backend, max(1, (os.cpu_count() or 1) // max_workers)),
+            )
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+        # Queue depth limit, created for the running event loop
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+        # (priority, sequence, texts, batch size, future) of the jobs waiting for a worker, and the jobs running
+        self._jobs: List[Tuple[int, int, Sequence[str], int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._running = 0
+
+    def _get_embedder(self) -> Embedder:
+        if self._embedder is None:
+            with self._embedder_lock:
+                if self._embedder is None:
+                    self._embedder = get_embedder(self.model_name, self.backend)
+        return self._embedder
+
+    def _thread_encode(self, texts: Sequence[str], batch_size: int) -> np.ndarray:
+        return self._get_embedder().encode(texts, batch_size)
+
+    def _submit(self, texts: Sequence[str], batch_size: int):
+        if self.kind == "process":
+            return self._pool.submit(_process_encode, list(texts), batch_size)
+        return self._pool.submit(self._thread_encode, texts, batch_size)
+
+    def encode(self, texts: Sequence[str], batch_size: int) -> np.ndarray:
+        """Embed texts, blocking the calling thread until the pool is done."""
+        return self._submit(texts, batch_size).result()
+
+    async def embed(self, texts: Sequence[str], batch_size: int, priority: int = PRIORITY_INGEST) -> np.ndarray:
+        """Embed texts in the pool without blocking the event loop, in jobs of at most job_size texts."""
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.queue_depth)
+            self._slots_loop = loop
+            self._jobs = []
+            self._running = 0
+        if priority == PRIORITY_QUERY:
+            return await self._embed_jobs(loop, texts, batch_size, priority)
+        async with self._slots:
+            return await self._embed_jobs(loop, texts, batch_size, priority)
+
+    async def _embed_jobs(
+        self, loop: asyncio.AbstractEventLoop, texts: Sequence[str], batch_size: int, priority: int
+    ) -> np.ndarray:
+        embeddings = await asyncio.gather(*[
+            self._schedule(loop, texts[start:start + self.job_size], batch_size, priority)
+            for start in range(0, max(len(texts), 1), self.job_size)
+        ])
+        return embeddings[0] if len(embeddings) == 1 else np.concatenate(embeddings)
+
+    def _schedule(
+        self, loop: asyncio.AbstractEventLoop, texts: Sequence[str], batch_size: int, priority: int
+    ) -> asyncio.Future:
+        future = loop.create_future()
+        heapq.heappush(self._jobs, (priority, next(self._sequence), texts, batch_size, future))
+        self._dispatch()
+        return future
+
+    def _dispatch(self) -> None:
+        """Hand the most urgent waiting jobs to the idle workers."""
+        while self._jobs and self._running < self.max_workers:
+            _, _, texts, batch_size, future = heapq.heappop(self._jobs)
+            if future.done():
+                # Cancelled while waiting
+                continue
+            self._running += 1
+            running = asyncio.wrap_future(self._submit(texts, batch_size))
+            running.add_done_callback(lambda running, future=future: self._job_done(running, future))
+
+    def _job_done(self, running: asyncio.Future, future: asyncio.Future) -> None:
+        self._running -= 1
+        if not future.done():
+            if running.cancelled():
+                future.cancel()
+            elif running.exception() is not None:
+                future.set_exception(running.exception())
+            else:
+                future.set_result(running.result())
+        self._dispatch()
+
+    def warm_up(self) -> None:
+        """Load the embedder of every worker and run a first forward pass.
+
+        Process pools start their workers on demand and any idle worker takes the next
+        task, so the warm-up tasks block on a barrier until there is one per worker.
+        """
+        if self.kind != "process":
+            self._submit(["warm up"], 1).result()
+            return
+        with self._mp_context.Manager() as manager:
+            barrier = manager.Barrier(self.max_workers, timeout=WARM_UP_TIMEOUT)
+            for future in [self._pool.submit(_process_warm_up, barrier) for _ in range(self.max_workers)]:
+                future.result()
+
+    def stats(self) -> Dict[str, float]:
+        """Throughput and padding metrics of the embedder, only available for the thread pool."""
+        if self._embedder is None:
+            return {}
+        return self._embedder.stats()
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_executors: Dict[Tuple[str, str], EmbeddingExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_embedding_executor(model_name: str, backend: str = EMBEDDING_BACKEND) -> EmbeddingExecutor:
+    """The process-wide embedding executor of model_name on backend."""
+    with _executors_lock:
+        executor = _executors.get((model_name, backend))
+        if executor is None:
+            executor = _executors[(model_name, backend)] = EmbeddingExecutor(model_name, backend)
+        return executor
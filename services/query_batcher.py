@@ -0,0 +1,124 @@
+"""
+Cross-request micro-batching of query embeddings.
+
+Concurrent /query requests each embed only a few short strings. The batcher holds
+the texts for up to QUERY_BATCH_MAX_WAIT_MS (or until QUERY_BATCH_MAX_SIZE texts are
+waiting), embeds them in a single call and resolves every caller with its own slice.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+QUERY_BATCH_MAX_WAIT_MS = float(os.environ.get("QUERY_BATCH_MAX_WAIT_MS") or 5)  # 0 disables batching
+QUERY_BATCH_MAX_SIZE = int(os.environ.get("QUERY_BATCH_MAX_SIZE") or 64)
+
+# Number of recent batches the percentiles are computed over
+METRICS_WINDOW = 1024
+
+
+class QueryEmbeddingBatcher:
+    def __init__(
+        self,
+        embed: Callable[[List[str]], Awaitable[Sequence[Any]]],
+        max_wait_ms: float = QUERY_BATCH_MAX_WAIT_MS,
+        max_batch_size: int = QUERY_BATCH_MAX_SIZE,
+    ):
+        """Create a query embedding batcher.
+
+        Args:
+            embed: Coroutine function embedding a list of texts, called once per batch.
+            max_wait_ms (float, optional): How long the first text of a batch waits for others.
+            max_batch_size (int, optional): Number of texts that dispatches a batch right away.
+        """
+        self._embed = embed
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        # (text, future, enqueue time) of the texts waiting for the next batch
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        # Metrics
+        self.batches = 0
+        self.items = 0
+        self.max_seen_batch_size = 0
+        self._recent_sizes: deque = deque(maxlen=METRICS_WINDOW)
+        self._recent_delays: deque = deque(maxlen=METRICS_WINDOW)
+
+    async def embed(self, texts: List[str]) -> List[Any]:
+        """Embed texts together with the texts of concurrent callers."""
+        if not texts:
+            return []
+        if self.max_wait <= 0:
+            return list(await self._embed(texts))
+
+        loop = asyncio.get_running_loop()
+        now = time.perf_counter()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self._pending.append((text, future, now))
+            futures.append(future)
+
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._dispatch)
+
+        return list(await asyncio.gather(*futures))
+
+    def _dispatch(self) -> None:
+        """Start embedding everything that is pending, max_batch_size texts per call."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            task = loop.create_task(self._run(batch))
+            # Keep a reference until the task is done
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future, float]]) -> None:
+        started = time.perf_counter()
+        self.batches += 1
+        self.items += len(batch)
+        self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+        self._recent_sizes.append(len(batch))
+        self._recent_delays.extend(started - enqueued for _, _, enqueued in batch)
+
+        try:
+            embeddings = await self._embed([text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    def stats(self) -> Dict[str, float]:
+        """Batch size and queueing delay metrics, percentiles over the recent batches."""
+        def percentile(values, q):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return float(ordered[min(len(ordered) - 1, int(q * len(ordered)))])
+
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_seen_batch_size,
+            "p50_batch_size": percentile(self._recent_sizes, 0.5),
+            "p50_queue_delay_ms": percentile(self._recent_delays, 0.5) * 1000,
+            "p99_queue_delay_ms": percentile(self._recent_delays, 0.99) * 1000,
+            "max_wait_ms": self.max_wait * 1000,
+        }
@@ -0,0 +1,48 @@
+"""
+Server readiness: models are loaded by a background warm-up task after the server
+has bound its port, and /health/ready only reports ready once that task is done.
+"""
+
+import asyncio
+import time
+from typing import Any, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class WarmUp:
+    def __init__(self, import_seconds: Optional[float] = None):
+        """Track the warm-up of a server.
+
+        Args:
+            import_seconds (Optional[float], optional): How long importing the server modules took.
+        """
+        self.import_seconds = import_seconds
+        self.warm_up_seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        self.ready = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, warm_up: Callable[[], Any]) -> None:
+        """Run the blocking warm_up function in a thread, without delaying the startup."""
+        self._task = asyncio.get_running_loop().create_task(self._run(warm_up))
+
+    async def _run(self, warm_up: Callable[[], Any]) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, warm_up)
+        except Exception as e:
+            self.error = str(e)
+            logger.error("Warm-up failed, error: {}".format(e))
+            return
+        self.warm_up_seconds = time.perf_counter() - started
+        self.ready = True
+        logger.info("Warm-up done in {:.2f}s".format(self.warm_up_seconds))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "import_seconds": self.import_seconds,
+            "warm_up_seconds": self.warm_up_seconds,
+            "error": self.error,
+        }
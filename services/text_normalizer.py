@@ -0,0 +1,112 @@
+"""
+Text normalization with precompiled rules.
+
+A TextNormalizer removes the matches of a few regexes, deletes characters with a
+translate table and collapses runs of repeated characters, each rule compiled once
+and the character rules fused into a single pass:
+
+- non-ASCII characters are dropped by the ASCII codec and the unwanted ASCII
+  characters by bytes.translate, both in C;
+- runs of every collapsed character are replaced by one regex with one group per
+  character.
+
+DESCRIPTION_NORMALIZER and LATEX_NORMALIZER give the same output as the original
+regex chains of clean_description and clean_latex. stream() normalizes an iterable
+of text blocks (e.g. a multi-megabyte LaTeX file read in blocks) block by block,
+cutting them at newlines so that no rule match spans two blocks.
+"""
+
+import re
+from typing import Iterable, Iterator, Optional, Sequence
+
+
+# Blocks normalize() cuts long texts into
+STREAM_BLOCK_CHARS = 1 << 20
+
+
+class TextNormalizer:
+    def __init__(
+        self,
+        removals: Sequence[str] = (),
+        keep: Optional[str] = None,
+        ascii_only: bool = False,
+        collapse: str = "",
+    ):
+        """Create a text normalizer.
+
+        Args:
+            removals (Sequence[str], optional): Regexes whose matches are removed, one pass each, in order.
+                                                They must not match a newline.
+            keep (Optional[str], optional): The ASCII characters to keep, every other character is deleted.
+                                            Defaults to keeping all of them.
+            ascii_only (bool, optional): Delete the non-ASCII characters. Implied by keep.
+            collapse (str, optional): Characters whose runs are replaced by a single one.
+        """
+        self._removals = [re.compile(removal) for removal in removals]
+        self._ascii_only = ascii_only or keep is not None
+        self._delete = None
+        if keep is not None:
+            self._delete = bytes(byte for byte in range(128) if chr(byte) not in keep)
+        self._collapse = collapse
+        self._collapse_pattern = None
+        if collapse:
+            self._collapse_pattern = re.compile(
+                "|".join(f"({re.escape(char)}){re.escape(char)}+" for char in collapse)
+            )
+            self._collapse_replacement = "".join(f"\\{group}" for group in range(1, len(collapse) + 1))
+
+    def normalize(self, text: str) -> str:
+        if len(text) > STREAM_BLOCK_CHARS:
+            return "".join(self.stream(text[i:i + STREAM_BLOCK_CHARS] for i in range(0, len(text), STREAM_BLOCK_CHARS)))
+        return self._normalize(text)
+
+    def _normalize(self, text: str) -> str:
+        for removal in self._removals:
+            text = removal.sub("", text)
+        if self._delete is not None:
+            text = text.encode("ascii", "ignore").translate(None, self._delete).decode("ascii")
+        elif self._ascii_only and not text.isascii():
+            text = text.encode("ascii", "ignore").decode("ascii")
+        if self._collapse_pattern is not None:
+            text = self._collapse_pattern.sub(self._collapse_replacement, text)
+        return text
+
+    def stream(self, blocks: Iterable[str]) -> Iterator[str]:
+        """Normalize the concatenation of blocks, yielding the normalized text piece by piece."""
+        pending = ""
+        last = ""
+        for block in blocks:
+            pending += block
+            cut = pending.rfind("\n") + 1
+            if not cut:
+                # No complete line yet
+                continue
+            piece = self._join(last, self._normalize(pending[:cut]))
+            pending = pending[cut:]
+            if piece:
+                last = piece[-1]
+                yield piece
+        piece = self._join(last, self._normalize(pending))
+        if piece:
+            yield piece
+
+    def _join(self, last: str, piece: str) -> str:
+        """piece without the characters continuing a run collapsed at the end of the previous piece."""
+        if last and last in self._collapse and piece.startswith(last):
+            return piece.lstrip(last)
+        return piece
+
+
+DESCRIPTION_NORMALIZER = TextNormalizer(
+    removals=(
+        # URLs and timestamps
+        r"http\S+|www.\S+|\d+:\d+(?::\d+)?",
+        # Sequences of characters that are longer than a certain threshold (e.g., 30),
+        # only tried where a sequence starts
+        r"(?<!\S)\S{30,}",
+    ),
+    keep="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 \n.",
+    collapse="\n ",
+)
+
+LATEX_NORMALIZER = TextNormalizer(ascii_only=True, collapse=" ")
@@ -0,0 +1,268 @@
+"""
+Recursive text splitter.
+
+Splits a text along a hierarchy of separators into chunks of at most chunk_size
+characters, consecutive chunks sharing up to chunk_overlap characters, with the
+semantics of langchain's RecursiveCharacterTextSplitter (separators kept at the start
+of the following piece, chunks stripped of surrounding whitespace). The separators are
+compiled once and the text is never copied while splitting: spans() yields the
+(start, end) offsets of the chunks, split() the chunk strings.
+
+ContentDefinedSplitter places the chunk boundaries where the content says so (after
+words whose hash hits a target) instead of filling chunks from the start, so an edit
+only changes the chunks around it; it is used where documents are re-indexed
+incrementally.
+
+LATEX_SEPARATORS are the separators of langchain's LatexTextSplitter, so that the chunks,
+and so their hashes, stay those of the documents already indexed. Its section and
+environment separators carry a doubled backslash (the align one a backspace) and
+never match a LaTeX source: documents are only split along display and inline math, then
+words. LATEX_COMMAND_SEPARATORS are the same commands as they appear in the text, so that
+chunks break at sections and environments; they are used instead when
+LATEX_COMMAND_SEPARATORS=true, which changes the chunks of every re-upserted document.
+"""
+
+import os
+import re
+import zlib
+from collections import deque
+from functools import lru_cache
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+
+# The separators of langchain's LatexTextSplitter, as they are (see the module docstring)
+LANGCHAIN_LATEX_SEPARATORS = (
+    "\n\\\\chapter{",
+    "\n\\\\section{",
+    "\n\\\\subsection{",
+    "\n\\\\subsubsection{",
+    "\n\\\\begin{enumerate}",
+    "\n\\\\begin{itemize}",
+    "\n\\\\begin{description}",
+    "\n\\\\begin{list}",
+    "\n\\\\begin{quote}",
+    "\n\\\\begin{quotation}",
+    "\n\\\\begin{verse}",
+    "\n\\\\begin{verbatim}",
+    "\n\\\x08egin{align}",
+    "$$",
+    "$",
+    " ",
+    "",
+)
+
+LATEX_COMMAND_SEPARATORS = (
+    # Sections
+    "\n\\chapter{",
+    "\n\\section{",
+    "\n\\subsection{",
+    "\n\\subsubsection{",
+    # Environments
+    "\n\\begin{enumerate}",
+    "\n\\begin{itemize}",
+    "\n\\begin{description}",
+    "\n\\begin{list}",
+    "\n\\begin{quote}",
+    "\n\\begin{quotation}",
+    "\n\\begin{verse}",
+    "\n\\begin{verbatim}",
+    # Math
+    "\n\\begin{align}",
+    "$$",
+    "$",
+    # Words, then characters
+    " ",
+    "",
+)
+
+USE_LATEX_COMMAND_SEPARATORS = (os.environ.get("LATEX_COMMAND_SEPARATORS") or "false").lower() == "true"
+LATEX_SEPARATORS = LATEX_COMMAND_SEPARATORS if USE_LATEX_COMMAND_SEPARATORS else LANGCHAIN_LATEX_SEPARATORS
+
+TEXT_SEPARATORS = ("\n\n", "\n", " ", "")
+
+Span = Tuple[int, int]
+
+# A word and the whitespace following it
+_WORD = re.compile(r"\S+\s*")
+# Assumed average characters per word, to turn the target chunk size into a word count
+_WORD_CHARS = 6
+
+
+class TextSplitter:
+    def __init__(self, separators: Sequence[str], chunk_size: int, chunk_overlap: int = 20):
+        """Create a text splitter.
+
+        Args:
+            separators (Sequence[str]): Literal separators, tried in order. "" splits into characters.
+            chunk_size (int): Maximum number of characters of a chunk.
+            chunk_overlap (int, optional): Maximum number of characters shared by consecutive chunks.
+                                           Defaults to 20.
+        """
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"Chunk overlap ({chunk_overlap}) is larger than the chunk size ({chunk_size})")
+        self.separators = tuple(separators)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._patterns = [re.compile(re.escape(separator)) if separator else None for separator in self.separators]
+
+    def spans(self, text: str) -> Iterator[Span]:
+        """Yield the (start, end) offsets of the chunks of text."""
+        return self._split(text, 0, len(text), 0)
+
+    def split(self, text: str) -> Iterator[str]:
+        """Yield the chunks of text."""
+        for start, end in self.spans(text):
+            yield text[start:end]
+
+    def _pieces(self, text: str, start: int, end: int, level: int) -> Tuple[Optional[List[Span]], int]:
+        """Split text[start:end] along the first separator found in it, each piece starting with its separator.
+
+        The pieces are None when the text is to be split into characters.
+        """
+        for i in range(level, len(self._patterns)):
+            pattern = self._patterns[i]
+            if pattern is None:
+                return None, len(self._patterns)
+            matches = [match.start() for match in pattern.finditer(text, start, end)]
+            if matches:
+                bounds = [start] + matches + [end]
+                return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b], i + 1
+        # No separator left, the span is a single piece
+        return [(start, end)], len(self._patterns)
+
+    def _split(self, text: str, start: int, end: int, level: int) -> Iterator[Span]:
+        pieces, next_level = self._pieces(text, start, end, level)
+        if pieces is None:
+            if self.chunk_size > 1:
+                # Merging single characters gives fixed windows, no need to go through every character
+                yield from self._windows(text, start, end)
+                return
+            pieces = [(i, i + 1) for i in range(start, end)]
+
+        good: List[Span] = []
+        for piece in pieces:
+            if piece[1] - piece[0] < self.chunk_size:
+                good.append(piece)
+                continue
+            if good:
+                yield from self._merge(text, good)
+                good = []
+            if next_level >= len(self._patterns):
+                yield piece
+            else:
+                yield from self._split(text, piece[0], piece[1], next_level)
+        if good:
+            yield from self._merge(text, good)
+
+    def _merge(self, text: str, pieces: List[Span]) -> Iterator[Span]:
+        """Combine consecutive pieces into chunks of at most chunk_size characters."""
+        current: deque = deque()
+        total = 0
+        for piece in pieces:
+            length = piece[1] - piece[0]
+            if total + length > self.chunk_size and current:
+                span = self._strip(text, current[0][0], current[-1][1])
+                if span is not None:
+                    yield span
+                # Keep the tail of the chunk as the overlap of the next one
+                while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                    first = current.popleft()
+                    total -= first[1] - first[0]
+            current.append(piece)
+            total += length
+        if current:
+            span = self._strip(text, current[0][0], current[-1][1])
+            if span is not None:
+                yield span
+
+    def _windows(self, text: str, start: int, end: int) -> Iterator[Span]:
+        """What merging the single characters of text[start:end] yields."""
+        stride = self.chunk_size - min(self.chunk_overlap, self.chunk_size - 1)
+        while start + self.chunk_size < end:
+            span = self._strip(text, start, start + self.chunk_size)
+            if span is not None:
+                yield span
+            start += stride
+        span = self._strip(text, start, end)
+        if span is not None:
+            yield span
+
+    @staticmethod
+    def _strip(text: str, start: int, end: int) -> Optional[Span]:
+        """The span without its leading and trailing whitespace, None if nothing is left."""
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return (start, end) if start < end else None
+
+
+class ContentDefinedSplitter:
+    def __init__(self, chunk_size: int, min_size: Optional[int] = None, average_size: Optional[int] = None):
+        """Create a content-defined splitter.
+
+        A chunk ends after a word when the hash of that word and the previous one is
+        0 modulo a divisor, and the chunk is at least min_size characters long. The
+        divisor is chosen so that chunks are about average_size characters long.
+        Chunks never exceed chunk_size characters: they are cut before the word that
+        would overflow them (and a longer word is cut into pieces). Chunks do not overlap.
+
+        Args:
+            chunk_size (int): Maximum number of characters of a chunk.
+            min_size (Optional[int], optional): Minimum number of characters before a boundary.
+                                                Defaults to chunk_size // 4.
+            average_size (Optional[int], optional): Target chunk size. Defaults to chunk_size // 2.
+        """
+        self.chunk_size = chunk_size
+        self.min_size = chunk_size // 4 if min_size is None else min_size
+        average_size = chunk_size // 2 if average_size is None else average_size
+        self._divisor = max(1, (average_size - self.min_size) // _WORD_CHARS)
+
+    def spans(self, text: str) -> Iterator[Span]:
+        """Yield the (start, end) offsets of the chunks of text."""
+        start = None
+        previous = b""
+        for match in _WORD.finditer(text):
+            word_start, word_end = match.span()
+            if start is None:
+                start = word_start
+            if word_end - start > self.chunk_size and word_start > start:
+                # The word does not fit, cut before it
+                span = TextSplitter._strip(text, start, word_start)
+                if span is not None:
+                    yield span
+                start = word_start
+            while word_end - start > self.chunk_size:
+                # A single word longer than a chunk
+                yield start, start + self.chunk_size
+                start += self.chunk_size
+
+            word = match.group().rstrip().encode("utf-8")
+            boundary = zlib.crc32(word, zlib.crc32(previous)) % self._divisor == 0
+            previous = word
+            if boundary and word_end - start >= self.min_size:
+                span = TextSplitter._strip(text, start, word_end)
+                if span is not None:
+                    yield span
+                start = None
+        if start is not None:
+            span = TextSplitter._strip(text, start, len(text))
+            if span is not None:
+                yield span
+
+    def split(self, text: str) -> Iterator[str]:
+        """Yield the chunks of text."""
+        for start, end in self.spans(text):
+            yield text[start:end]
+
+
+@lru_cache(maxsize=None)
+def get_content_defined_splitter(chunk_size: int) -> ContentDefinedSplitter:
+    """The shared content-defined splitter of chunk_size."""
+    return ContentDefinedSplitter(chunk_size)
+
+
+@lru_cache(maxsize=None)
+def get_text_splitter(separators: Tuple[str, ...], chunk_size: int, chunk_overlap: int = 20) -> TextSplitter:
+    """The shared splitter of these settings."""
+    return TextSplitter(separators, chunk_size, chunk_overlap)
@@ -0,0 +1,42 @@
+from services.dedup import Deduplicator, simhash
+
+
+def paper(topic):
+    return " ".join(f"{topic} result {i} holds for every {topic} instance of size {i}" for i in range(40))
+
+
+def test_chunks_are_not_skipped_for_another_document(tmp_path):
+    deduplicator = Deduplicator(str(tmp_path / "dedup.sqlite"))
+    license_text = "Permission is hereby granted, free of charge, to any person obtaining a copy of this software"
+    first = deduplicator.deduplicate("first", paper("graph"), [license_text, "graphs"])
+    deduplicator.record([first])
+
+    second = deduplicator.deduplicate("second", paper("matrix"), [license_text, "matrices", license_text])
+
+    # Only the repeated chunk of the document itself is skipped
+    assert second.duplicate_of is None
+    assert second.kept == [0, 1]
+
+
+def test_texts_without_words_are_not_fingerprinted(tmp_path):
+    deduplicator = Deduplicator(str(tmp_path / "dedup.sqlite"))
+    assert simhash("---- !!! ....") is None
+
+    first = deduplicator.deduplicate("first", "* * *", ["----", "...."])
+    deduplicator.record([first])
+    second = deduplicator.deduplicate("second", "= = =", ["----"])
+
+    assert first.kept == [0, 1]
+    assert first.fingerprints == []
+    assert second.duplicate_of is None
+    assert second.kept == [0]
+
+
+def test_near_duplicate_document_keeps_no_chunk(tmp_path):
+    deduplicator = Deduplicator(str(tmp_path / "dedup.sqlite"))
+    deduplicator.record([deduplicator.deduplicate("v1", paper("graph"), ["a chunk"])])
+
+    second = deduplicator.deduplicate("v2", paper("graph") + " final version", ["a chunk"])
+
+    assert second.duplicate_of == "v1"
+    assert second.kept == []
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("sentence_transformers")
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+import services.embedders as embedders
+from services.embedders import OnnxEmbedder, QuantizedOnnxEmbedder, SentenceTransformerEmbedder, check_parity
+
+
+WORDS = "the quick brown fox jumps over a lazy dog while an embedding model is exported to onnx".split()
+
+# Texts of different lengths, so that the batches are padded and the attention mask matters
+TEXTS = [
+    "the quick brown fox",
+    "a lazy dog",
+    "the quick brown fox jumps over a lazy dog while an embedding model is exported to onnx",
+    "onnx",
+    "an embedding model is exported",
+]
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """A small random BERT model, mean pooled by sentence-transformers, without downloading anything."""
+    path = tmp_path_factory.mktemp("bert")
+    vocab_file = path / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS))
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(str(path))
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(WORDS) + 5,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )
+    BertModel(config).save_pretrained(str(path))
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def reference(model_dir):
+    return SentenceTransformerEmbedder(model_dir)
+
+
+def test_onnx_parity(model_dir, reference, tmp_path):
+    candidate = OnnxEmbedder(model_dir, onnx_dir=str(tmp_path))
+
+    # The graph inputs are fed by name, they must be the tensors they are named after
+    assert set(candidate.input_names) == {"input_ids", "attention_mask", "token_type_ids"}
+    parity = check_parity(reference, candidate, TEXTS, batch_size=len(TEXTS))
+    assert parity["max_drift"] < 1e-4
+
+
+def test_quantized_onnx_parity(model_dir, reference, tmp_path):
+    candidate = QuantizedOnnxEmbedder(model_dir, onnx_dir=str(tmp_path))
+
+    parity = check_parity(reference, candidate, TEXTS, batch_size=len(TEXTS))
+    assert parity["mean_drift"] < 0.05
+
+
+def test_concurrent_workers_export_once(model_dir, tmp_path, monkeypatch):
+    exports = []
+    export_onnx = embedders.export_onnx
+
+    def counted_export_onnx(model_name, export_dir):
+        exports.append(export_dir)
+        export_onnx(model_name, export_dir)
+
+    monkeypatch.setattr(embedders, "export_onnx", counted_export_onnx)
+    candidates = []
+    workers = [
+        threading.Thread(target=lambda: candidates.append(OnnxEmbedder(model_dir, onnx_dir=str(tmp_path))))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # The other workers waited for the export and loaded its files
+    assert len(exports) == 1
+    assert len(candidates) == 3
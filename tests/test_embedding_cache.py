@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from services.embedding_cache import EmbeddingCache
+
+
+def vectors(count, start=0):
+    return np.arange(start * 4, (start + count) * 4, dtype=np.float32).reshape(count, 4)
+
+
+def test_partial_write_does_not_misalign_later_rows(tmp_path):
+    cache = EmbeddingCache("model", max_items=0, cache_dir=str(tmp_path))
+    cache.put_many(["a", "b"], vectors(2))
+    disk = cache._disk
+    # A writer killed in the middle of a vector and of an index record
+    with open(disk._shard_path(0), "ab") as f:
+        f.write(b"\0" * 6)
+    with open(disk._index_path, "ab") as f:
+        f.write(b"\0" * 5)
+
+    cache.put_many(["c", "d"], vectors(2, start=2))
+
+    reopened = EmbeddingCache("model", max_items=0, cache_dir=str(tmp_path))
+    found = reopened.get_many(["a", "b", "c", "d"])
+    assert np.array_equal(np.stack(found), vectors(4))
+    assert os.path.getsize(disk._shard_path(0)) == 4 * 4 * 4
+
+
+def test_memory_tier_does_not_keep_the_computed_batch():
+    cache = EmbeddingCache("model")
+    computed = vectors(3)
+
+    cache.get_or_compute(["a", "b", "c"], lambda texts: computed)
+
+    for vector in cache._memory.values():
+        assert vector.base is None
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import numpy as np
+
+from services.embedding_executor import PRIORITY_QUERY, EmbeddingExecutor
+
+
+class SlowEmbedder:
+    """Takes a fixed time per text, like a model on a busy CPU."""
+
+    def __init__(self, seconds_per_text):
+        self.seconds_per_text = seconds_per_text
+
+    def encode(self, texts, batch_size):
+        time.sleep(self.seconds_per_text * len(texts))
+        return np.array([[float(text.split()[-1])] for text in texts], dtype=np.float32)
+
+
+def make_executor(job_size):
+    executor = EmbeddingExecutor("model", kind="thread", max_workers=1, job_size=job_size)
+    executor._embedder = SlowEmbedder(0.005)
+    return executor
+
+
+def test_query_finishes_while_large_upsert_is_in_flight():
+    executor = make_executor(job_size=20)
+    texts = [f"chunk {i}" for i in range(400)]  # About 2 seconds of encoding
+    finished = {}
+
+    async def timed(name, coroutine):
+        result = await coroutine
+        finished[name] = time.monotonic()
+        return result
+
+    async def main():
+        upsert = asyncio.ensure_future(timed("upsert", executor.embed(texts, 32)))
+        await asyncio.sleep(0.2)
+        started = time.monotonic()
+        query = await timed("query", executor.embed(["query 7"], 32, priority=PRIORITY_QUERY))
+        return started, query, await upsert
+
+    started, query, upsert = asyncio.run(main())
+    executor.shutdown()
+
+    # The query waited for one job of the upsert at most, not for the whole upsert
+    assert finished["query"] < finished["upsert"]
+    assert finished["query"] - started < 0.5
+    assert query.tolist() == [[7.0]]
+    # The jobs of the upsert are put back together in order
+    assert upsert[:, 0].tolist() == list(range(400))
+
+
+def test_embed_without_texts():
+    executor = make_executor(job_size=20)
+
+    embeddings = asyncio.run(executor.embed([], 32))
+    executor.shutdown()
+
+    assert len(embeddings) == 0
@@ -0,0 +1,120 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+import datastore.datastore as datastore_module
+import services.data_processing as data_processing
+from datastore.datastore import DataStore
+from models.models import Document, DocumentMetadata, Partition
+
+
+class MemoryDataStore(DataStore):
+    """Stores the chunks in a dict, with the chunk hash support of the Milvus datastore."""
+
+    def __init__(self):
+        self.rows = {}
+        self.next_id = 0
+
+    async def _upsert(self, document_chunks):
+        for document_id, chunks in document_chunks.items():
+            for chunk in chunks:
+                self.rows[self.next_id] = (document_id, chunk)
+                self.next_id += 1
+        return {document_id: {"count": str(len(chunks))} for document_id, chunks in document_chunks.items()}
+
+    async def _get_chunk_hashes(self, document_id, collection_name, partition_name, metadata):
+        chunk_hashes = {}
+        for id, (stored_document_id, chunk) in self.rows.items():
+            if stored_document_id == document_id:
+                chunk_hashes.setdefault(chunk.chunk_hash, []).append(id)
+        return chunk_hashes
+
+    async def _delete_chunks(self, collection_name, ids):
+        for id in ids:
+            del self.rows[id]
+        return len(ids)
+
+    async def _delete(self, documents):
+        document_ids = {document.document_id for document in documents}
+        self.rows = {id: row for id, row in self.rows.items() if row[0] not in document_ids}
+        return True
+
+    def texts(self):
+        return sorted(chunk.text for _, chunk in self.rows.values())
+
+
+class ReplacingDataStore(MemoryDataStore):
+    """A datastore without chunk hashes nor chunk deletes."""
+
+    _get_chunk_hashes = DataStore._get_chunk_hashes
+    _delete_chunks = DataStore._delete_chunks
+
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """The texts embedded, instead of running the model."""
+    texts = []
+
+    async def embed_document_chunks(chunks):
+        for chunk in chunks:
+            texts.append(chunk.text)
+            chunk.embedding = np.zeros(4, dtype=np.float32)
+
+    monkeypatch.setattr(datastore_module, "embed_document_chunks", embed_document_chunks)
+    monkeypatch.setattr(data_processing, "INCREMENTAL_UPSERT_PARTITIONS", ["notes"])
+    return texts
+
+
+def paragraphs(seed, count):
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "theta", "kappa", "lambda", "sigma", "omega"]
+    return [" ".join(rng.choice(words) + str(rng.randint(0, 99)) for _ in range(60)) for _ in range(count)]
+
+
+def note(text):
+    metadata = DocumentMetadata(title="Notes", created_at="2024-01-01", authors="someone")
+    return Document(text=text, partition=Partition.notes, metadata=metadata)
+
+
+def test_paragraph_inserted_at_the_start_embeds_one_chunk(embedded):
+    datastore = MemoryDataStore()
+    body = paragraphs(0, 20)
+    asyncio.run(datastore.upsert([note("\n".join(body))]))
+    chunks = len(datastore.rows)
+    assert chunks > 5
+    embedded.clear()
+
+    [response] = asyncio.run(datastore.upsert([note("\n".join(["a new first paragraph"] + body))])).values()
+
+    # Only the first chunk changed, the chunks after it are kept although their index moved
+    assert len(embedded) == 1
+    assert response == {"count": "1", "unchanged": str(chunks - 1), "deleted": "1"}
+    assert len(datastore.rows) == chunks
+
+
+def test_repeated_chunks_are_kept_once_per_occurrence(embedded):
+    datastore = MemoryDataStore()
+    body = paragraphs(1, 10)
+    asyncio.run(datastore.upsert([note("\n".join(body + body))]))
+    before = datastore.texts()
+    embedded.clear()
+
+    [response] = asyncio.run(datastore.upsert([note("\n".join(body + body))])).values()
+
+    assert embedded == []
+    assert response["deleted"] == "0"
+    assert datastore.texts() == before
+
+
+def test_datastore_without_chunk_deletes_replaces_the_document(embedded):
+    datastore = ReplacingDataStore()
+    asyncio.run(datastore.upsert([note("\n".join(paragraphs(2, 10)))]))
+    edited = "\n".join(paragraphs(3, 10))
+
+    asyncio.run(datastore.upsert([note(edited)]))
+
+    # No chunk of the first version is left
+    assert datastore.texts() == sorted(embedded[-len(datastore.rows):])
+    assert all(text in data_processing.clean_description(edited) for text in datastore.texts())
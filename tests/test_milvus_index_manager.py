@@ -0,0 +1,122 @@
+import threading
+import time
+
+from datastore.providers.milvus_datastore import CollectionHandle, MilvusDataStore
+from datastore.providers.milvus_index_manager import IndexManager
+
+
+class FakeCollection:
+    """The parts of a pymilvus Collection the index manager uses."""
+
+    def __init__(self, name, num_entities):
+        self.name = name
+        self.num_entities = num_entities
+        self.created = []
+
+    def create_index(self, field, index_params, timeout=None):
+        self.created.append((field, index_params))
+
+
+def test_new_collection_is_indexed_for_the_expected_corpus():
+    collection = FakeCollection("empty", 0)
+
+    chosen = IndexManager("content_vector", 384).create(collection)
+
+    # Not FLAT: rebuilds are off by default, the index must scale as the collection fills up
+    assert chosen["index_type"] == "HNSW"
+    assert collection.created == [("content_vector", chosen)]
+
+
+def test_small_expected_corpus_is_searched_exactly():
+    manager = IndexManager("content_vector", 384, expected_rows=0)
+
+    assert manager.choose(100)["index_type"] == "FLAT"
+    assert manager.choose(100_000)["index_type"] == "HNSW"
+
+
+class FakeIndex:
+    def __init__(self, field_name, params):
+        self.field_name = field_name
+        self.params = params
+
+
+class IndexedCollection(FakeCollection):
+    """A collection with an index, recording the calls of a rebuild."""
+
+    def __init__(self, name, num_entities, index_params, calls):
+        super().__init__(name, num_entities)
+        self.indexes = [FakeIndex("content_vector", index_params)]
+        self.calls = calls
+
+    def release(self, timeout=None):
+        self.calls.append("release")
+
+    def drop_index(self, timeout=None):
+        self.calls.append("drop_index")
+
+    def create_index(self, field, index_params, timeout=None):
+        self.calls.append("create_index")
+        self.indexes = [FakeIndex(field, index_params)]
+
+    def load(self, timeout=None):
+        self.calls.append("load")
+
+
+def test_rebuild_holds_operations_of_every_process_back(tmp_path):
+    # Two managers on one lock directory stand for two processes of the datastore
+    rebuilder = IndexManager("content_vector", 384, expected_rows=0, lock_dir=str(tmp_path))
+    other = IndexManager("content_vector", 384, expected_rows=0, lock_dir=str(tmp_path))
+    calls = []
+    collection = IndexedCollection("papers", 100_000, {"index_type": "FLAT", "params": {}}, calls)
+    assert other.index_params(collection)["index_type"] == "FLAT"
+
+    operation_running = threading.Event()
+    finish_operation = threading.Event()
+
+    def running_operation():
+        with other.operation("papers"):
+            operation_running.set()
+            finish_operation.wait()
+            calls.append("first operation done")
+
+    def later_operation():
+        with other.operation("papers"):
+            calls.append("later operation")
+
+    first = threading.Thread(target=running_operation)
+    first.start()
+    operation_running.wait()
+    rebuild = threading.Thread(target=rebuilder.check, args=(collection,))
+    rebuild.start()
+    time.sleep(0.2)
+    # The rebuild waits for the running operation, and holds the later one back
+    later = threading.Thread(target=later_operation)
+    later.start()
+    time.sleep(0.2)
+    assert calls == []
+    with other.exclusive("papers") as acquired:
+        assert not acquired
+
+    finish_operation.set()
+    for thread in (first, rebuild, later):
+        thread.join(5)
+    assert calls == ["first operation done", "release", "drop_index", "create_index", "load", "later operation"]
+    # The other process reads the rebuilt index again
+    assert other.index_params(collection)["index_type"] == "HNSW"
+
+
+def test_collections_opened_on_pooled_aliases_are_checked():
+    datastore = MilvusDataStore.__new__(MilvusDataStore)
+    datastore.alias = "default"
+    datastore._collections_lock = threading.Lock()
+    datastore._load_collection = lambda name, alias: CollectionHandle(FakeCollection(name, 0), "V3")
+    # Collection "pooled" was only opened on connections of the pool
+    datastore._collections = {
+        ("default", "papers"): CollectionHandle(FakeCollection("papers", 0), "V3"),
+        ("pool-1", "papers"): CollectionHandle(FakeCollection("papers", 0), "V3"),
+        ("pool-1", "pooled"): CollectionHandle(FakeCollection("pooled", 0), "V3"),
+        ("pool-2", "pooled"): CollectionHandle(FakeCollection("pooled", 0), "V3"),
+    }
+
+    # Once per collection, not per alias
+    assert [collection.name for collection in datastore._opened_collections()] == ["papers", "pooled"]
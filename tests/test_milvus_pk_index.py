@@ -0,0 +1,61 @@
+import json
+
+from datastore.providers.milvus_datastore import MilvusDataStore
+from datastore.providers.milvus_flush_scheduler import FlushScheduler
+from datastore.providers.milvus_pk_index import PrimaryKeyIndex
+
+
+class StoredCollection:
+    """A collection of (primary key, document id) rows, without query_iterator like pymilvus before 2.3."""
+
+    name = "papers"
+
+    def __init__(self, rows):
+        self.rows = dict(rows)
+        self.expressions = []
+
+    def query(self, expr, output_fields, limit, consistency_level, timeout):
+        document_ids = json.loads(expr[len("documentId in "):])
+        return [{"id": pk} for pk, document_id in self.rows.items() if document_id in document_ids][:limit]
+
+    def delete(self, expr, timeout):
+        self.expressions.append(expr)
+        for pk in eval(expr[len("id in "):]):
+            del self.rows[pk]
+
+
+class Handle:
+    def __init__(self, collection):
+        self.collection = collection
+
+
+def make_datastore(tmp_path, expression_deletes=False):
+    datastore = MilvusDataStore.__new__(MilvusDataStore)
+    datastore._pk_index = PrimaryKeyIndex(str(tmp_path / "pk.sqlite"))
+    datastore._expression_deletes = expression_deletes
+    datastore._flush_scheduler = FlushScheduler(lambda collection: None)
+    return datastore
+
+
+def test_untracked_collection_is_deleted_from_without_iterator(tmp_path):
+    datastore = make_datastore(tmp_path)
+    collection = StoredCollection({1: "a", 2: "a", 3: "b"})
+
+    deleted = datastore._delete_documents(Handle(collection), ["a"])
+
+    assert deleted == 2
+    assert collection.rows == {3: "b"}
+
+
+def test_document_missing_from_index_is_deleted_by_document_id(tmp_path):
+    datastore = make_datastore(tmp_path)
+    datastore._pk_index.track("papers")
+    datastore._pk_index.add("papers", [("a", 1)])
+    # Document b was written by a process with another index file
+    collection = StoredCollection({1: "a", 2: "b", 3: "b", 4: "c"})
+
+    deleted = datastore._delete_documents(Handle(collection), ["a", "b"])
+
+    assert deleted == 3
+    assert collection.rows == {4: "c"}
+    assert collection.expressions[0] == "id in [1]"
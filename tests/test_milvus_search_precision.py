@@ -0,0 +1,67 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from datastore.providers.milvus_datastore import EMBEDDING_FIELD, OUTPUT_DIM, MilvusDataStore
+from datastore.providers.milvus_index_manager import IndexManager
+from models.models import QueryWithEmbedding, SearchPrecision
+
+
+class FakeIndex:
+    def __init__(self, field_name, params):
+        self.field_name = field_name
+        self.params = params
+
+
+class SearchedCollection:
+    """A collection with an index, recording the search params of every search."""
+
+    name = "papers"
+
+    def __init__(self, index_params):
+        self.indexes = [FakeIndex(EMBEDDING_FIELD, index_params)]
+        self.searches = []
+
+    def search(self, data, anns_field, param, **kwargs):
+        self.searches.append(param["param"])
+        return []
+
+
+class Handle:
+    def __init__(self, collection):
+        self.collection = collection
+
+
+def search_params(tmp_path, index_params):
+    """The search params of a high, a medium and a low precision query, searched through the datastore."""
+    datastore = MilvusDataStore.__new__(MilvusDataStore)
+    datastore._index_manager = IndexManager(EMBEDDING_FIELD, OUTPUT_DIM, lock_dir=str(tmp_path))
+    datastore.search_params = None
+    collection = SearchedCollection(index_params)
+
+    async def run(collection_name, operation, idempotent=True):
+        return operation(Handle(collection))
+
+    datastore._run = run
+    queries = [
+        QueryWithEmbedding(query="q", top_k=3, searchprecision=precision, embedding=np.zeros(OUTPUT_DIM).tolist())
+        for precision in (SearchPrecision.high, SearchPrecision.medium, SearchPrecision.low)
+    ]
+    asyncio.run(datastore._query(queries))
+    return collection.searches
+
+
+def test_precision_tunes_ef_of_the_default_index(tmp_path):
+    # The index a new collection gets
+    index_params = IndexManager(EMBEDDING_FIELD, OUTPUT_DIM).choose(0)
+    assert index_params["index_type"] == "HNSW"
+
+    assert search_params(tmp_path, index_params) == [{"ef": 64}, {"ef": 32}, {"ef": 16}]
+
+
+@pytest.mark.parametrize("index_type", ["IVF_FLAT", "IVF_SQ8"])
+def test_precision_tunes_nprobe_of_ivf_indexes(tmp_path, index_type):
+    index_params = {"index_type": index_type, "metric_type": "IP", "params": {"nlist": 1024}}
+
+    assert search_params(tmp_path, index_params) == [{"nprobe": 64}, {"nprobe": 32}, {"nprobe": 16}]
@@ -0,0 +1,80 @@
+import asyncio
+
+import grpc
+import numpy as np
+from pymilvus import MilvusException
+from pymilvus.exceptions import ParamError
+
+from datastore.providers.milvus_datastore import OUTPUT_DIM, MilvusDataStore, _rejected
+from datastore.providers.milvus_write_buffer import WriteBuffer
+from models.models import DocumentChunk
+
+
+class DeadlineExceeded(grpc.RpcError):
+    """The error pymilvus lets through when an insert times out, possibly applied on the server."""
+
+    def code(self):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+
+    def details(self):
+        return "Deadline Exceeded"
+
+
+def make_datastore(error):
+    """A datastore whose Milvus inserts all fail with error, recording the rows sent."""
+    datastore = MilvusDataStore.__new__(MilvusDataStore)
+    sent = []
+
+    async def run(collection_name, operation, idempotent=True):
+        sent.append(collection_name)
+        raise error
+
+    datastore._run = run
+    datastore._write_buffer = WriteBuffer(datastore._insert_rows, max_wait_ms=50)
+    return datastore, sent
+
+
+def rows(document_id, count):
+    return [
+        (document_id, DocumentChunk(id=f"{document_id}_{i}", text=f"chunk {i}", embedding=np.zeros(OUTPUT_DIM)))
+        for i in range(count)
+    ]
+
+
+async def write_concurrently(datastore):
+    destination = ("collection", "chats")
+    return await asyncio.gather(
+        datastore._write_buffer.write(destination, rows("a", 2)),
+        datastore._write_buffer.write(destination, rows("b", 1)),
+    )
+
+
+def test_rejected_classification():
+    assert _rejected(ParamError(message="invalid data"))
+    assert _rejected(MilvusException(message="the length (70000) of varchar field (text) exceeds max length (65535)"))
+    assert not _rejected(DeadlineExceeded())
+    assert not _rejected(grpc.FutureTimeoutError())
+    assert not _rejected(MilvusException(message="rpc deadline exceeded"))
+    assert not _rejected(ValueError("unexpected"))
+
+
+def test_timed_out_insert_is_not_sent_again():
+    datastore, sent = make_datastore(DeadlineExceeded())
+
+    inserted = asyncio.run(write_concurrently(datastore))
+
+    # One coalesced insert, no retry of rows the server may have stored
+    assert sent == ["collection"]
+    assert inserted == [[False, False], [False]]
+    assert datastore._write_buffer.stats()["retried_writes"] == 0
+
+
+def test_rejected_insert_is_retried_per_write():
+    datastore, sent = make_datastore(ParamError(message="invalid data"))
+
+    inserted = asyncio.run(write_concurrently(datastore))
+
+    # The coalesced insert, then one insert per write
+    assert len(sent) == 3
+    assert inserted == [[False, False], [False]]
+    assert datastore._write_buffer.stats()["retried_writes"] == 2
@@ -0,0 +1,130 @@
+import random
+import re
+
+import pytest
+
+import services.text_normalizer as text_normalizer
+from services.data_processing import clean_description, clean_latex
+from services.text_normalizer import DESCRIPTION_NORMALIZER, LATEX_NORMALIZER
+
+
+def reference_clean_description(description):
+    """clean_description before the TextNormalizer."""
+    description = re.sub(r'http\S+|www.\S+', '', description, flags=re.MULTILINE)
+    description = re.sub(r'\d+:\d+:\d+|\d+:\d+', '', description)
+    description = re.sub(r'\S{30,}', '', description)
+    description = re.sub(r'[^a-zA-Z0-9 \n\.]', '', description)
+    description = re.sub(r'\n+', '\n', description)
+    description = re.sub(r' +', ' ', description)
+    return description
+
+
+def reference_clean_latex(latex_content):
+    """clean_latex before the TextNormalizer."""
+    cleaned_content = re.sub(r'[\u2022-\u5424]', '', latex_content)
+    cleaned_content = re.sub(r'[^\x00-\x7F]+', '', cleaned_content)
+    cleaned_content = re.sub(r' +', ' ', cleaned_content)
+    return cleaned_content
+
+
+CASES = [
+    (reference_clean_description, clean_description, DESCRIPTION_NORMALIZER),
+    (reference_clean_latex, clean_latex, LATEX_NORMALIZER),
+]
+
+TEXTS = [
+    "",
+    " ",
+    "\n",
+    "plain text without anything to clean",
+    "  leading and   trailing  spaces  ",
+    "lines\n\n\nand\n \n more lines\n",
+    "a link http://example.org/a?b=1 and www.example.org/path, then httpz and www y",
+    "at 12:30 or 1:2:3 or 10:20:30:40, ratio 3:4",
+    "short " + "x" * 29 + " long " + "y" * 30 + " longer " + "z" * 45,
+    "$x^2 + y_1$ \\section{Intro} \\begin{align} a &= b \\end{align}",
+    "accents é à ü, ellipsis … bullet • dash — quote « »",
+    "中文 text, 吤 and 吥 around the range end, emoji 🙂",
+    "tabs\tand\rcarriage returns\x00and nulls",
+    "ünïcödé only",
+]
+
+
+def blocks(text, sizes):
+    """Cut text into blocks of the given sizes, repeated until the text is consumed."""
+    start = 0
+    i = 0
+    while start < len(text):
+        end = start + sizes[i % len(sizes)]
+        yield text[start:end]
+        start = end
+        i += 1
+
+
+@pytest.mark.parametrize("reference, function, normalizer", CASES)
+@pytest.mark.parametrize("text", TEXTS)
+def test_normalize_matches_reference(reference, function, normalizer, text):
+    assert function(text) == reference(text)
+    assert normalizer.normalize(text) == reference(text)
+
+
+@pytest.mark.parametrize("reference, function, normalizer", CASES)
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("sizes", [[1], [2, 3], [7], [64]])
+def test_stream_matches_reference(reference, function, normalizer, text, sizes):
+    assert "".join(normalizer.stream(blocks(text, sizes))) == reference(text)
+
+
+@pytest.mark.parametrize("reference, function, normalizer", CASES)
+@pytest.mark.parametrize(
+    "text, cut",
+    [
+        # A block boundary inside a URL, a timestamp, a long sequence and runs of newlines and spaces
+        ("see http://example.org/some/long/path\nnext line", 14),
+        ("meeting at 12:30:45\nagenda", 13),
+        ("a " + "w" * 40 + "\nb", 20),
+        ("first\n\n\n\nsecond", 7),
+        ("first\n   \n   second", 8),
+        ("words      spaced\n      out", 9),
+        ("a line\n" + " " * 10 + "indented", 10),
+        ("中文\n中文 and more", 2),
+    ],
+)
+def test_stream_block_boundary_inside_pattern(reference, function, normalizer, text, cut):
+    assert "".join(normalizer.stream([text[:cut], text[cut:]])) == reference(text)
+
+
+def test_stream_of_no_blocks():
+    assert "".join(DESCRIPTION_NORMALIZER.stream([])) == ""
+    assert "".join(LATEX_NORMALIZER.stream([])) == ""
+
+
+def test_clean_description_of_missing_values():
+    assert clean_description(None) == ""
+    assert clean_description(float("nan")) == ""
+
+
+@pytest.mark.parametrize("reference, function, normalizer", CASES)
+def test_normalize_long_text_in_blocks(monkeypatch, reference, function, normalizer):
+    # normalize() streams the texts longer than STREAM_BLOCK_CHARS
+    monkeypatch.setattr(text_normalizer, "STREAM_BLOCK_CHARS", 16)
+    text = "\n".join(TEXTS) * 3
+    assert normalizer.normalize(text) == reference(text)
+
+
+FRAGMENTS = [
+    "a", "Z", "7", " ", "  ", "\n", "\n\n", "\t", ".", ":", "12:30", "1:2:3", "$x^2$", "\\section{A}",
+    "http://example.org/a?b=1", "www.x", "www y", "httpz", "w", "ww", "é", "…", "•", "中文", "吤", "吥",
+    "x" * 29, "y" * 31, "#", "\r", "\x00",
+]
+
+
+@pytest.mark.parametrize("reference, function, normalizer", CASES)
+def test_random_texts_match_reference(reference, function, normalizer):
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 60)))
+        expected = reference(text)
+        assert normalizer.normalize(text) == expected, text
+        sizes = [rng.randint(1, 64) for _ in range(4)]
+        assert "".join(normalizer.stream(blocks(text, sizes))) == expected, text